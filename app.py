@@ -6,6 +6,7 @@ from dotenv import load_dotenv
 import smtplib
 import imaplib
 import time
+import queue
 import tkinter as tk
 from hashlib import sha256
 from tkinter import ttk
@@ -13,12 +14,17 @@ from tkinter import ttk
 from tkinter import scrolledtext
 from tkinter import ttk
 from message import Request, Response
-from smtp import send_email, log_in
-from imap import read_email
-from deploy import create_contract, register_voter, vote, getBundle, check_contract,check_consistency
+from smtp import SMTPSender
+from outbox import Outbox
+from indexer import EventIndexer
+from imap import read_email, ResponseListener
+from deploy import create_contract_with_voters, register_voter, vote, getBundle, check_request
 from tkinter import *
 from tkinter import messagebox
 
+TRANSACTION_POLL_MS = 500
+RESPONSE_POLL_MS = 1000
+OUTBOX_POLL_MS = 2000
 
         
 def CreateInterface(bgcolor):
@@ -133,6 +139,12 @@ def CreateInterface(bgcolor):
 def emailExit():
     MsgBox = messagebox.askquestion('Exit Application', 'Are you sure you want to exit?')
     if MsgBox == 'yes':
+        if root.listener != None:
+            root.listener.stop(wait=False)
+        root.outbox.stop(wait=False)
+        if root.indexer != None:
+            root.indexer.stop(wait=False)
+        SMTPSender.close_all()
         root.destroy()
         os.popen("LoginGUI.pyw")
 
@@ -146,7 +158,8 @@ def retrieveBundle():
     abi = os.getenv('ABI')
     Contract_address = os.getenv("Contract_Address")
     url = os.getenv('URL')
-    strBundle = getBundle(abi, url,Contract_address,private_key,account_address,requestID)
+    store = root.indexer.store if root.indexer != None else None
+    strBundle = getBundle(abi, url,Contract_address,private_key,account_address,requestID,store)
     root.bodyEmail.insert(tk.INSERT, strBundle)
 
 def readEmail():
@@ -155,13 +168,48 @@ def readEmail():
     recipient = toEmail.get()
     subject = subjectEmail.get()
     try:
-        email_message = read_email(email,password,subject,recipient)
-        root.bodyEmail.insert(tk.INSERT, email_message)
+        # Show the newest encrypted reply; older ones are never downloaded or decrypted
+        email_message = None
+        for reply in read_email(email,password,subject,recipient):
+            if reply.payload != None:
+                email_message = reply.format()
+                break
+        if email_message == None:
+            messagebox.showinfo("Read Email",message="No encrypted replies from " + recipient + " yet.")
+        else:
+            root.bodyEmail.insert(tk.INSERT, email_message)
+        listenForResponses(email,password,subject,recipient)
     except imaplib.IMAP4.error:
         messagebox.showerror("Error",message="Login failed.")
     except FieldException:
         messagebox.showerror("Error",message="Fields are missing.")   
         
+def listenForResponses(email,password,subject,recipient):
+    '''
+    Keep watching the Inbox for further replies from this recipient about
+    this subject, replacing any listener started for a different one.
+    '''
+    criteria = '(FROM "{}" SUBJECT "{}")'.format(recipient,subject)
+    if root.listener != None:
+        if root.listener.sync.criteria == criteria and root.listener.is_alive():
+            return
+        root.listener.stop(wait=False)
+    root.listener = ResponseListener(email,password,criteria).start()
+    watchResponses(root.listener)
+
+def watchResponses(listener):
+    '''
+    Show the votes a ResponseListener has picked up, from the Tk main loop.
+    '''
+    while True:
+        try:
+            sender, response = listener.queue.get_nowait()
+        except queue.Empty:
+            break
+        root.bodyEmail.insert(tk.INSERT, "\nVote from {0}: {1} (request {2})\n".format(sender, response.responseContents, response.requestID))
+    if listener.is_alive() or not listener.queue.empty():
+        root.after(RESPONSE_POLL_MS, watchResponses, listener)
+
 def create_request(messageContents, action,messageHash=None,alreadySent=False,inputtedTime=''):
     # Strip out newlines
     "Newlines aren't supported by the Request class"
@@ -246,6 +294,30 @@ def triggerConsistency(boolTuple):
 
     
 
+def watchTransaction(pendingTransaction, description):
+    '''
+    Check on a transaction sent with wait=False from the Tk main loop, so the
+    interface stays responsive while it confirms, and report it if it fails.
+    '''
+    if not pendingTransaction.done():
+        root.after(TRANSACTION_POLL_MS, watchTransaction, pendingTransaction, description)
+        return
+    error = pendingTransaction.exception()
+    if error != None:
+        messagebox.showerror("Error",message="{0} failed: {1}".format(description, error))
+
+def watchOutbox():
+    '''
+    Report any email the outbox has given up on, from the Tk main loop.
+    '''
+    while True:
+        try:
+            job, error = root.outbox.deadLetters.get_nowait()
+        except queue.Empty:
+            break
+        messagebox.showerror("Error",message="Email \"{0}\" to {1} could not be sent: {2}".format(job["subject"], ", ".join(job["recipients"]), error))
+    root.after(OUTBOX_POLL_MS, watchOutbox)
+
 def sendEmail():
 
     # Fetching all the necessary parameters and storing in respective variables
@@ -264,7 +336,9 @@ def sendEmail():
     url = os.getenv('URL')
 
     try:
-        server = log_in(email,password)
+        sender = SMTPSender.for_account(email,password)
+        sender.connect()
+        root.outbox.register_account(email,password)
         triggerException(root.entryValue.get(), bodyOld,email, password, recipient,recipientEthAddress, subject, businessPercentage, root.type.get())
         if(root.type.get() == "Request"):
             if root.expiryOpt.get() == "Days":
@@ -276,31 +350,32 @@ def sendEmail():
             
             subjectHash = sha256(subject.encode('utf-8')).hexdigest()
             keyID = email + subject
-            returnedResult = check_contract(Contract_address, abi, url,keyID)
+            bodyOldHash = sha256(bodyOld.encode('utf-8')).hexdigest()
+            returnedResult, boolTuple = check_request(Contract_address,abi,url,keyID,bodyOldHash,expiryDate,int(businessPercentage),account_address)
             if(returnedResult[1]==''):
                 body,messageID, requestDate,expiryLength = create_request(bodyOld,root.action.get())
                 requestDate = requestDate + " +" + expiryLength
-                result1 = create_contract(abi,url,messageID,expiryDate,int(businessPercentage),Contract_address,subject,bodyOld,requestDate,keyID)
-                result2 = register_voter(Contract_address, abi, url,recipientEthAddress,account_address,private_key,messageID)
-                send_email(email,server,recipient,subject,body)
+                result1 = create_contract_with_voters(abi,url,messageID,expiryDate,int(businessPercentage),Contract_address,subject,bodyOld,requestDate,keyID,[recipientEthAddress],wait=False)
+                root.outbox.enqueue(email,[recipient],subject,body,after=result1[-1],url=url)
+                watchTransaction(result1[-1], "Creating the proposal")
             else:
                 messageID = returnedResult[0].hex()
                 messageDate = returnedResult[1]
-                bodyOldHash = sha256(bodyOld.encode('utf-8')).hexdigest()
-                boolTuple = check_consistency(Contract_address,abi,url,keyID,bodyOldHash,expiryDate,int(businessPercentage))
                 triggerConsistency(boolTuple)
                 body, _, _, _ = create_request(bodyOld,root.action.get(),messageID,True,messageDate)
-                result2 = register_voter(Contract_address, abi, url,recipientEthAddress,account_address,private_key,messageID)
-                send_email(email,server,recipient,subject,body)
+                result2 = register_voter(Contract_address, abi, url,recipientEthAddress,account_address,private_key,messageID,wait=False)
+                root.outbox.enqueue(email,[recipient],subject,body,after=result2,url=url)
+                watchTransaction(result2, "Registering " + recipientEthAddress)
 
         elif(root.type.get() == "Response"):
             r = Response(bodyOld)
             _, responseString, requestID = r.parse_from_email()
-            result = vote(Contract_address, abi, url,account_address,private_key,responseString.lower(),requestID)
-            send_email(email,server,recipient,subject,bodyOld)
+            result = vote(Contract_address, abi, url,account_address,private_key,responseString.lower(),requestID,wait=False)
+            root.outbox.enqueue(email,[recipient],subject,bodyOld,after=result,url=url)
+            watchTransaction(result, "Vote")
 
 
-        messagebox.showinfo("Success",message="Email sent successfully to " + str(recipient))
+        messagebox.showinfo("Success",message="Email to " + str(recipient) + " queued. It is sent once the transaction is confirmed.")
 
     except smtplib.SMTPAuthenticationError:
         messagebox.showerror("Error",message="Invalid username or password")
@@ -338,6 +413,17 @@ root.config(background = bgColor)
 root.title("Email-based Consensus Protocol")
 root.resizable(True,True)
 
+# The background ResponseListener started by "Read Email", if any
+root.listener = None
+# Delivers outgoing email in the background, picking up any left from the last session
+root.outbox = Outbox.shared()
+# Mirrors the contract's events into a local database, so finished bundles are read without the node.
+# It only runs once DEPLOY_BLOCK is set, so the first sync doesn't scan the chain from genesis.
+load_dotenv()
+root.indexer = None
+if os.getenv('URL') and os.getenv("Contract_Address") and os.getenv("DEPLOY_BLOCK"):
+    root.indexer = EventIndexer.for_contract(os.getenv('URL'), os.getenv("Contract_Address"), startBlock=int(os.getenv("DEPLOY_BLOCK"))).start()
+
 # Creating tkinter variables
 toEmail = StringVar(root)
 fromEmail = StringVar(root)
@@ -348,6 +434,7 @@ businessRequirement = StringVar(root)
 
 # Calling the CreateWidgets() function with argument bgColor
 CreateInterface(bgColor)
+watchOutbox()
 
 # Defining infinite loop to run application
 root.mainloop()
\ No newline at end of file
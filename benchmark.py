@@ -0,0 +1,1344 @@
+#! python3
+# benchmark.py
+# Micro-benchmarks for the P.O.C application, run against local in-process stand-ins.
+#
+# Usage: python benchmark.py [benchmark name ...]
+# With no arguments every benchmark is run.
+
+import email, json, os, re, socket, socketserver, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------- Global values ---------- #
+ARTIFACTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "contracts", "artifacts")
+CONTRACTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "contracts")
+CONTRACT_ADDRESS = "0x" + "42" * 20
+MESSAGE_ID = "ab" * 32
+SOLC_VERSION = "0.8.17"
+
+def load_abi(name="BusinessConsensus"):
+    with open(os.path.join(ARTIFACTS_PATH, name + ".json")) as f:
+        return json.dumps(json.load(f)["abi"])
+
+def word(value):
+    '''
+    ABI-encode an integer as a single 32-byte word.
+    '''
+    return "0x" + hex(value)[2:].rjust(64, "0")
+
+# ---------- Stand-in blockchain node ---------- #
+class NodeError(Exception):
+    '''
+    Raised by a StandInNode method to answer with a JSON-RPC error object.
+    '''
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+class StandInNode:
+    '''
+    A minimal JSON-RPC node served from a background thread. It understands
+    just enough of the Ethereum API for the client code paths being measured,
+    and counts HTTP round-trips and JSON-RPC calls so benchmarks can report them.
+
+    Arguments:
+        latency -- Seconds of artificial delay added to every HTTP round-trip.
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.roundTrips = 0
+        self.calls = 0
+        self.connections = 0
+        self.methods = {
+            "eth_chainId": lambda params: "0x539",
+            "net_version": lambda params: "1337",
+            "eth_blockNumber": lambda params: "0x1",
+            "eth_gasPrice": lambda params: hex(10 ** 9),
+            "eth_feeHistory": lambda params: {"oldestBlock": "0x1", "baseFeePerGas": [hex(10 ** 9)] * 2, "gasUsedRatio": [0.5], "reward": [[hex(10 ** 8)]]},
+            "eth_getTransactionCount": lambda params: "0x0",
+            "eth_call": lambda params: self.callResults.get(params[0]["data"][:10], word(1)),
+            "eth_estimateGas": lambda params: hex(100000),
+            "eth_sendRawTransaction": self.send_raw_transaction,
+            "eth_getTransactionReceipt": lambda params: self.receipts.get(params[0]),
+        }
+        self.receipts = {}
+        # Canned eth_call results keyed by 4-byte function selector
+        self.callResults = {}
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                node.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                node.roundTrips += 1
+                if node.latency:
+                    time.sleep(node.latency)
+                if isinstance(body, list):
+                    reply = [node.dispatch(call) for call in body]
+                else:
+                    reply = node.dispatch(body)
+                payload = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def dispatch(self, call):
+        self.calls += 1
+        method = self.methods.get(call["method"])
+        if method == None:
+            return {"jsonrpc": "2.0", "id": call["id"], "error": {"code": -32601, "message": "method not found"}}
+        try:
+            return {"jsonrpc": "2.0", "id": call["id"], "result": method(call.get("params", []))}
+        except NodeError as e:
+            return {"jsonrpc": "2.0", "id": call["id"], "error": {"code": e.code, "message": str(e)}}
+
+    def send_raw_transaction(self, params):
+        '''
+        "Mine" a transaction immediately by storing a successful receipt for it.
+        '''
+        from eth_utils import keccak
+        hash = "0x" + keccak(hexstr=params[0]).hex()
+        self.receipts[hash] = {
+            "transactionHash": hash, "transactionIndex": "0x0", "blockHash": "0x" + "11" * 32,
+            "blockNumber": "0x1", "from": "0x" + "00" * 20, "to": CONTRACT_ADDRESS,
+            "cumulativeGasUsed": "0x5208", "gasUsed": "0x5208", "contractAddress": None,
+            "logs": [], "logsBloom": "0x" + "00" * 256, "status": "0x1", "effectiveGasPrice": hex(10 ** 9), "type": "0x0",
+        }
+        return hash
+
+    def reset_counters(self):
+        self.roundTrips = 0
+        self.calls = 0
+        self.connections = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# ---------- Stand-in IMAP server ---------- #
+class StandInIMAP:
+    '''
+    A minimal IMAP4rev1 server served from a background thread, with one
+    mailbox ("Inbox") holding the raw RFC822 messages in .messages. It
+    understands just enough of the protocol for imaplib and the code paths
+    being measured, and counts connections, logins, commands and bytes sent.
+
+    Arguments:
+        latency -- Seconds of artificial delay added to every command.
+        handshakeLatency -- Seconds of delay before the greeting, standing in for a TLS handshake.
+        condstore -- Whether SELECT reports HIGHESTMODSEQ, as CONDSTORE servers do.
+        idle -- Whether the server supports IDLE.
+    '''
+    def __init__(self, latency=0.0, handshakeLatency=0.0, condstore=False, idle=False):
+        self.latency = latency
+        self.handshakeLatency = handshakeLatency
+        self.condstore = condstore
+        self.idle = idle
+        # Writers of the connections currently in IDLE
+        self.idlers = []
+        self.idlersLock = threading.Lock()
+        self.messages = []
+        self.reset_counters()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                socketserver.StreamRequestHandler.setup(self)
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def handle(self):
+                server.connections += 1
+                if server.handshakeLatency:
+                    time.sleep(server.handshakeLatency)
+                self.wfile.write(b"* OK IMAP4rev1 stand-in ready\r\n")
+                seen = 0
+                for line in self.rfile:
+                    tag, command, args = (line.decode().rstrip("\r\n").split(" ", 2) + ["", ""])[:3]
+                    server.commands += 1
+                    if server.latency:
+                        time.sleep(server.latency)
+                    if command.upper() == "IDLE" and server.idle:
+                        self.idle(tag)
+                        continue
+                    untagged, status = server.dispatch(command.upper(), args)
+                    # Like a real server, report new mail in reply to NOOP
+                    if command.upper() in ("SELECT", "EXAMINE", "NOOP"):
+                        if command.upper() == "NOOP" and len(server.messages) != seen:
+                            untagged = ["* {0} EXISTS\r\n".format(len(server.messages)).encode()] + untagged
+                        seen = len(server.messages)
+                    reply = b"".join(untagged) + "{0} {1}\r\n".format(tag, status).encode()
+                    server.bytesSent += len(reply)
+                    self.wfile.write(reply)
+                    if command.upper() == "LOGOUT":
+                        return
+
+            def idle(self, tag):
+                with server.idlersLock:
+                    self.wfile.write(b"+ idling\r\n")
+                    server.idlers.append(self.wfile)
+                self.rfile.readline()
+                with server.idlersLock:
+                    server.idlers.remove(self.wfile)
+                    self.wfile.write("{0} OK IDLE terminated\r\n".format(tag).encode())
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def dispatch(self, command, args):
+        '''
+        Return (untagged response lines as bytes, tagged status) for one command.
+        '''
+        if command == "CAPABILITY":
+            return [b"* CAPABILITY IMAP4rev1" + (b" IDLE" if self.idle else b"") + b"\r\n"], "OK CAPABILITY completed"
+        if command == "LOGIN":
+            self.logins += 1
+            return [], "OK LOGIN completed"
+        if command in ("SELECT", "EXAMINE"):
+            untagged = ["* {0} EXISTS".format(len(self.messages)), "* OK [UIDVALIDITY 1] UIDs valid", "* OK [UIDNEXT {0}] Predicted next UID".format(len(self.messages) + 1)]
+            if self.condstore:
+                untagged.append("* OK [HIGHESTMODSEQ {0}] Highest".format(len(self.messages) + 1))
+            return [(line + "\r\n").encode() for line in untagged], "OK [READ-WRITE] SELECT completed"
+        if command == "UID":
+            command, args = (args.split(" ", 1) + [""])[:2]
+            return self.dispatch_messages(command.upper(), args, True)
+        if command in ("SEARCH", "FETCH"):
+            return self.dispatch_messages(command, args, False)
+        if command == "NOOP":
+            return [], "OK NOOP completed"
+        if command == "LOGOUT":
+            return [b"* BYE logging out\r\n"], "OK LOGOUT completed"
+        return [], "BAD unknown command"
+
+    def dispatch_messages(self, command, args, byUid):
+        '''
+        SEARCH and FETCH, by message number or by UID. A message's UID is its number.
+        '''
+        if command == "SEARCH":
+            terms = [term.encode() for term in re.findall(r'"([^"]*)"', args)]
+            uidRange = re.search(r"UID (\S+)", args)
+            candidates = self.message_set(uidRange[1]) if uidRange != None else range(1, len(self.messages) + 1)
+            found = [str(num) for num in candidates if all([term in self.messages[num - 1] for term in terms])]
+            return [" ".join(["* SEARCH"] + found).encode() + b"\r\n"], "OK SEARCH completed"
+        if command == "FETCH":
+            nums, items = args.split(" ", 1)
+            return [self.fetch_item(num, items, byUid) for num in self.message_set(nums)], "OK FETCH completed"
+        return [], "BAD unknown command"
+
+    def message_set(self, nums):
+        found = []
+        for item in nums.split(","):
+            first, last = (item.split(":") + [item])[:2]
+            if last == "*":
+                first, last = min(int(first), len(self.messages)), len(self.messages)
+            found += [num for num in range(int(first), int(last) + 1) if num <= len(self.messages)]
+        return found
+
+    def fetch_item(self, num, items, byUid=False):
+        '''
+        The untagged FETCH response for one message. Understands RFC822,
+        BODYSTRUCTURE and BODY[section] / BODY.PEEK[section] for part numbers
+        and HEADER.FIELDS.
+        '''
+        raw = self.messages[num - 1]
+        message = email.message_from_bytes(raw)
+        attributes = [b"UID " + str(num).encode()] if byUid else []
+        for item in re.finditer(r"BODY(?:\.PEEK)?\[([^\]]*)\]|RFC822|BODYSTRUCTURE", items):
+            if item[0] == "RFC822":
+                data = raw
+            elif item[0] == "BODYSTRUCTURE":
+                attributes.append(b"BODYSTRUCTURE " + self.body_structure(message))
+                continue
+            elif item[1].upper().startswith("HEADER.FIELDS"):
+                names = item[1][item[1].index("(") + 1:item[1].index(")")].lower().split()
+                data = b"".join(["{0}: {1}\r\n".format(key, value).encode() for key, value in message.items() if key.lower() in names]) + b"\r\n"
+            else:
+                part = message
+                for number in item[1].split("."):
+                    part = part.get_payload()[int(number) - 1] if part.is_multipart() else part
+                data = part.get_payload().encode()
+            name = b"RFC822" if item[0] == "RFC822" else "BODY[{0}]".format(item[1]).encode()
+            attributes.append(name + " {{{0}}}\r\n".format(len(data)).encode() + data)
+        return "* {0} FETCH (".format(num).encode() + b" ".join(attributes) + b")\r\n"
+
+    def body_structure(self, part):
+        if part.is_multipart():
+            children = b"".join([self.body_structure(child) for child in part.get_payload()])
+            return children.join([b"(", ' "{0}")'.format(part.get_content_subtype()).encode()])
+        payload = part.get_payload().encode()
+        fields = '"{0}" "{1}" NIL NIL NIL "{2}" {3}'.format(part.get_content_maintype(), part.get_content_subtype(), part.get("Content-Transfer-Encoding", "7bit"), len(payload))
+        if part.get_content_maintype() == "text":
+            fields += " {0}".format(payload.count(b"\n"))
+        return "({0})".format(fields).encode()
+
+    def deliver(self, message):
+        '''
+        Add a message to the Inbox and tell every connection in IDLE about it.
+        '''
+        with self.idlersLock:
+            self.messages.append(message)
+            for wfile in self.idlers:
+                wfile.write("* {0} EXISTS\r\n".format(len(self.messages)).encode())
+
+    def reset_counters(self):
+        self.connections = 0
+        self.logins = 0
+        self.commands = 0
+        self.bytesSent = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# ---------- Stand-in SMTP server ---------- #
+class StandInSMTP:
+    '''
+    A minimal ESMTP server (no TLS) served from a background thread. It
+    accepts any AUTH PLAIN login, keeps every message it receives in
+    .messages as (sender, recipients, data), and counts connections and logins.
+
+    Arguments:
+        latency -- Seconds of artificial delay added to every command.
+        handshakeLatency -- Seconds of delay before the greeting, standing in for STARTTLS.
+        dropAfter -- Hang up on a client after this many messages, to exercise reconnects.
+        deferEvery -- Refuse every this many'th MAIL command with a temporary 451 reply.
+    '''
+    def __init__(self, latency=0.0, handshakeLatency=0.0, dropAfter=None, deferEvery=None):
+        self.latency = latency
+        self.handshakeLatency = handshakeLatency
+        self.dropAfter = dropAfter
+        self.deferEvery = deferEvery
+        self.messages = []
+        self.lock = threading.Lock()
+        self.reset_counters()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                socketserver.StreamRequestHandler.setup(self)
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def reply(self, line):
+                if server.latency:
+                    time.sleep(server.latency)
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def handle(self):
+                server.connections += 1
+                if server.handshakeLatency:
+                    time.sleep(server.handshakeLatency)
+                self.wfile.write(b"220 stand-in ESMTP ready\r\n")
+                sender, recipients, received = None, [], 0
+                for line in self.rfile:
+                    command = line.decode().strip()
+                    verb = command.split(" ", 1)[0].upper()
+                    if verb in ("EHLO", "HELO"):
+                        self.reply("250-stand-in\r\n250 AUTH PLAIN")
+                    elif verb == "AUTH":
+                        server.logins += 1
+                        self.reply("235 2.7.0 Accepted")
+                    elif verb == "MAIL":
+                        with server.lock:
+                            server.mails += 1
+                            deferred = server.deferEvery != None and server.mails % server.deferEvery == 0
+                            server.deferred += deferred
+                        if deferred:
+                            self.reply("451 4.7.1 Try again later")
+                            continue
+                        sender, recipients = command[10:].strip("<>"), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command[8:].strip("<>"))
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                        with server.lock:
+                            server.messages.append((sender, recipients, data))
+                        self.reply("250 OK queued")
+                        received += 1
+                        if server.dropAfter != None and received >= server.dropAfter:
+                            return
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def reset_counters(self):
+        self.connections = 0
+        self.logins = 0
+        self.mails = 0
+        self.deferred = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# ---------- Local dev chain ---------- #
+class DevChain(StandInNode):
+    '''
+    A StandInNode whose calls are all answered by a real in-process EVM
+    (eth-tester with the py-evm backend), so gas figures are genuine while
+    the client code under test still talks JSON-RPC over HTTP.
+
+    Needs the optional packages eth-tester[py-evm] and py-solc-x.
+    '''
+    def __init__(self, latency=0.0):
+        StandInNode.__init__(self, latency)
+        from web3 import Web3
+        self.web3 = Web3(Web3.EthereumTesterProvider())
+        self.chainLock = threading.Lock()
+
+    def dispatch(self, call):
+        self.calls += 1
+        with self.chainLock:
+            response = dict(self.web3.provider.make_request(call["method"], call.get("params", [])))
+        response["jsonrpc"] = "2.0"
+        response["id"] = call["id"]
+        return json.loads(json.dumps(response, default=to_json))
+
+    def deploy(self, name="BusinessConsensus"):
+        '''
+        Compile contracts/<name>.sol and deploy it from the first funded
+        eth-tester account. Return (address, abi as a JSON string).
+        '''
+        import solcx
+        solcx.install_solc(SOLC_VERSION)
+        compiled = solcx.compile_files([os.path.join(CONTRACTS_PATH, name + ".sol")], output_values=["abi", "bin"], solc_version=SOLC_VERSION)
+        artifact = [value for key, value in compiled.items() if key.endswith(":" + name)][0]
+        with self.chainLock:
+            contract = self.web3.eth.contract(abi=artifact["abi"], bytecode=artifact["bin"])
+            tx = contract.constructor().transact({"from": self.web3.eth.accounts[0]})
+            address = self.web3.eth.wait_for_transaction_receipt(tx)["contractAddress"]
+        return address, json.dumps(artifact["abi"])
+
+    def time_travel(self, seconds):
+        '''
+        Move the chain's clock forward, e.g. past a proposal's expiry.
+        '''
+        with self.chainLock:
+            tester = self.web3.provider.ethereum_tester
+            tester.time_travel(self.web3.eth.get_block("latest")["timestamp"] + seconds)
+            tester.mine_blocks()
+
+    def funded_account(self):
+        '''
+        Create a new local account holding enough ether to pay for benchmarks.
+        '''
+        from eth_account import Account
+        account = Account.create()
+        with self.chainLock:
+            tx = self.web3.eth.send_transaction({"from": self.web3.eth.accounts[0], "to": account.address, "value": 10 ** 20})
+            self.web3.eth.wait_for_transaction_receipt(tx)
+        return account
+
+def to_json(value):
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    raise TypeError("{0!r} is not JSON serializable".format(value))
+
+def new_message_id():
+    return "0x" + os.urandom(32).hex()
+
+def timed(function, iterations):
+    '''
+    Run function() iterations times and return the mean latency in milliseconds.
+    '''
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+def report(title, rows):
+    print("\n" + title)
+    for label, value in rows:
+        print("  {0:<46} {1}".format(label, value))
+
+# ---------- Benchmarks ---------- #
+def bench_connection_pool(iterations=300):
+    '''
+    Per-call latency of a read-only contract view using a fresh Web3 and
+    contract object per call (the pre-pooling code path) versus the shared
+    ConsensusClient.
+    '''
+    from web3 import Web3
+    from chain import ConsensusClient
+    abi = load_abi()
+
+    with StandInNode() as node:
+        def fresh():
+            web3 = Web3(Web3.HTTPProvider(node.url))
+            contract = web3.eth.contract(address=CONTRACT_ADDRESS, abi=abi)
+            contract.functions.getIsCompiled(MESSAGE_ID).call()
+
+        def pooled():
+            contract = ConsensusClient.for_url(node.url).contract(CONTRACT_ADDRESS, abi)
+            contract.functions.getIsCompiled(MESSAGE_ID).call()
+
+        fresh()
+        pooled()
+        node.reset_counters()
+        freshMs = timed(fresh, iterations)
+        node.reset_counters()
+        pooledMs = timed(pooled, iterations)
+        ConsensusClient.close_all()
+
+    report("Connection pool: getIsCompiled() x {0}".format(iterations), [
+        ("fresh Web3 per call (ms/call)", "{0:.3f}".format(freshMs)),
+        ("shared ConsensusClient (ms/call)", "{0:.3f}".format(pooledMs)),
+        ("speed-up", "{0:.1f}x".format(freshMs / pooledMs)),
+    ])
+
+def bench_bulk_registration(sizes=(1, 10, 50)):
+    '''
+    Gas and wall-clock latency of registering N voters with one RegisterVoter
+    transaction each (sent and confirmed one after another, as app.sendEmail
+    used to) versus deploy.register_voters() on a local EVM.
+    '''
+    from eth_account import Account
+    from chain import ConsensusClient
+    import deploy
+
+    rows = []
+    with DevChain() as chain:
+        address, abi = chain.deploy()
+        account = chain.funded_account()
+        client = ConsensusClient.for_url(chain.url)
+        contract = client.contract(address, abi)
+
+        for size in sizes:
+            voters = [Account.create().address for _ in range(size)]
+
+            messageID = new_message_id()
+            client.transact(contract.functions.createContract(messageID, 3600, 50, messageID, "date", messageID), account.address, account.key)
+            start = time.perf_counter()
+            receipts = [deploy.register_voter(address, abi, chain.url, voter, account.address, account.key, messageID) for voter in voters]
+            singleMs = (time.perf_counter() - start) * 1000
+            singleGas = sum([receipt["gasUsed"] for receipt in receipts])
+
+            messageID = new_message_id()
+            client.transact(contract.functions.createContract(messageID, 3600, 50, messageID, "date", messageID), account.address, account.key)
+            start = time.perf_counter()
+            receipts = deploy.register_voters(address, abi, chain.url, voters, account.address, account.key, messageID)
+            bulkMs = (time.perf_counter() - start) * 1000
+            bulkGas = sum([receipt["gasUsed"] for receipt in receipts])
+
+            rows.append(("{0} voters: RegisterVoter x {0} (gas / ms)".format(size), "{0} / {1:.1f}".format(singleGas, singleMs)))
+            rows.append(("{0} voters: register_voters (gas / ms)".format(size), "{0} / {1:.1f}".format(bulkGas, bulkMs)))
+        ConsensusClient.close_all()
+
+    report("Bulk voter registration", rows)
+
+def bench_batch_reads(iterations=50, latency=0.02):
+    '''
+    HTTP round-trips and latency of the reads made before creating a request:
+    getIsCreated, checkConsistency, the gas price and the pending nonce, sent
+    one by one versus as one deploy.check_request() batch. The stand-in node
+    adds latency seconds to every round-trip to mimic a remote RPC endpoint.
+    '''
+    from eth_abi import encode_abi
+    from chain import ConsensusClient
+    import deploy
+    abi = load_abi()
+    keyID = "sender@example.comSubject"
+    account = "0x" + "17" * 20
+
+    with StandInNode(latency) as node:
+        contract = ConsensusClient.for_url(node.url).contract(CONTRACT_ADDRESS, abi)
+        selector = lambda function: function._encode_transaction_data()[:10]
+        node.callResults[selector(contract.functions.getIsCreated(MESSAGE_ID))] = "0x" + encode_abi(["bytes32", "string"], [b"\x01" * 32, "Mon Jan 1 00:00:00 2024 +0000 +1d"]).hex()
+        node.callResults[selector(contract.functions.checkConsistency(MESSAGE_ID, 50, 60, MESSAGE_ID))] = "0x" + encode_abi(["bool", "bool", "bool"], [True, True, True]).hex()
+
+        def sequential():
+            client = ConsensusClient.for_url(node.url)
+            deploy.check_contract(CONTRACT_ADDRESS, abi, node.url, keyID)
+            deploy.check_consistency(CONTRACT_ADDRESS, abi, node.url, keyID, MESSAGE_ID, 60, 50)
+            client.web3.eth.gas_price
+            client.web3.eth.getTransactionCount(account, 'pending')
+
+        def batched():
+            deploy.check_request(CONTRACT_ADDRESS, abi, node.url, keyID, MESSAGE_ID, 60, 50, account)
+
+        sequential()
+        batched()
+        node.reset_counters()
+        sequentialMs = timed(sequential, iterations)
+        sequentialTrips = node.roundTrips / iterations
+        node.reset_counters()
+        batchedMs = timed(batched, iterations)
+        batchedTrips = node.roundTrips / iterations
+        ConsensusClient.close_all()
+
+    report("Batched reads: request-creation checks x {0} ({1:.0f} ms per round-trip)".format(iterations, latency * 1000), [
+        ("sequential (round-trips / ms per check)", "{0:.1f} / {1:.1f}".format(sequentialTrips, sequentialMs)),
+        ("check_request (round-trips / ms per check)", "{0:.1f} / {1:.1f}".format(batchedTrips, batchedMs)),
+    ])
+
+def legacy_parse_request(email_string):
+    '''
+    The regex-per-call Request parser that blockparser replaced, kept here as
+    the baseline. It returns the raw captured fields.
+    '''
+    import re
+    email_string = email_string.replace("\r", "")
+    requestRegex = re.compile(
+        r"#.+?-{10}.+?START.+?BLOCKCHAIN.+?REQUEST.+?-{10}.+?#\n(.+?)\n#..?-{10}.+?END.+?BLOCKCHAIN.+?REQUEST.+?-{10}.+?#\n"
+    , re.DOTALL)
+    requestBlock = requestRegex.search(email_string)
+    if requestBlock == None:
+        return None
+    parseRegex = re.compile(
+        r"^#.+?MESSAGE.DATE:.+?(.+?)\n#.+?EXPIRY.+?DATE:.+?(.+?)\n#.+?MESSAGE.+?ID:.+?(.+?)\n#.+?MESSAGE.+?CONTENTS:.+?(.+?)\n#.+?ACTION.+?REQUESTED:.+?\n#.+?Edit.+?the.+?MESSAGE.+?RESPONSE.+?field.+?to.+?say.+?\"(I.+?[A-Za-z]+?)\".+?if.+?YES,.+?or.+?\"(I.+?[A-Za-z]+?)\".+?if.+?NO"
+    , re.DOTALL)
+    parse = parseRegex.search(requestBlock[1])
+    if parse == None:
+        return None
+    message = parse[4]
+    while "\n" in message or "  " in message:
+        message = message.replace("\n", " ")
+        message = message.replace("  ", " ")
+    return message
+
+def legacy_parse_response(email_string):
+    import re
+    responseRegex = re.compile(r"#.+?-{10}.+?START.+?BLOCKCHAIN.+?RESPONSE.+?-{10}.+?#\n# MESSAGE ID:.+?\w{64}\n#.+?MESSAGE.+?RESPONSE:.+?I.+?[A-Za-z]+?\n#.+?-{10}.+?END.+?BLOCKCHAIN RESPONSE.+?-{10}.+?#", re.DOTALL)
+    responseBlock = responseRegex.search(email_string.replace("\r", ""))
+    if responseBlock == None:
+        return None
+    parseRegex = re.compile(r"#.+?MESSAGE.+?ID:.+?(\w{64})\s{0,10}?\n#.+?MESSAGE.+?RESPONSE:.+?(I.+?[A-Za-z]+).+?\s{0,10}", re.DOTALL)
+    return parseRegex.search(responseBlock[0])
+
+def bench_parser(iterations=5):
+    '''
+    Time to parse a Request and a Response out of large and pathological email
+    bodies with the legacy regex parser versus blockparser.
+    '''
+    from message import Request, Response, responseFormat
+
+    request = Request()
+    request.create_new("Please approve the attached budget", "approval")
+    requestText = request.format_request_as_string()
+    responseText = responseFormat.format(request.id, "approve", "disapprove").replace(" OR I disapprove", "")
+    thread = "> On Mon, someone wrote:\n> " + "lorem ipsum dolor sit amet " * 8 + "\n"
+    hugeContents = "word  \n" * 20000
+
+    bodies = {
+        # A long reply thread with the blocks at the very end
+        "long thread (~600 KB)": thread * 2500 + requestText + responseText,
+        # A request whose contents wrap over 20,000 lines of doubled spaces
+        "huge wrapped contents": requestText.replace("Please approve the attached budget", hugeContents),
+        # START frames that are never closed: the legacy regex backtracks through every combination
+        # of them, so each extra frame multiplies its run time
+        "8 unclosed frames": "# ---------- START BLOCKCHAIN RESPONSE ---------- #\n# MESSAGE ID: x\n" * 8 + "filler\n" * 80,
+    }
+
+    rows = []
+    for label, body in bodies.items():
+        def legacy():
+            legacy_parse_request(body)
+            legacy_parse_response(body)
+
+        def current():
+            Request().parse_from_email(body)
+            Response(body)
+
+        legacyMs = timed(legacy, iterations)
+        currentMs = timed(current, iterations)
+        rows.append((label + " (legacy / blockparser ms)", "{0:.2f} / {1:.2f}".format(legacyMs, currentMs)))
+
+    report("Block parser: Request + Response per email ({0} runs)".format(iterations), rows)
+
+def bench_imap_sessions(iterations=50, latency=0.002, handshakeLatency=0.05):
+    '''
+    Per-call latency of read_email() connecting and logging in on every call
+    (the pre-pooling code path) versus reusing a session from IMAPSessionPool.
+    '''
+    import imaplib
+    from imap import IMAPSessionPool, read_email
+    subject, sender = "Consensus", "bob@example.com"
+
+    with StandInIMAP(latency, handshakeLatency) as server:
+        server.messages.append("From: {0}\r\nSubject: {1}\r\n\r\nHello\r\n".format(sender, subject).encode())
+
+        def fresh():
+            imap_server = imaplib.IMAP4("127.0.0.1", server.port)
+            imap_server.login("alice@example.com", "secret")
+            imap_server.select('Inbox')
+            _, data = imap_server.search(None, '(FROM "{}" SUBJECT "{}")'.format(sender, subject))
+            for num in data[0].split():
+                imap_server.fetch(num, '(RFC822)')
+            # The old code never logged out; do so here so the benchmark doesn't leak sockets
+            imap_server.logout()
+
+        pool = IMAPSessionPool("127.0.0.1", server.port, ssl=False)
+        pooled = lambda: list(read_email("alice@example.com", "secret", subject, sender, pool=pool))
+
+        freshMs = timed(fresh, iterations)
+        freshLogins = server.logins
+        server.reset_counters()
+        pooledMs = timed(pooled, iterations)
+        pooledLogins = server.logins
+        pool.close()
+
+    report("IMAP sessions: read_email() x {0} ({1:.0f} ms handshake, {2:.0f} ms/command)".format(iterations, handshakeLatency * 1000, latency * 1000), [
+        ("connect + LOGIN per call (ms/call)", "{0:.2f}".format(freshMs)),
+        ("IMAPSessionPool (ms/call)", "{0:.2f}".format(pooledMs)),
+        ("logins (per call / pooled)", "{0} / {1}".format(freshLogins, pooledLogins)),
+        ("speed-up", "{0:.1f}x".format(freshMs / pooledMs)),
+    ])
+
+def pgp_message(sender, subject, size=3000, armored=None):
+    '''
+    A PGP/MIME message shaped like the ones smtp.send_email() sends, with the
+    kind of relay and signature headers a real mailbox adds. The encrypted
+    part is filler of about size bytes unless armored is given.
+    '''
+    armored = armored or "-----BEGIN PGP MESSAGE-----\r\n\r\n" + "\r\n".join(["A" * 64] * (size // 66)) + "\r\n-----END PGP MESSAGE-----\r\n"
+    relays = "".join(["Received: from relay{0}.example.com (relay{0}.example.com [10.0.0.{0}]) by mx.example.com with ESMTPS id {1}; Mon, 1 Jan 2024 00:00:00 +0000\r\n".format(n, "x" * 24) for n in range(4)])
+    return (relays +
+        "DKIM-Signature: v=1; a=rsa-sha256; d=example.com; s=mail; b={0}\r\n".format("B" * 344) +
+        "From: {0}\r\nTo: alice@example.com\r\nSubject: {1}\r\nDate: Mon, 1 Jan 2024 00:00:00 +0000\r\n".format(sender, subject) +
+        "MIME-Version: 1.0\r\nContent-Type: multipart/encrypted; protocol=\"application/pgp-encrypted\"; boundary=\"b\"\r\n\r\n"
+        "--b\r\nContent-Type: application/pgp-encrypted\r\nContent-Description: PGP/MIME version identification\r\n\r\nVersion: 1\r\n\r\n"
+        "--b\r\nContent-Type: application/octet-stream\r\nContent-Description: OpenPGP encrypted message\r\nContent-Disposition: inline\r\n\r\n" +
+        armored + "\r\n--b--\r\n").encode()
+
+def bench_imap_fetch(counts=(10, 100, 300), latency=0.002):
+    '''
+    Time to download every reply in a mailbox with one FETCH (RFC822) per
+    message (the pre-batching code path), versus batched UID FETCH of whole
+    messages, versus BODYSTRUCTURE then BODY.PEEK of the encrypted part.
+    '''
+    import imaplib
+    from imap import fetch_encrypted
+    subject, sender = "Consensus", "bob@example.com"
+    rows = []
+
+    for count in counts:
+        with StandInIMAP(latency) as server:
+            server.messages = [pgp_message(sender, subject) for _ in range(count)]
+            imap_server = imaplib.IMAP4("127.0.0.1", server.port)
+            imap_server.login("alice@example.com", "secret")
+            imap_server.select('Inbox')
+            criteria = '(FROM "{}" SUBJECT "{}")'.format(sender, subject)
+
+            def per_message():
+                _, data = imap_server.search(None, criteria)
+                return [imap_server.fetch(num, '(RFC822)') for num in data[0].split()]
+
+            def batched(useBodyStructure):
+                _, data = imap_server.uid('SEARCH', None, criteria)
+                return list(fetch_encrypted(imap_server, data[0].split(), useBodyStructure))
+
+            results = []
+            for label, run in [("FETCH per message", per_message),
+                               ("batched RFC822", lambda: batched(False)),
+                               ("BODYSTRUCTURE + BODY.PEEK", lambda: batched(True))]:
+                server.reset_counters()
+                ms = timed(run, 1)
+                results.append("{0:.0f} ms, {1} cmds, {2:.0f} KB".format(ms, server.commands, server.bytesSent / 1024))
+            imap_server.logout()
+        rows.append(("{0} replies: per message".format(count), results[0]))
+        rows.append(("{0} replies: batched RFC822".format(count), results[1]))
+        rows.append(("{0} replies: BODYSTRUCTURE + BODY.PEEK".format(count), results[2]))
+
+    report("IMAP fetch: every reply in the Inbox ({0:.0f} ms/command)".format(latency * 1000), rows)
+
+def bench_inbox_sync(mailboxSize=300, polls=20, latency=0.002):
+    '''
+    Cost of polling a busy mailbox for new votes by re-searching and
+    re-fetching every match (the read_email code path), versus InboxSync,
+    when one new reply arrives every other poll.
+    '''
+    from imap import CheckpointStore, IMAPSessionPool, InboxSync, fetch_encrypted
+    subject, sender = "Consensus", "bob@example.com"
+    criteria = '(FROM "{}" SUBJECT "{}")'.format(sender, subject)
+    rows = []
+
+    for condstore in (False, True):
+        with StandInIMAP(latency, condstore=condstore) as server:
+            server.messages = [pgp_message(sender, subject) for _ in range(mailboxSize)]
+            pool = IMAPSessionPool("127.0.0.1", server.port, ssl=False)
+            sync = InboxSync("alice@example.com", "secret", criteria, store=CheckpointStore(None), pool=pool)
+            list(sync.poll())
+
+            def full():
+                with pool.session("alice@example.com", "secret") as imap_server:
+                    imap_server.select('Inbox')
+                    _, data = imap_server.uid('SEARCH', None, criteria)
+                    return list(fetch_encrypted(imap_server, data[0].split()))
+
+            runs = [("InboxSync" + (" + CONDSTORE" if condstore else ""), lambda: list(sync.poll()))]
+            if not condstore:
+                runs.insert(0, ("full search + fetch", full))
+            for label, run in runs:
+                server.reset_counters()
+                start = time.perf_counter()
+                for poll in range(polls):
+                    if poll % 2 == 0:
+                        server.messages.append(pgp_message(sender, subject))
+                    run()
+                ms = (time.perf_counter() - start) * 1000 / polls
+                rows.append((label + " (per poll)", "{0:.1f} ms, {1:.1f} cmds, {2:.1f} KB".format(ms, server.commands / polls, server.bytesSent / 1024 / polls)))
+            pool.close()
+
+    report("Inbox sync: {0} replies, {1} polls, a new reply every other poll".format(mailboxSize, polls), rows)
+
+def bench_response_listener(deliveries=5, pollInterval=2.0, latency=0.002):
+    '''
+    Delay between a reply reaching the Inbox and its Response being queued
+    by a ResponseListener, using IMAP IDLE versus NOOP polling.
+    '''
+    import queue
+    from imap import CheckpointStore, IMAPSessionPool, ResponseListener
+    from message import responseFormat
+    subject, sender = "Consensus", "bob@example.com"
+
+    class PlainText:
+        # Replies in this benchmark aren't really encrypted
+        def decrypt(self, payload):
+            return payload
+
+    rows = []
+    for label, idle in [("IDLE", True), ("NOOP every {0:.0f} s".format(pollInterval), False)]:
+        with StandInIMAP(latency, idle=idle) as server:
+            pool = IMAPSessionPool("127.0.0.1", server.port, ssl=False)
+            listener = ResponseListener("alice@example.com", "secret", '(FROM "{}" SUBJECT "{}")'.format(sender, subject),
+                                        store=CheckpointStore(None), pool=pool, gpg=PlainText(), pollInterval=pollInterval).start()
+            time.sleep(0.5)
+            delays = []
+            for n in range(deliveries):
+                reply = responseFormat.format(new_message_id(), "approve", "disapprove").replace(" OR I disapprove", "")
+                start = time.perf_counter()
+                server.deliver(pgp_message(sender, subject, armored=reply))
+                try:
+                    listener.queue.get(timeout=pollInterval * 3)
+                    delays.append((time.perf_counter() - start) * 1000)
+                except queue.Empty:
+                    pass
+                time.sleep(pollInterval / (deliveries + 1))
+            listener.stop()
+            pool.close()
+        rows.append((label + " (mean / max ms, {0} of {1} seen)".format(len(delays), deliveries),
+                     "{0:.1f} / {1:.1f}".format(sum(delays) / max(len(delays), 1), max(delays + [0]))))
+
+    report("Response listener: reply arrival to queued vote ({0:.0f} ms/command)".format(latency * 1000), rows)
+
+def temporary_keyring(addresses, keyLength=2048, curve25519=False):
+    '''
+    A GnuPG keyring in a new temporary directory, with an unprotected key
+    for each address: RSA of keyLength bits, or Curve25519 (much quicker to
+    generate in bulk). Return (gpg, directory).
+    '''
+    import gnupg, tempfile
+    directory = tempfile.mkdtemp()
+    gpg = gnupg.GPG(gnupghome=directory)
+    for address in addresses:
+        if curve25519:
+            gpg.gen_key(gpg.gen_key_input(name_email=address, key_type="EDDSA", key_curve="ed25519", subkey_type="ECDH", subkey_curve="cv25519", no_protection=True))
+        else:
+            gpg.gen_key(gpg.gen_key_input(name_email=address, key_type="RSA", key_length=keyLength, no_protection=True))
+    # Trust every key, as a user would after checking them, so encrypting to them works
+    gpg.trust_keys([key["fingerprint"] for key in gpg.list_keys()], "TRUST_ULTIMATE")
+    return gpg, directory
+
+def bench_decryption(count=100, workerCounts=(1, 2, 4, 8)):
+    '''
+    Time to decrypt a proposal's worth of replies one after another (the
+    read_email code path) versus with a DecryptionPool.
+    '''
+    import email, shutil
+    from imap import DecryptionPool, ReceivedEmail
+    from message import responseFormat
+    gpg, directory = temporary_keyring(["alice@example.com"])
+    header = email.message_from_string("From: bob@example.com\nSubject: Consensus\n\n")
+    body = responseFormat.format(MESSAGE_ID, "approve", "disapprove")
+    payloads = [str(gpg.encrypt(body, "alice@example.com", always_trust=True)) for _ in range(count)]
+    replies = lambda: [ReceivedEmail(str(uid), header, payload, gpg) for uid, payload in enumerate(payloads)]
+
+    start = time.perf_counter()
+    serial = [reply.plaintext for reply in replies()]
+    serialMs = (time.perf_counter() - start) * 1000
+    rows = [("serial (ms total)", "{0:.0f}".format(serialMs))]
+    for workers in workerCounts:
+        pool = DecryptionPool(workers)
+        start = time.perf_counter()
+        decrypted = list(pool.decrypt_all(replies()))
+        ms = (time.perf_counter() - start) * 1000
+        pool.close()
+        assert [reply.plaintext for reply in decrypted] == serial
+        perMessage = sorted([reply.decryptSeconds * 1000 for reply in decrypted])
+        rows.append(("DecryptionPool, {0} workers (ms total)".format(workers),
+                     "{0:.0f} ({1:.1f}x), median {2:.1f} ms/message".format(ms, serialMs / ms, perMessage[len(perMessage) // 2])))
+    shutil.rmtree(directory, ignore_errors=True)
+
+    report("Decryption: {0} replies, {1} CPU cores".format(count, os.cpu_count()), rows)
+
+class CollectingSMTP:
+    '''
+    Stands in for a logged-in smtplib.SMTP, keeping what would have been sent.
+    '''
+    def __init__(self):
+        self.sent = []
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.sent.append((from_addr, to_addrs, msg))
+
+def bench_keyring(messages=50, recipients=5):
+    '''
+    Per-message cost of send_email() building a new GPG and re-exporting the
+    sender's key for every message (the pre-KeyringService code path) versus
+    sharing one KeyringService.
+    '''
+    import gnupg, shutil
+    from keyservice import KeyringService
+    from smtp import send_email
+    sender = "alice@example.com"
+    addresses = ["voter{0}@example.com".format(n) for n in range(recipients)]
+    gpg, directory = temporary_keyring([sender] + addresses, keyLength=1024)
+
+    def fresh(recipient):
+        # What send_email did for its keys before: a new context and an export per message
+        context = gnupg.GPG(gnupghome=directory)
+        publicKey = context.export_keys(sender)
+        return str(context.encrypt("I approve", recipient, sign=publicKey))
+
+    keyring = KeyringService(directory)
+    server = CollectingSMTP()
+    shared = lambda recipient: send_email(sender, server, recipient, "Consensus", "I approve", keyring=keyring)
+
+    rows = []
+    for label, send in [("new GPG + export per message", fresh), ("shared KeyringService", shared)]:
+        start = time.perf_counter()
+        for n in range(messages):
+            send(addresses[n % recipients])
+        rows.append((label + " (ms/message)", "{0:.1f}".format((time.perf_counter() - start) * 1000 / messages)))
+    shutil.rmtree(directory, ignore_errors=True)
+
+    report("Keyring: {0} messages to {1} recipients".format(messages, recipients), rows)
+
+def bench_smtp_sender(recipients=50, latency=0.002, handshakeLatency=0.05):
+    '''
+    Time to send a request to every recipient by logging in for each one
+    (the pre-SMTPSender code path) versus fanning out over one SMTPSender
+    session, with the session dropped by the server every 20 messages.
+    '''
+    import shutil, smtplib
+    from keyservice import KeyringService
+    from smtp import SMTPSender, send_email
+    sender = "alice@example.com"
+    addresses = ["voter{0}@example.com".format(n) for n in range(5)]
+    gpg, directory = temporary_keyring([sender] + addresses, keyLength=1024)
+    keyring = KeyringService(directory)
+    voters = [addresses[n % len(addresses)] for n in range(recipients)]
+    rows = []
+
+    with StandInSMTP(latency, handshakeLatency, dropAfter=20) as server:
+        def per_send():
+            for voter in voters:
+                connection = smtplib.SMTP("127.0.0.1", server.port)
+                connection.ehlo()
+                connection.login(sender, "secret")
+                send_email(sender, connection, voter, "Consensus", "Please vote", keyring=keyring)
+                # The old code never quit; do so here so the benchmark doesn't leak sockets
+                connection.quit()
+
+        def fan_out():
+            smtpSender = SMTPSender(sender, "secret", "127.0.0.1", server.port, starttls=False, keyring=keyring)
+            assert smtpSender.send(voters, "Consensus", "Please vote") == {}
+            smtpSender.close()
+
+        for label, run in [("login per send", per_send), ("SMTPSender fan-out", fan_out)]:
+            server.reset_counters()
+            del server.messages[:]
+            start = time.perf_counter()
+            run()
+            ms = (time.perf_counter() - start) * 1000
+            assert len(server.messages) == recipients
+            rows.append((label + " (ms total, logins)", "{0:.0f}, {1}".format(ms, server.logins)))
+    shutil.rmtree(directory, ignore_errors=True)
+
+    report("SMTP: one request to {0} recipients ({1:.0f} ms handshake, {2:.0f} ms/command)".format(recipients, handshakeLatency * 1000, latency * 1000), rows)
+
+def bench_broadcast(sizes=(10, 100, 500)):
+    '''
+    Time to sign, encrypt and send one request to every recipient with a
+    message per recipient versus one broadcast message encrypted to all.
+    '''
+    import shutil
+    from keyservice import KeyringService
+    from smtp import SMTPSender
+    sender = "alice@example.com"
+    voters = ["voter{0}@example.com".format(n) for n in range(max(sizes))]
+    gpg, directory = temporary_keyring([sender] + voters, curve25519=True)
+    keyring = KeyringService(directory)
+    rows = []
+
+    with StandInSMTP() as server:
+        smtpSender = SMTPSender(sender, "secret", "127.0.0.1", server.port, starttls=False, keyring=keyring)
+        smtpSender.connect()
+        for size in sizes:
+            results = []
+            for broadcast in (False, True):
+                del server.messages[:]
+                start = time.perf_counter()
+                assert smtpSender.send(voters[:size], "Consensus", "Please vote on the attached proposal.", broadcast=broadcast) == {}
+                ms = (time.perf_counter() - start) * 1000
+                results.append((ms, len(server.messages), sum([len(data) for _, _, data in server.messages]) / 1024))
+            rows.append(("{0} recipients: per recipient".format(size), "{0:.0f} ms, {1} messages, {2:.0f} KB".format(*results[0])))
+            rows.append(("{0} recipients: broadcast".format(size), "{0:.0f} ms, {1} messages, {2:.0f} KB ({3:.1f}x)".format(*(results[1] + (results[0][0] / results[1][0],)))))
+        smtpSender.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    report("Broadcast: one request, Curve25519 keys", rows)
+
+def bench_outbox(messages=60, accounts=4, latency=0.002, handshakeLatency=0.05):
+    '''
+    Time the interface is blocked sending emails inline versus handing them
+    to the Outbox, and how long the outbox takes to deliver them all with one
+    and with several workers, while the server defers every 10th message.
+    '''
+    import shutil, tempfile
+    from keyservice import KeyringService
+    from outbox import Outbox
+    from smtp import SMTPSender
+    senders = ["sender{0}@example.com".format(n) for n in range(accounts)]
+    gpg, directory = temporary_keyring(senders + ["voter@example.com"], keyLength=1024)
+    keyring = KeyringService(directory)
+    jobs = [(senders[n % accounts], "Consensus {0}".format(n)) for n in range(messages)]
+    rows = []
+
+    with StandInSMTP(latency, handshakeLatency, deferEvery=10) as server:
+        def sender_for(email_address, password):
+            return SMTPSender(email_address, password, "127.0.0.1", server.port, starttls=False, keyring=keyring)
+
+        smtpSenders = {}
+        del server.messages[:]
+        failed = 0
+        start = time.perf_counter()
+        for address, subject in jobs:
+            smtpSender = smtpSenders.setdefault(address, sender_for(address, "secret"))
+            failed += len(smtpSender.send(["voter@example.com"], subject, "Please vote"))
+        ms = (time.perf_counter() - start) * 1000
+        for smtpSender in smtpSenders.values():
+            smtpSender.close()
+        rows.append(("inline (ms blocked, sent, lost)", "{0:.0f}, {1}, {2}".format(ms, len(server.messages), failed)))
+
+        for workers in (1, accounts):
+            spool = tempfile.mkdtemp()
+            senderCache = {}
+            outbox = Outbox(spool, workers, lambda email_address, password: senderCache.setdefault(email_address, sender_for(email_address, password)), backoff=0.05, rates={})
+            outbox.start()
+            for address in senders:
+                outbox.register_account(address, "secret")
+            del server.messages[:]
+            start = time.perf_counter()
+            for address, subject in jobs:
+                outbox.enqueue(address, ["voter@example.com"], subject, "Please vote")
+            blocked = (time.perf_counter() - start) * 1000
+            while outbox.delivered < messages:
+                time.sleep(0.005)
+            ms = (time.perf_counter() - start) * 1000
+            outbox.stop()
+            for smtpSender in senderCache.values():
+                smtpSender.close()
+            assert len(server.messages) == messages and outbox.deadLetters.empty()
+            rows.append(("outbox, {0} worker(s) (ms blocked, delivered)".format(workers), "{0:.1f}, {1:.0f}".format(blocked, ms)))
+            shutil.rmtree(spool, ignore_errors=True)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    report("Outbox: {0} emails from {1} accounts, every 10th deferred with a 451".format(messages, accounts), rows)
+
+def consensus_logs(proposals, votersPerProposal, eventsPerBlock=20):
+    '''
+    Synthetic eth_getLogs entries for proposals that are created, have every
+    voter registered and voting, and reach consensus, eventsPerBlock to a block.
+    '''
+    from eth_abi import encode_abi
+    from indexer import EVENTS, EVENT_TOPICS
+    topics = {name: topic for topic, name in EVENT_TOPICS.items()}
+    events = []
+    for n in range(proposals):
+        messageID = n.to_bytes(32, "big")
+        voters = ["0x" + (n * votersPerProposal + v + 1).to_bytes(20, "big").hex() for v in range(votersPerProposal)]
+        events.append(("ProposalCreated", [messageID, "0x" + "11" * 20, messageID, 10 ** 9, 50, b"\x02" * 32, "Mon Jan 1 00:00:00 2024"]))
+        events += [("VoterRegistered", [messageID, voter]) for voter in voters]
+        events += [("VoteCast", [messageID, voter, v % 2 == 0]) for v, voter in enumerate(voters)]
+        events.append(("ConsensusReached", [messageID, True, votersPerProposal, (votersPerProposal + 1) // 2]))
+    logs = []
+    for i, (name, values) in enumerate(events):
+        indexed, data = EVENTS[name]
+        blockNumber = 1 + i // eventsPerBlock
+        logs.append({
+            "address": CONTRACT_ADDRESS, "removed": False, "blockNumber": hex(blockNumber), "logIndex": hex(i % eventsPerBlock),
+            "blockHash": "0x" + blockNumber.to_bytes(32, "big").hex(), "transactionHash": "0x" + i.to_bytes(32, "big").hex(), "transactionIndex": "0x0",
+            "topics": [topics[name]] + ["0x" + encode_abi([type], [value]).hex() for (_, type), value in zip(indexed, values)],
+            "data": "0x" + encode_abi([type for _, type in data], values[len(indexed):]).hex(),
+        })
+    return logs
+
+def serve_logs(node, logs, limit=None):
+    '''
+    Make a StandInNode answer eth_blockNumber, eth_getBlockByNumber and
+    eth_getLogs from these logs. Like hosted RPC providers, it refuses an
+    eth_getLogs matching more than limit logs.
+    '''
+    import bisect
+    blocks = [int(log["blockNumber"], 16) for log in logs]
+    def get_logs(params):
+        start, end = int(params[0]["fromBlock"], 16), int(params[0]["toBlock"], 16)
+        matched = logs[bisect.bisect_left(blocks, start):bisect.bisect_right(blocks, end)]
+        if limit != None and len(matched) > limit:
+            raise NodeError(-32005, "query returned more than {0} results".format(limit))
+        return matched
+    node.methods["eth_blockNumber"] = lambda params: hex(blocks[-1])
+    node.methods["eth_getBlockByNumber"] = lambda params: {"number": params[0], "hash": "0x" + int(params[0], 16).to_bytes(32, "big").hex()}
+    node.methods["eth_getLogs"] = get_logs
+
+def bench_indexer(proposals=500, votersPerProposal=10, iterations=200, latency=0.01):
+    '''
+    How fast EventIndexer builds its SQLite projection from the contract's
+    events, and the latency of a proposal status query answered from it
+    versus an eth_call to the node.
+    '''
+    from chain import ConsensusClient
+    from indexer import EventIndexer, ProposalStore
+    logs = consensus_logs(proposals, votersPerProposal)
+    messageIDs = ["0x" + n.to_bytes(32, "big").hex() for n in range(proposals)]
+
+    with StandInNode(latency) as node:
+        serve_logs(node, logs)
+        client = ConsensusClient.for_url(node.url)
+        indexer = EventIndexer(client, CONTRACT_ADDRESS, ProposalStore(":memory:"), startBlock=1)
+        start = time.perf_counter()
+        count = indexer.sync()
+        seconds = time.perf_counter() - start
+        assert count == len(logs) and indexer.store.statuses(indexer.contract_address, messageIDs[-1:])[0]["isCompiled"]
+
+        contract = client.contract(CONTRACT_ADDRESS, load_abi())
+        rpcMs = timed(lambda: contract.functions.getIsCompiled(MESSAGE_ID).call(), iterations)
+        localMs = timed(lambda: indexer.store.statuses(indexer.contract_address, [messageIDs[proposals // 2]]), iterations)
+        bundleMs = timed(lambda: indexer.store.bundle(indexer.contract_address, messageIDs[proposals // 2]), iterations)
+        ConsensusClient.close_all()
+
+    report("Event indexer: {0} proposals, {1} events ({2:.0f} ms per RPC round-trip)".format(proposals, len(logs), latency * 1000), [
+        ("initial sync (s, events/s)", "{0:.2f}, {1:.0f}".format(seconds, len(logs) / seconds)),
+        ("status via eth_call (us per query)", "{0:.0f}".format(rpcMs * 1000)),
+        ("status from ProposalStore (us per query)", "{0:.0f}".format(localMs * 1000)),
+        ("bundle from ProposalStore (us per query)", "{0:.0f}".format(bundleMs * 1000)),
+    ])
+
+def bench_backfill(proposals=1000, votersPerProposal=10, limit=100, latency=0.02, eventsPerBlock=1):
+    '''
+    Logs per second EventIndexer backfills from a node that, like hosted RPC
+    providers, refuses eth_getLogs ranges matching more than limit logs,
+    with one range in flight at a time versus several. The events are spread
+    over enough blocks, and limit is small enough, that the backfill takes
+    hundreds of ranges, as it does against a real provider.
+    '''
+    from chain import ConsensusClient
+    from indexer import EventIndexer, ProposalStore, LOG_BATCH_SIZE
+    logs = consensus_logs(proposals, votersPerProposal, eventsPerBlock)
+    rows = []
+
+    with StandInNode(latency) as node:
+        serve_logs(node, logs, limit)
+        client = ConsensusClient.for_url(node.url)
+        serial = None
+        for workers in (1, 4, 8):
+            indexer = EventIndexer(client, CONTRACT_ADDRESS, ProposalStore(":memory:"), startBlock=1, workers=workers)
+            node.reset_counters()
+            start = time.perf_counter()
+            count = indexer.sync()
+            seconds = time.perf_counter() - start
+            assert count == len(logs)
+            serial = seconds if serial == None else serial
+            rows.append(("{0} worker(s) (logs/s, s, RPC calls, speedup)".format(workers), "{0:.0f}, {1:.2f}, {2}, {3:.1f}x".format(
+                count / seconds, seconds, node.calls, serial / seconds)))
+        rows.append(("batch size settled at (blocks)", "{0} (from {1})".format(indexer.batchSize, LOG_BATCH_SIZE)))
+        ConsensusClient.close_all()
+
+    report("Backfill: {0} logs ({1} votes) over {2} blocks, max {3} logs per eth_getLogs, {4:.0f} ms per round-trip".format(
+        len(logs), proposals * votersPerProposal, int(logs[-1]["blockNumber"], 16), limit, latency * 1000), rows)
+
+def bench_vote_gas(voters=20):
+    '''
+    Calldata size and gas of a vote cast with the legacy Vote(string, bytes32)
+    versus VoteV2(bytes32, uint8). Calldata is worked out from the ABI
+    encoding; execution gas is measured on a DevChain, when one is available.
+    '''
+    from eth_abi import encode_abi
+    from eth_utils import keccak
+    messageID = bytes.fromhex(MESSAGE_ID)
+    calldata = {
+        "Vote(\"i disapprove\")": keccak(text="Vote(string,bytes32)")[:4] + encode_abi(["string", "bytes32"], ["i disapprove", messageID]),
+        "VoteV2(Disapprove)": keccak(text="VoteV2(bytes32,uint8)")[:4] + encode_abi(["bytes32", "uint8"], [messageID, 0]),
+    }
+    rows = []
+    for label, data in calldata.items():
+        # 4 gas per zero byte and 16 per non-zero byte of calldata (EIP-2028)
+        rows.append((label + " (calldata bytes, gas)", "{0}, {1}".format(len(data), sum([16 if byte else 4 for byte in data]))))
+
+    try:
+        chain = DevChain()
+    except ImportError as e:
+        rows.append(("execution gas", "skipped: DevChain needs {0}".format(e.name)))
+        report("Vote calldata and gas", rows)
+        return
+    from chain import ConsensusClient
+    import deploy
+    with chain:
+        address, abi = chain.deploy()
+        initiator = chain.funded_account()
+        accounts = [chain.funded_account() for _ in range(2 * voters)]
+        client = ConsensusClient.for_url(chain.url)
+        contract = client.contract(address, abi)
+        messageID = new_message_id()
+        deploy.create_contract_with_voters(abi, chain.url, messageID, 3600, 50, address, "Subject", "Body", "date", "key", [account.address for account in accounts])
+        legacy = [client.transact(contract.functions.Vote("i approve" if n % 2 else "i disapprove", messageID), account.address, account.key)["gasUsed"]
+                  for n, account in enumerate(accounts[:voters])]
+        choice = [deploy.vote(address, abi, chain.url, account.address, account.key, "i approve" if n % 2 else "i disapprove", messageID)["gasUsed"]
+                  for n, account in enumerate(accounts[voters:])]
+        ConsensusClient.close_all()
+    rows.append(("Vote (mean gas used per vote)", "{0:.0f}".format(sum(legacy) / voters)))
+    rows.append(("VoteV2 (mean gas used per vote)", "{0:.0f}".format(sum(choice) / voters)))
+    report("Vote calldata and gas", rows)
+
+def bench_contract_gas(voters=(1, 10, 50)):
+    '''
+    Gas used to create a proposal, register its voters, vote and reach
+    consensus on BusinessConsensus (parallel mappings) versus
+    BusinessConsensusV2 (one packed Proposal struct), on a DevChain.
+    '''
+    try:
+        chain = DevChain()
+    except ImportError as e:
+        report("Contract gas: BusinessConsensus -> BusinessConsensusV2", [("all", "skipped: DevChain needs {0}".format(e.name))])
+        return
+    from chain import ConsensusClient
+    rows = []
+    with chain:
+        client = ConsensusClient.for_url(chain.url)
+        initiator = chain.funded_account()
+        accounts = [chain.funded_account() for _ in range(max(voters))]
+        contracts = []
+        for name in ("BusinessConsensus", "BusinessConsensusV2"):
+            address, abi = chain.deploy(name)
+            contracts.append((name, client.contract(address, abi)))
+
+        for size in voters:
+            gas = {}
+            for name, contract in contracts:
+                transact = lambda function, account: client.transact(function, account.address, account.key)["gasUsed"]
+                messageID = new_message_id()
+                create = transact(contract.functions.createContract(messageID, 60, 50, messageID, "Mon Jan 1 00:00:00 2024 +0000 +1m", messageID), initiator)
+                register = transact(contract.functions.RegisterVoters([account.address for account in accounts[:size]], messageID), initiator)
+                votes = [transact(contract.functions.VoteV2(messageID, n % 2), account) for n, account in enumerate(accounts[:size])]
+                chain.time_travel(120)
+                consensus = transact(contract.functions.Consensus(messageID), initiator)
+                gas[name] = (create, register, sum(votes) // size, consensus)
+            for i, step in enumerate(["create", "register {0} voters".format(size), "vote (mean)", "consensus"]):
+                before, after = gas["BusinessConsensus"][i], gas["BusinessConsensusV2"][i]
+                rows.append(("{0} voters: {1}".format(size, step), "{0} -> {1} ({2:+.0f}%)".format(before, after, (after - before) * 100 / before)))
+        ConsensusClient.close_all()
+
+    report("Contract gas: BusinessConsensus -> BusinessConsensusV2", rows)
+
+def bench_consensus_gas(boards=(10, 100, 300), turnout=0.5):
+    '''
+    Gas used by Consensus on boards of different sizes, with turnout of the
+    voters voting, and the time deploy.getBundle takes to assemble the bundle
+    with its absent voters, on a DevChain. Consensus should cost the same
+    whatever the board size, including past the old 255-voter limit.
+    '''
+    try:
+        chain = DevChain()
+    except ImportError as e:
+        report("Consensus gas by board size", [("all", "skipped: DevChain needs {0}".format(e.name))])
+        return
+    from chain import ConsensusClient
+    import deploy
+    rows = []
+    with chain:
+        client = ConsensusClient.for_url(chain.url)
+        initiator = chain.funded_account()
+        accounts = [chain.funded_account() for _ in range(max(boards))]
+        for name in ("BusinessConsensus", "BusinessConsensusV2"):
+            address, abi = chain.deploy(name)
+            contract = client.contract(address, abi)
+            for size in boards:
+                messageID = new_message_id()
+                client.transact(contract.functions.createContract(messageID, 60, 50, messageID, "Mon Jan 1 00:00:00 2024 +0000 +1m", messageID), initiator.address, initiator.key)
+                deploy.register_voters(address, abi, chain.url, [account.address for account in accounts[:size]], initiator.address, initiator.key, messageID)
+                for account in accounts[:int(size * turnout)]:
+                    client.transact(contract.functions.VoteV2(messageID, 1), account.address, account.key)
+                chain.time_travel(120)
+                gas = client.transact(contract.functions.Consensus(messageID), initiator.address, initiator.key)["gasUsed"]
+                start = time.perf_counter()
+                bundle = deploy.getBundle(abi, chain.url, address, initiator.key, initiator.address, messageID)
+                ms = (time.perf_counter() - start) * 1000
+                assert "Accepted" in bundle
+                rows.append(("{0}, {1} voters (Consensus gas, getBundle ms)".format(name, size), "{0}, {1:.0f}".format(gas, ms)))
+        ConsensusClient.close_all()
+
+    report("Consensus gas by board size ({0:.0f}% turnout)".format(turnout * 100), rows)
+
+BENCHMARKS = {
+    "connection_pool": bench_connection_pool,
+    "bulk_registration": bench_bulk_registration,
+    "batch_reads": bench_batch_reads,
+    "parser": bench_parser,
+    "imap_sessions": bench_imap_sessions,
+    "imap_fetch": bench_imap_fetch,
+    "inbox_sync": bench_inbox_sync,
+    "response_listener": bench_response_listener,
+    "decryption": bench_decryption,
+    "keyring": bench_keyring,
+    "smtp_sender": bench_smtp_sender,
+    "broadcast": bench_broadcast,
+    "outbox": bench_outbox,
+    "indexer": bench_indexer,
+    "backfill": bench_backfill,
+    "vote_gas": bench_vote_gas,
+    "contract_gas": bench_contract_gas,
+    "consensus_gas": bench_consensus_gas,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
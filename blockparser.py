@@ -0,0 +1,206 @@
+#! python3
+# blockparser.py
+# Finds and parses the "# ---------- START BLOCKCHAIN ... ---------- #" blocks in email bodies.
+#
+# Every pattern here is compiled once at import and none of them nest lazy
+# wildcards, so finding and parsing a block is linear in the size of the email.
+
+import re
+
+# ---------- Global values ---------- #
+BLOCK_KINDS = ["REQUEST", "RESPONSE", "BUNDLE"]
+
+# A START or END frame line. Emails can wrap lines ANYWHERE, so any whitespace
+# (including newlines, and the ">" quoting of a wrapped line in a reply) is
+# allowed between the frame's words.
+FRAME_PATTERN = r"#[\s>]*-{10,}[\s>]*(START|END)[\s>]+BLOCKCHAIN[\s>]+(REQUEST|RESPONSE|BUNDLE)[\s>]*-{10,}[\s>]*#"
+FRAME_REGEX = re.compile(FRAME_PATTERN)
+FRAME_BYTES_REGEX = re.compile(FRAME_PATTERN.encode())
+# The ">" quoting at the start of each line of a quoted reply
+QUOTE_REGEX = re.compile(r"^[ \t]*(?:>[ \t]?)+", re.M)
+
+# "# KEY: value" at the start of a field, e.g. "# MESSAGE ID: ..."
+FIELD_REGEX = re.compile(r"#\s*([A-Z]+(?:\s+[A-Z]+)*):[ \t]*")
+WHITESPACE_REGEX = re.compile(r"[ \n]+")
+MESSAGE_ID_REGEX = re.compile(r"(\w{64})\s*$")
+RESPONSE_REGEX = re.compile(r"I\s+[A-Za-z]+")
+EXPECTED_RESPONSES_REGEX = re.compile(r"\"(I\s+[A-Za-z]+)\"\s+if\s+YES,\s+or\s+\"(I\s+[A-Za-z]+)\"\s+if\s+NO")
+
+REQUEST_FIELDS = ["MESSAGE DATE", "EXPIRY DATE", "MESSAGE ID", "MESSAGE CONTENTS", "ACTION REQUESTED"]
+RESPONSE_FIELDS = ["MESSAGE ID", "MESSAGE RESPONSE"]
+BUNDLE_FIELDS = ["REQUEST ID", "REQUEST CONTENTS", "ACTION REQUESTED", "RECIPIENTS", "RESPONSES", "VERDICT"]
+
+# ---------- Block framing ---------- #
+class Block:
+    '''
+    One framed block found by scan_blocks().
+
+    Attributes:
+        kind -- One of BLOCK_KINDS.
+        start -- Offset of the "#" opening the START frame in the scanned email.
+        end -- Offset just past the "#" closing the END frame. Offsets count
+               bytes if the email was scanned as bytes, characters otherwise.
+        quoteDepth -- How many levels of ">" quoting the block was found under.
+        body -- The text between the frames, with quoting and "\r" removed.
+    '''
+    def __init__(self, kind, start, end, quoteDepth, body):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.quoteDepth = quoteDepth
+        self.body = body
+
+    def parse(self):
+        '''
+        Parse the body with the parser for this block's kind. Return a dict
+        of its fields, or None if the block is malformed.
+        '''
+        return BLOCK_PARSERS[self.kind](self.body)
+
+def scan_blocks(email_string):
+    '''
+    Walk an email once and yield a Block for every complete REQUEST, RESPONSE
+    and BUNDLE block in it, including blocks inside quoted replies, in the
+    order they end. A START frame that is never closed is skipped, and a
+    second START of the same kind before an END replaces the first.
+
+    Arguments:
+        email_string -- The contents of an email, as text or as raw bytes.
+    '''
+    isBytes = isinstance(email_string, (bytes, bytearray))
+    frameRegex = FRAME_BYTES_REGEX if isBytes else FRAME_REGEX
+    newline = b"\n" if isBytes else "\n"
+    opened = {}
+    for frame in frameRegex.finditer(email_string):
+        action, kind = frame[1], frame[2]
+        if isBytes:
+            action, kind = action.decode(), kind.decode()
+        if action == "START":
+            opened[kind] = frame
+        elif kind in opened:
+            start = opened.pop(kind)
+            body = email_string[start.end():frame.start()]
+            # Whatever precedes the "#" on the START line is the reply quoting, e.g. "> > "
+            prefix = email_string[email_string.rfind(newline, 0, start.start()) + 1:start.start()]
+            if isBytes:
+                body, prefix = body.decode("utf-8", "replace"), prefix.decode("utf-8", "replace")
+            quoteDepth = prefix.count(">")
+            body = body.replace("\r", "")
+            if quoteDepth > 0:
+                body = QUOTE_REGEX.sub("", body)
+            yield Block(kind, start.start(), frame.end(), quoteDepth, trim_body(body))
+
+def find_block(email_string, kind):
+    '''
+    Return the body of the first complete block of this kind, or None if the
+    email has none.
+
+    Arguments:
+        email_string -- The contents of an email as text, with "\r" removed.
+        kind -- One of BLOCK_KINDS.
+    '''
+    for block in scan_blocks(email_string):
+        if block.kind == kind:
+            return block.body
+    return None
+
+def trim_body(body):
+    '''
+    Drop the newline ending the START line and the one starting the END line.
+    '''
+    if body.startswith("\n"):
+        body = body[1:]
+    if body.endswith("\n"):
+        body = body[:-1]
+    return body
+
+# ---------- Field parsing ---------- #
+def normalise(value):
+    '''
+    Turn every run of spaces and newlines into a single space. Emails wrap
+    long lines, so this undoes the wrapping inside a field's value.
+    '''
+    return WHITESPACE_REGEX.sub(" ", value)
+
+def split_fields(block):
+    '''
+    Split a block body into its "# KEY: value" fields in one pass. A field's
+    value runs until the next line starting with "#". Lines starting with "#"
+    that aren't fields are collected, in order, under the key None.
+
+    Return a dict of {key: value}, with keys' inner whitespace normalised.
+    '''
+    fields = {None: []}
+    for segment in ("\n" + block).split("\n#")[1:]:
+        segment = "#" + segment
+        field = FIELD_REGEX.match(segment)
+        if field == None:
+            fields[None].append(segment)
+            continue
+        key = normalise(field[1])
+        if key not in fields:
+            fields[key] = segment[field.end():]
+    return fields
+
+def parse_request_block(block):
+    '''
+    Parse the body of a REQUEST block.
+
+    Return a dict with the keys date, expiry, id, message, expectedYes and
+    expectedNo (the last two lower case), or None if the block is malformed.
+    '''
+    fields = split_fields(block)
+    if not all([key in fields for key in REQUEST_FIELDS]):
+        return None
+    expected = EXPECTED_RESPONSES_REGEX.search(normalise(" ".join(fields[None])))
+    if expected == None:
+        return None
+    return {
+        "date": normalise(fields["MESSAGE DATE"]),
+        "expiry": normalise(fields["EXPIRY DATE"]),
+        "id": normalise(fields["MESSAGE ID"]),
+        "message": normalise(fields["MESSAGE CONTENTS"]),
+        "expectedYes": normalise(expected[1]).lower(),
+        "expectedNo": normalise(expected[2]).lower(),
+    }
+
+def parse_response_block(block):
+    '''
+    Parse the body of a RESPONSE block.
+
+    Return a dict with the keys id (the 64 character request ID) and response
+    (e.g. "I approve"), or None if the block is malformed.
+    '''
+    fields = split_fields(block)
+    if not all([key in fields for key in RESPONSE_FIELDS]):
+        return None
+    id = MESSAGE_ID_REGEX.search(fields["MESSAGE ID"])
+    response = RESPONSE_REGEX.search(fields["MESSAGE RESPONSE"])
+    if id == None or response == None:
+        return None
+    return {"id": id[1], "response": response[0]}
+
+def parse_bundle_block(block):
+    '''
+    Parse the body of a BUNDLE block.
+
+    Return a dict with the keys id, message, action, recipients, responses
+    and verdict, or None if the block is malformed.
+    '''
+    fields = split_fields(block)
+    if not all([key in fields for key in BUNDLE_FIELDS]):
+        return None
+    return {
+        "id": normalise(fields["REQUEST ID"]),
+        "message": normalise(fields["REQUEST CONTENTS"]),
+        "action": normalise(fields["ACTION REQUESTED"]),
+        "recipients": normalise(fields["RECIPIENTS"]),
+        "responses": normalise(fields["RESPONSES"]),
+        "verdict": normalise(fields["VERDICT"]),
+    }
+
+BLOCK_PARSERS = {
+    "REQUEST": parse_request_block,
+    "RESPONSE": parse_response_block,
+    "BUNDLE": parse_bundle_block,
+}
@@ -0,0 +1,851 @@
+#! python3
+# chain.py
+# Provides a long-lived, pooled connection layer to the BusinessConsensus contract.
+
+import json, statistics, threading, time, unittest
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from hashlib import sha256
+
+import requests
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.method_formatters import receipt_formatter
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.datastructures import AttributeDict
+from web3.exceptions import TimeExhausted
+
+from shared import Registry
+
+# ---------- Global values ---------- #
+REQUEST_TIMEOUT = 600
+POOL_SIZE = 10
+SEND_ATTEMPTS = 3
+RECEIPT_POLL_INTERVAL = 0.5
+RECEIPT_TIMEOUT = 600
+# How long FeeOracle reuses a fee estimate, in seconds
+FEE_TTL = 12
+# eth_feeHistory window, and the priority fee percentile taken from each block
+FEE_HISTORY_BLOCKS = 5
+PRIORITY_FEE_PERCENTILE = 50
+# Used when recent blocks paid no priority fee at all
+DEFAULT_PRIORITY_FEE = 10 ** 9
+
+# JSON-RPC error code, and substrings of node error messages, meaning the node doesn't implement a method
+METHOD_NOT_FOUND = -32601
+METHOD_MISSING_ERRORS = ["does not exist", "method not found", "not supported"]
+# Substrings of node error messages meaning our local nonce is out of step with the chain
+NONCE_ERRORS = ["nonce too low", "nonce too high", "already known", "replacement transaction underpriced"]
+
+# ---------- Unit tests ---------- #
+class TestNonceManager(unittest.TestCase):
+    class FakeEth:
+        def __init__(self, count):
+            self.count = count
+            self.lookups = 0
+
+        def getTransactionCount(self, account_address, block_identifier="latest"):
+            self.lookups += 1
+            return self.count
+
+    class FakeWeb3:
+        def __init__(self, count):
+            self.eth = TestNonceManager.FakeEth(count)
+
+    def test_nonces_are_unique_across_threads(self):
+        # Arrange
+        web3 = self.FakeWeb3(7)
+        nonces = NonceManager(web3)
+        allocated = []
+
+        def allocate():
+            for _ in range(100):
+                allocated.append(nonces.next_nonce("0xabc"))
+
+        # Act
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Assert
+        self.assertEqual(sorted(allocated), list(range(7, 807)))
+        self.assertEqual(web3.eth.lookups, 1)
+
+    def test_resync_refetches_pending_count(self):
+        # Arrange
+        web3 = self.FakeWeb3(3)
+        nonces = NonceManager(web3)
+        nonces.next_nonce("0xabc")
+        nonces.next_nonce("0xabc")
+
+        # Act
+        web3.eth.count = 10
+        nonces.resync("0xabc")
+
+        # Assert
+        self.assertEqual(nonces.next_nonce("0xabc"), 10)
+        self.assertEqual(web3.eth.lookups, 2)
+
+class TestFeeOracle(unittest.TestCase):
+    class FakeEth:
+        def __init__(self, feeHistory):
+            self.feeHistory = feeHistory
+            self.lookups = 0
+
+        def fee_history(self, block_count, newest_block, reward_percentiles):
+            self.lookups += 1
+            if self.feeHistory == None:
+                raise ValueError({"code": -32601, "message": "the method eth_feeHistory does not exist"})
+            if isinstance(self.feeHistory, Exception):
+                raise self.feeHistory
+            return self.feeHistory
+
+        @property
+        def gas_price(self):
+            self.lookups += 1
+            return 5
+
+    class FakeWeb3:
+        def __init__(self, feeHistory):
+            self.eth = TestFeeOracle.FakeEth(feeHistory)
+
+    def test_burst_shares_one_lookup(self):
+        # Arrange
+        web3 = self.FakeWeb3({"baseFeePerGas": [90, 100], "reward": [[2], [4], [3]]})
+        fees = FeeOracle(web3)
+
+        # Act
+        fields = [fees.transaction_fields() for _ in range(10)]
+
+        # Assert
+        self.assertEqual(fields[0], {"maxFeePerGas": 203, "maxPriorityFeePerGas": 3})
+        self.assertEqual(web3.eth.lookups, 1)
+        self.assertEqual((fees.hits, fees.misses), (9, 1))
+
+    def test_falls_back_to_legacy_pricing(self):
+        # Arrange
+        web3 = self.FakeWeb3(None)
+        fees = FeeOracle(web3)
+
+        # Act
+        first = fees.transaction_fields()
+        fees.invalidate()
+        second = fees.transaction_fields()
+
+        # Assert
+        self.assertEqual(first, {"gasPrice": 5})
+        self.assertEqual(second, {"gasPrice": 5})
+        self.assertEqual(web3.eth.lookups, 3) # feeHistory is only tried once
+
+    def test_transient_error_keeps_fee_history(self):
+        # Arrange
+        web3 = self.FakeWeb3(ValueError({"code": -32000, "message": "header not found"}))
+        fees = FeeOracle(web3)
+
+        # Act
+        first = fees.transaction_fields()
+        web3.eth.feeHistory = {"baseFeePerGas": [90, 100], "reward": [[2], [4], [3]]}
+        fees.invalidate()
+        second = fees.transaction_fields()
+
+        # Assert
+        self.assertEqual(first, {"gasPrice": 5})
+        self.assertEqual(second, {"maxFeePerGas": 203, "maxPriorityFeePerGas": 3})
+        self.assertEqual(fees.supportsFeeHistory, True)
+
+class TestAbiHash(unittest.TestCase):
+    def test_string_and_parsed_abi_match(self):
+        # Arrange
+        abi = [{"type": "function", "name": "Vote", "inputs": [], "outputs": [], "stateMutability": "nonpayable"}]
+
+        # Act
+        fromString = abi_hash(json.dumps(abi, indent=2))
+        fromList = abi_hash(abi)
+
+        # Assert
+        self.assertEqual(fromString, fromList)
+
+class TestReceiptTracker(unittest.TestCase):
+    class FakeNonces:
+        def __init__(self):
+            self.resynced = []
+
+        def resync(self, account_address):
+            self.resynced.append(account_address)
+
+    class FakeClient:
+        def __init__(self, receipt=None, error=None):
+            self.receipt = receipt
+            self.error = error
+            self.nonces = TestReceiptTracker.FakeNonces()
+
+        def batch(self, calls):
+            if self.error != None:
+                raise self.error
+            return [self.receipt for _ in calls]
+
+    def receipt(self, status):
+        return {"transactionHash": "0x" + "ab" * 32, "blockHash": "0x" + "cd" * 32, "blockNumber": "0x5",
+                "transactionIndex": "0x0", "from": "0x" + "11" * 20, "to": "0x" + "22" * 20, "contractAddress": None,
+                "cumulativeGasUsed": "0x5208", "gasUsed": "0x5208", "logs": [], "status": status}
+
+    def test_mined_receipt_is_formatted(self):
+        # Arrange
+        tracker = ReceiptTracker(self.FakeClient(self.receipt("0x1")))
+        pendingTransaction = PendingTransaction(HexBytes("0x" + "ab" * 32), "0xabc")
+
+        # Act
+        tracker.poll([pendingTransaction])
+
+        # Assert
+        receipt = pendingTransaction.result(0)
+        self.assertEqual(receipt.status, 1)
+        self.assertEqual(receipt["gasUsed"], 21000)
+        self.assertEqual(receipt["transactionHash"], HexBytes("0x" + "ab" * 32))
+
+    def test_reverted_transaction_fails(self):
+        # Arrange
+        tracker = ReceiptTracker(self.FakeClient(self.receipt("0x0")))
+        pendingTransaction = PendingTransaction(HexBytes("0x" + "ab" * 32), "0xabc")
+
+        # Act
+        tracker.poll([pendingTransaction])
+
+        # Assert
+        self.assertIsInstance(pendingTransaction.exception(0), TransactionReverted)
+
+    def test_unmined_transaction_times_out(self):
+        # Arrange
+        client = self.FakeClient()
+        tracker = ReceiptTracker(client, interval=0.01, timeout=0.05)
+
+        # Act
+        pendingTransaction = tracker.track(HexBytes("0x" + "ab" * 32), "0xabc")
+
+        # Assert
+        self.assertIsInstance(pendingTransaction.exception(2), TimeExhausted)
+        self.assertEqual(client.nonces.resynced, ["0xabc"])
+
+    def test_unreachable_node_times_out(self):
+        # Arrange
+        client = self.FakeClient(error=requests.ConnectionError("connection refused"))
+        tracker = ReceiptTracker(client, interval=0.01, timeout=0.05)
+
+        # Act
+        pendingTransaction = tracker.track(HexBytes("0x" + "ab" * 32), "0xabc")
+
+        # Assert
+        self.assertIsInstance(pendingTransaction.exception(2), TimeExhausted)
+
+class TestBatchReader(unittest.TestCase):
+    ADDRESS = "0x" + "11" * 20
+    ABI = [{"type": "function", "name": "getIsCompiled", "stateMutability": "view",
+            "inputs": [{"name": "_messageID", "type": "bytes32"}], "outputs": [{"name": "", "type": "bool"}]}]
+
+    class FakeResponse:
+        def __init__(self, body):
+            self.body = body
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return self.body
+
+    class FakeSession:
+        # Answers each batch with reply(payload)
+        def __init__(self, reply):
+            self.reply = reply
+
+        def post(self, url, json, timeout):
+            return TestBatchReader.FakeResponse(self.reply(json))
+
+    def client(self, reply):
+        client = ConsensusClient("http://batch-reader.test")
+        client.session = self.FakeSession(reply)
+        return client
+
+    def test_reads_are_decoded_in_order(self):
+        # Arrange
+        results = {"eth_call": "0x" + "00" * 31 + "01", "eth_getTransactionCount": "0x7", "eth_gasPrice": "0x5"}
+        client = self.client(lambda payload: [{"id": call["id"], "result": results[call["method"]]} for call in reversed(payload)])
+        contract = client.contract(self.ADDRESS, self.ABI)
+
+        # Act
+        reader = client.reader()
+        reader.call(contract.functions.getIsCompiled(b"m" * 32))
+        reader.transaction_count("0xabc")
+        reader.gas_price()
+        results = reader.execute()
+
+        # Assert
+        self.assertEqual(results, [True, 7, 5])
+        self.assertEqual(client.nonces.next_nonce("0xabc"), 7)
+
+    def test_failed_reads_are_raised_or_returned(self):
+        # Arrange
+        error = {"code": -32000, "message": "execution reverted"}
+        client = self.client(lambda payload: [{"id": call["id"], "error": error} if call["method"] == "eth_call" else {"id": call["id"], "result": "0x5"} for call in payload])
+        contract = client.contract(self.ADDRESS, self.ABI)
+
+        # Act
+        results = client.reader().call(contract.functions.getIsCompiled(b"m" * 32)).gas_price().execute(raise_errors=False)
+
+        # Assert
+        self.assertIsInstance(results[0], RPCError)
+        self.assertEqual(results[0].error, error)
+        self.assertEqual(results[1], 5)
+        with self.assertRaises(RPCError):
+            client.reader().call(contract.functions.getIsCompiled(b"m" * 32)).execute()
+
+    def test_rejected_batch_raises_rpc_error(self):
+        # Arrange
+        client = self.client(lambda payload: {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "batch requests are not supported"}})
+
+        # Act / Assert
+        with self.assertRaises(RPCError) as raised:
+            client.batch([("eth_blockNumber", []), ("eth_gasPrice", [])])
+        self.assertEqual(raised.exception.error["code"], -32600)
+
+# ---------- Object class definition ---------- #
+class FeeOracle:
+    '''
+    Caches transaction fee estimates for ttl seconds, so a burst of
+    transactions shares one lookup. On nodes that support eth_feeHistory it
+    produces EIP-1559 (type-2) fee fields: the latest base fee doubled, plus
+    the median of recent priority fees at the given percentile. Otherwise it
+    falls back to legacy eth_gasPrice pricing.
+
+    The hits and misses counters record how often the cache was used.
+
+    Arguments:
+        web3 -- The Web3 instance used for fee lookups.
+        ttl -- Seconds an estimate stays fresh.
+        percentile -- Priority fee percentile requested from eth_feeHistory.
+    '''
+    def __init__(self, web3, ttl=FEE_TTL, percentile=PRIORITY_FEE_PERCENTILE):
+        self.web3 = web3
+        self.ttl = ttl
+        self.percentile = percentile
+        self.hits = 0
+        self.misses = 0
+        self.supportsFeeHistory = None # unknown until first tried
+        self._fields = None
+        self._fieldsTime = 0
+        self._lock = threading.Lock()
+
+    def transaction_fields(self):
+        '''
+        Return the fee fields to merge into a transaction: either
+        maxFeePerGas and maxPriorityFeePerGas, or gasPrice.
+        '''
+        with self._lock:
+            if self._fields != None and time.monotonic() - self._fieldsTime <= self.ttl:
+                self.hits += 1
+                return dict(self._fields)
+            self.misses += 1
+            legacy = self.supportsFeeHistory == False
+            if not legacy:
+                try:
+                    history = self.web3.eth.fee_history(FEE_HISTORY_BLOCKS, 'latest', [self.percentile])
+                    self._store_history(history["baseFeePerGas"], history["reward"])
+                    legacy = self.supportsFeeHistory == False
+                except ValueError as e:
+                    # Any other error (e.g. a rate limit) only prices this lookup the legacy way
+                    if is_method_missing(e):
+                        self.supportsFeeHistory = False
+                    legacy = True
+            if legacy:
+                self._store({"gasPrice": self.web3.eth.gas_price})
+            return dict(self._fields)
+
+    def invalidate(self):
+        with self._lock:
+            self._fields = None
+
+    def prime_fee_history(self, baseFees, rewards):
+        '''
+        Store an eth_feeHistory result read elsewhere (e.g. in a BatchReader).
+        '''
+        with self._lock:
+            self._store_history(baseFees, rewards)
+
+    def prime_gas_price(self, gasPrice):
+        '''
+        Store an eth_gasPrice result read elsewhere. Only used on nodes
+        without eth_feeHistory, where it is the price we'd have fetched anyway.
+        '''
+        with self._lock:
+            if self.supportsFeeHistory == False:
+                self._store({"gasPrice": gasPrice})
+
+    def mark_unsupported(self):
+        with self._lock:
+            self.supportsFeeHistory = False
+
+    def _store_history(self, baseFees, rewards):
+        # The last base fee is the one predicted for the next block. Pre-London chains report zero.
+        baseFee = baseFees[-1]
+        if baseFee == 0:
+            self.supportsFeeHistory = False
+            return
+        self.supportsFeeHistory = True
+        priorityFees = [reward[0] for reward in rewards if len(reward) > 0]
+        priorityFee = int(statistics.median(priorityFees)) if len(priorityFees) > 0 else 0
+        if priorityFee == 0:
+            priorityFee = DEFAULT_PRIORITY_FEE
+        self._store({"maxFeePerGas": 2 * baseFee + priorityFee, "maxPriorityFeePerGas": priorityFee})
+
+    def _store(self, fields):
+        self._fields = fields
+        self._fieldsTime = time.monotonic()
+
+class NonceManager:
+    '''
+    Hands out transaction nonces per account without asking the node every
+    time. The pending transaction count is fetched once per account; after
+    that nonces are allocated locally under a lock, so threads (and asyncio
+    tasks, since allocation never awaits) sending from the same account never
+    collide.
+
+    Call resync() whenever the node rejects a nonce or a sent transaction is
+    dropped, and the next allocation will re-read the pending count.
+
+    Arguments:
+        web3 -- The Web3 instance used to read the pending transaction count.
+    '''
+    def __init__(self, web3):
+        self.web3 = web3
+        self._nonces = {}
+        self._lock = threading.Lock()
+
+    def next_nonce(self, account_address):
+        with self._lock:
+            nonce = self._nonces.get(account_address)
+            if nonce == None:
+                nonce = self.web3.eth.getTransactionCount(account_address, 'pending')
+            self._nonces[account_address] = nonce + 1
+            return nonce
+
+    def prime(self, account_address, pendingCount):
+        '''
+        Seed an account's next nonce from a pending transaction count read
+        elsewhere (e.g. in a BatchReader), unless it is already being tracked.
+        '''
+        with self._lock:
+            self._nonces.setdefault(account_address, pendingCount)
+
+    def resync(self, account_address):
+        with self._lock:
+            self._nonces.pop(account_address, None)
+
+class ConsensusClient:
+    '''
+    A ConsensusClient owns one Web3 instance and one keep-alive HTTP session
+    pool for a single RPC URL. Contract instances are cached per
+    (address, ABI hash) so the ABI is only parsed once per process.
+
+    Arguments:
+        url -- The HTTP(S) endpoint of the blockchain node.
+        timeout -- Timeout in seconds for every RPC made through this client.
+        poolSize -- Maximum number of kept-alive connections to the node.
+    '''
+    _clients = Registry()
+
+    def __init__(self, url, timeout=REQUEST_TIMEOUT, poolSize=POOL_SIZE):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.web3 = Web3(Web3.HTTPProvider(url, request_kwargs={'timeout': timeout}, session=self.session))
+        self.nonces = NonceManager(self.web3)
+        self.fees = FeeOracle(self.web3)
+        self.tracker = ReceiptTracker(self)
+        self._contracts = {}
+        self._contractsLock = threading.Lock()
+
+    @classmethod
+    def for_url(cls, url):
+        '''
+        Return the shared client for this RPC URL, creating it on first use.
+        '''
+        return cls._clients.get(url, lambda: cls(url))
+
+    @classmethod
+    def close_all(cls):
+        '''
+        Close every shared client's HTTP sessions and forget them.
+        '''
+        cls._clients.close_all(lambda client: client.session.close())
+
+    def contract(self, address, abi):
+        '''
+        Return the cached contract instance for this address and ABI. The ABI
+        may be given either as the JSON string stored in .env or as a list.
+        '''
+        key = (address, abi_hash(abi))
+        with self._contractsLock:
+            contract = self._contracts.get(key)
+            if contract == None:
+                contract = self.web3.eth.contract(address=address, abi=abi)
+                self._contracts[key] = contract
+            return contract
+
+    def reader(self):
+        '''
+        Return a new BatchReader for queuing up reads against this client's node.
+        '''
+        return BatchReader(self)
+
+    def batch(self, calls):
+        '''
+        Send several raw JSON-RPC calls to the node in a single HTTP round-trip
+        and return their results in the same order. A call that failed is
+        returned as its JSON-RPC error object wrapped in an RPCError. If the
+        node rejects the whole batch (e.g. it doesn't support batching), its
+        error is raised as an RPCError instead.
+
+        Arguments:
+            calls -- A list of (method, params) tuples.
+        '''
+        if len(calls) == 0:
+            return []
+        payload = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, (method, params) in enumerate(calls)]
+        response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        body = response.json()
+        if isinstance(body, dict):
+            raise RPCError(body.get("error", {"message": "Unexpected reply to a JSON-RPC batch: {0}".format(body)}))
+        replies = {reply["id"]: reply for reply in body}
+        return [RPCError(replies[i]["error"]) if "error" in replies[i] else replies[i]["result"] for i in range(len(calls))]
+
+    def submit(self, function, account_address, private_key, gas=None):
+        '''
+        Build, sign and send a contract function call (or constructor) from
+        account_address, and return a PendingTransaction straight away. The
+        shared ReceiptTracker resolves it once the transaction is mined.
+
+        Arguments:
+            function -- A bound contract function, e.g. contract.functions.Vote(...),
+                        or contract.constructor().
+            account_address -- The address paying for the transaction.
+            private_key -- The private key used to sign the transaction.
+            gas -- Gas limit to send with. If None it is estimated by the node,
+                   which fails for a call that depends on a transaction not
+                   yet mined.
+        '''
+        web3 = self.web3
+        for attempt in range(SEND_ATTEMPTS):
+            try:
+                fields = {'nonce': self.nonces.next_nonce(account_address), 'from': account_address}
+                if gas != None:
+                    fields['gas'] = gas
+                fields.update(self.fees.transaction_fields())
+                tx = function.buildTransaction(fields)
+
+                signed_tx = web3.eth.account.signTransaction(tx, private_key=private_key)
+
+                tx_transact = web3.eth.sendRawTransaction(signed_tx.rawTransaction)
+                break
+            except ValueError as e:
+                # The allocated nonce was never used, so our local count is now ahead of the chain
+                self.nonces.resync(account_address)
+                if attempt == SEND_ATTEMPTS - 1 or not is_nonce_error(e):
+                    raise
+            except Exception:
+                self.nonces.resync(account_address)
+                raise
+
+        return self.tracker.track(tx_transact, account_address)
+
+    def transact(self, function, account_address, private_key, timeout=None):
+        '''
+        Same as submit(), but block until the transaction's receipt is available.
+        Raises TimeExhausted if it isn't within timeout seconds, by default
+        the receipt tracker's own timeout plus one poll.
+        '''
+        pendingTransaction = self.submit(function, account_address, private_key)
+        if timeout == None:
+            timeout = self.tracker.timeout + self.tracker.interval + self.timeout
+        try:
+            return pendingTransaction.result(timeout)
+        except FutureTimeoutError:
+            raise TimeExhausted("Transaction {0} is not in the chain after {1} seconds".format(Web3.toHex(pendingTransaction.hash), timeout))
+
+class BatchReader:
+    '''
+    Queues read-only contract calls (plus fee lookups and
+    eth_getTransactionCount) and sends them all to the node as one JSON-RPC
+    batch. execute() returns each result decoded the same way as
+    ContractFunction.call() would, in the order the reads were queued.
+
+    Reading fees or a transaction count also primes the client, so a
+    transaction sent straight afterwards doesn't read them again.
+
+    Arguments:
+        client -- The ConsensusClient whose node is queried.
+    '''
+    def __init__(self, client):
+        self.client = client
+        self._calls = []
+        self._decoders = []
+
+    def call(self, function, block_identifier='latest'):
+        '''
+        Queue a bound contract view, e.g. contract.functions.getIsCompiled(messageID).
+        '''
+        web3 = self.client.web3
+        outputTypes = get_abi_output_types(function.abi)
+
+        def decode(result):
+            decoded = map_abi_data(BASE_RETURN_NORMALIZERS, outputTypes, web3.codec.decode_abi(outputTypes, HexBytes(result)))
+            return decoded[0] if len(decoded) == 1 else list(decoded)
+
+        transaction = {"to": function.address, "data": function._encode_transaction_data()}
+        return self._queue("eth_call", [transaction, block_identifier], decode)
+
+    def gas_price(self):
+        def decode(result):
+            gasPrice = int(result, 16)
+            self.client.fees.prime_gas_price(gasPrice)
+            return gasPrice
+        return self._queue("eth_gasPrice", [], decode)
+
+    def fees(self):
+        '''
+        Queue whichever lookup the client's FeeOracle relies on: eth_feeHistory,
+        or eth_gasPrice on nodes without it. Its result primes the oracle; if
+        the node doesn't have eth_feeHistory the oracle falls back to legacy
+        pricing. Either way a failure is returned in place rather than raised.
+        '''
+        fees = self.client.fees
+        if fees.supportsFeeHistory == False:
+            return self.gas_price()
+
+        def decode(result):
+            baseFees = [int(baseFee, 16) for baseFee in result["baseFeePerGas"]]
+            rewards = [[int(reward, 16) for reward in block] for block in result.get("reward", [])]
+            fees.prime_fee_history(baseFees, rewards)
+            return fees.transaction_fields()
+
+        def failed(error):
+            if is_method_missing(error):
+                fees.mark_unsupported()
+            return error
+        return self._queue("eth_feeHistory", [hex(FEE_HISTORY_BLOCKS), 'latest', [fees.percentile]], decode, failed)
+
+    def transaction_count(self, account_address, block_identifier='pending'):
+        def decode(result):
+            count = int(result, 16)
+            if block_identifier == 'pending':
+                self.client.nonces.prime(account_address, count)
+            return count
+        return self._queue("eth_getTransactionCount", [account_address, block_identifier], decode)
+
+    def _queue(self, method, params, decoder, onError=None):
+        self._calls.append((method, params))
+        self._decoders.append((decoder, onError))
+        return self
+
+    def execute(self, raise_errors=True):
+        '''
+        Send every queued read in one round-trip and return the decoded results.
+
+        Arguments:
+            raise_errors -- If True, raise the first RPCError (e.g. a reverted
+                            view). Otherwise failed reads are returned in place
+                            as RPCError instances.
+        '''
+        replies = self.client.batch(self._calls)
+        results = []
+        for reply, (decode, onError) in zip(replies, self._decoders):
+            if isinstance(reply, RPCError) and onError != None:
+                results.append(onError(reply))
+            elif isinstance(reply, RPCError):
+                if raise_errors:
+                    raise reply
+                results.append(reply)
+            else:
+                results.append(decode(reply))
+        return results
+
+class RPCError(Exception):
+    '''
+    Raised (or returned from ConsensusClient.batch()) when the node answers a
+    JSON-RPC call with an error object.
+    '''
+    def __init__(self, error):
+        super().__init__(error.get("message", error))
+        self.error = error
+
+class TransactionReverted(Exception):
+    '''
+    Set on a PendingTransaction whose transaction was mined but reverted.
+    '''
+    def __init__(self, receipt):
+        super().__init__("Transaction {0} reverted".format(receipt["transactionHash"].hex()))
+        self.receipt = receipt
+
+class PendingTransaction:
+    '''
+    A handle to a sent transaction. It wraps a concurrent.futures.Future that
+    resolves to the transaction receipt, or fails with TransactionReverted if
+    the transaction reverted, or with TimeExhausted if it was never mined.
+
+    Arguments:
+        hash -- The transaction hash returned by sendRawTransaction.
+        account_address -- The sending account, used to resync its nonce if
+                           the transaction is dropped.
+    '''
+    def __init__(self, hash, account_address):
+        self.hash = hash
+        self.account_address = account_address
+        self.sentAt = time.monotonic()
+        self.future = Future()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(pendingTransaction) from the tracker thread once the
+        transaction is confirmed, reverted or timed out.
+        '''
+        self.future.add_done_callback(lambda future: callback(self))
+
+class ReceiptTracker:
+    '''
+    Polls for the receipts of every in-flight transaction of one client from a
+    single background thread. Each poll asks for all pending hashes in one
+    JSON-RPC batch, so tracking many transactions costs one round-trip per
+    interval rather than one per transaction.
+
+    Arguments:
+        client -- The ConsensusClient whose node is polled.
+        interval -- Seconds between polls.
+        timeout -- Seconds after which an unmined transaction is given up on.
+    '''
+    def __init__(self, client, interval=RECEIPT_POLL_INTERVAL, timeout=RECEIPT_TIMEOUT):
+        self.client = client
+        self.interval = interval
+        self.timeout = timeout
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def track(self, hash, account_address):
+        pendingTransaction = PendingTransaction(hash, account_address)
+        with self._lock:
+            self._pending[hash] = pendingTransaction
+            if self._thread == None:
+                self._thread = threading.Thread(target=self._run, name="ReceiptTracker", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return pendingTransaction
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self._lock:
+                pending = list(self._pending.values())
+            if len(pending) == 0:
+                continue
+            try:
+                self.poll(pending)
+            except Exception:
+                # A failed poll (e.g. the node is briefly unreachable) is retried on the next interval
+                pass
+            # Checked whether or not the poll succeeded, so an unreachable node can't stall callers forever
+            self.expire(pending)
+
+    def poll(self, pending):
+        '''
+        Fetch the receipts of these transactions in one batch and resolve
+        every one that has been mined.
+        '''
+        replies = self.client.batch([("eth_getTransactionReceipt", [Web3.toHex(p.hash)]) for p in pending])
+        for pendingTransaction, reply in zip(pending, replies):
+            if reply == None or isinstance(reply, RPCError):
+                continue
+            # Formatted the same way web3.eth.getTransactionReceipt would, without fetching it again
+            receipt = AttributeDict.recursive(receipt_formatter(reply))
+            if receipt["status"] == 0:
+                self._finish(pendingTransaction, exception=TransactionReverted(receipt))
+            else:
+                self._finish(pendingTransaction, result=receipt)
+
+    def expire(self, pending):
+        '''
+        Fail every one of these transactions that is still unresolved after
+        the tracker's timeout with TimeExhausted.
+        '''
+        for pendingTransaction in pending:
+            if pendingTransaction.done() or time.monotonic() - pendingTransaction.sentAt <= self.timeout:
+                continue
+            # The transaction may have been dropped, leaving a gap at its nonce
+            self.client.nonces.resync(pendingTransaction.account_address)
+            self._finish(pendingTransaction, exception=TimeExhausted(
+                "Transaction {0} is not in the chain after {1} seconds".format(Web3.toHex(pendingTransaction.hash), self.timeout)))
+
+    def _finish(self, pendingTransaction, result=None, exception=None):
+        with self._lock:
+            self._pending.pop(pendingTransaction.hash, None)
+        if exception != None:
+            pendingTransaction.future.set_exception(exception)
+        else:
+            pendingTransaction.future.set_result(result)
+
+def is_nonce_error(error):
+    '''
+    Return True if a ValueError raised by the node says the nonce we sent was rejected.
+    '''
+    message = str(error).lower()
+    return any([text in message for text in NONCE_ERRORS])
+
+def is_method_missing(error):
+    '''
+    Return True if a node error (a ValueError raised by web3, or an RPCError)
+    says the method called doesn't exist, rather than that it failed this time.
+    '''
+    details = error.error if isinstance(error, RPCError) else (error.args[0] if len(error.args) > 0 else None)
+    if isinstance(details, dict):
+        if details.get("code") == METHOD_NOT_FOUND:
+            return True
+        details = details.get("message", "")
+    message = str(details).lower()
+    return any([text in message for text in METHOD_MISSING_ERRORS])
+
+def is_revert(error):
+    '''
+    Return True if an RPCError says the call reverted, as a call to a function
+    the deployed contract doesn't have does.
+    '''
+    return "revert" in str(error.error.get("message", "")).lower()
+
+def has_function(contract, name):
+    '''
+    Return True if the contract's ABI declares a function with this name. Used
+    to fall back gracefully when talking to an older deployment.
+    '''
+    return any([entry.get("type") == "function" and entry.get("name") == name for entry in contract.abi])
+
+def abi_hash(abi):
+    '''
+    Hash an ABI so that equal ABIs share a cache entry whether they were
+    loaded as a string or as parsed JSON.
+    '''
+    if isinstance(abi, str):
+        abi = json.loads(abi)
+    return sha256(json.dumps(abi, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,91 @@
+#! python3
+# compile_contracts.py
+# Rebuilds contracts/artifacts and the ABI and BYTECODE in .env from the Solidity sources.
+#
+# Usage: python compile_contracts.py [contract name ...]
+# Run it in the same commit as any change to contracts/*.sol, so that the
+# artifacts and .env never describe an older contract than the source.
+
+import json, os, re, sys, unittest
+
+from shared import write_json
+
+# ---------- Global values ---------- #
+CONTRACTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "contracts")
+ARTIFACTS_PATH = os.path.join(CONTRACTS_PATH, "artifacts")
+ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+SOLC_VERSION = "0.8.17"
+# Compiled by default; the first is the one deploy.py and app.py read from .env
+CONTRACTS = ["BusinessConsensus", "BusinessConsensusV2"]
+# Networks listed in each artifact's "deploy" section, as Remix writes them
+NETWORKS = ["VM:-", "main:1", "ropsten:3", "rinkeby:4", "kovan:42", "görli:5", "Custom"]
+OUTPUTS = ["abi", "metadata", "evm.bytecode", "evm.deployedBytecode", "evm.gasEstimates", "evm.methodIdentifiers"]
+
+# ---------- Unit tests ---------- #
+class TestUpdateEnv(unittest.TestCase):
+    def test_only_abi_and_bytecode_are_replaced(self):
+        # Arrange
+        env = ('ABI = \'[{"old": true}]\' #ABI of the contract\n'
+               'BYTECODE = "6080" #Bytecode of the contract\n'
+               'Contract_Address = "0x42" #Contract address after being deployed\n')
+
+        # Act
+        updated = update_env(env, [{"name": "new"}], "60806040")
+
+        # Assert
+        self.assertEqual(updated, 'ABI = \'[{"name":"new"}]\' #ABI of the contract\n'
+                                  'BYTECODE = "60806040" #Bytecode of the contract\n'
+                                  'Contract_Address = "0x42" #Contract address after being deployed\n')
+
+# ---------- Functions ---------- #
+def compile_contract(name):
+    '''
+    Compile contracts/<name>.sol with solc SOLC_VERSION, installing it first
+    if needed, and return the contract's standard JSON output.
+    '''
+    import solcx
+    solcx.install_solc(SOLC_VERSION)
+    source = "contracts/{0}.sol".format(name)
+    with open(os.path.join(CONTRACTS_PATH, name + ".sol")) as f:
+        content = f.read()
+    compiled = solcx.compile_standard({
+        "language": "Solidity",
+        "sources": {source: {"content": content}},
+        "settings": {"optimizer": {"enabled": False, "runs": 200}, "outputSelection": {"*": {"*": OUTPUTS}}},
+    }, solc_version=SOLC_VERSION)
+    return compiled["contracts"][source][name]
+
+def write_artifacts(name, output):
+    '''
+    Write contracts/artifacts/<name>.json and <name>_metadata.json in the
+    layout Remix uses.
+    '''
+    artifact = {
+        "deploy": {network: {"linkReferences": {}, "autoDeployLib": True} for network in NETWORKS},
+        "data": output["evm"],
+        "abi": output["abi"],
+    }
+    write_json(os.path.join(ARTIFACTS_PATH, name + ".json"), artifact, indent="\t", ensure_ascii=False)
+    write_json(os.path.join(ARTIFACTS_PATH, name + "_metadata.json"), json.loads(output["metadata"]), indent="\t", ensure_ascii=False)
+
+def update_env(env, abi, bytecode):
+    '''
+    Return the text of a .env file with its ABI and BYTECODE values replaced,
+    keeping every other line and the comments after them.
+    '''
+    env = re.sub(r"^ABI = '[^']*'", lambda match: "ABI = '{0}'".format(json.dumps(abi, separators=(",", ":"))), env, flags=re.M)
+    return re.sub(r'^BYTECODE = "[^"]*"', lambda match: 'BYTECODE = "{0}"'.format(bytecode), env, flags=re.M)
+
+def main(names):
+    for name in names:
+        output = compile_contract(name)
+        write_artifacts(name, output)
+        if name == CONTRACTS[0]:
+            with open(ENV_PATH) as f:
+                env = f.read()
+            with open(ENV_PATH, "w") as f:
+                f.write(update_env(env, output["abi"], output["evm"]["bytecode"]["object"]))
+        print("Compiled {0}".format(name))
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or CONTRACTS)
@@ -9,6 +9,27 @@ contract BusinessConsensus{
         address recipient; // represents a stakeholder recipient
     }
 
+    // A vote cast through VoteV2.
+    enum Choice { Disapprove, Approve }
+
+    // Summary of one proposal, as returned by getProposalStatuses.
+    struct ProposalStatus {
+        uint256 expiryDate;
+        uint256 voteCount;
+        uint256 numApprovals;
+        uint256 numVoters;
+        bool isCompiled;
+        bool finalVerdict;
+    }
+
+    // Emitted on every state change, so off-chain indexers can follow
+    // proposals with eth_getLogs instead of polling the mappings below.
+    event ProposalCreated(bytes32 indexed messageID, address indexed initiator, bytes32 indexed keyID,
+    uint256 expiryDate, uint256 requiredPercentage, bytes32 contents, string messageDate);
+    event VoterRegistered(bytes32 indexed messageID, address indexed voter);
+    event VoteCast(bytes32 indexed messageID, address indexed voter, bool approval);
+    event ConsensusReached(bytes32 indexed messageID, bool verdict, uint256 voteCount, uint256 numApprovals);
+
     mapping(bytes32=>address) public initiators;
     mapping(bytes32 =>bytes32) public IDs;
     mapping(bytes32 => uint256) public voteCounts;
@@ -26,6 +47,21 @@ contract BusinessConsensus{
     
     function createContract(bytes32 _messageID, uint256 expiry, uint256 requiredPercentage,bytes32 _contents,
     string memory _messageDate, bytes32 _keyID) external{
+        createProposal(_messageID,expiry,requiredPercentage,_contents,_messageDate,_keyID);
+    }
+
+    // Create a proposal and register its initial recipients atomically,
+    // so a proposal never exists without its voters.
+    function createContractWithVoters(bytes32 _messageID, uint256 expiry, uint256 requiredPercentage,bytes32 _contents,
+    string memory _messageDate, bytes32 _keyID, address[] calldata voters) external{
+        createProposal(_messageID,expiry,requiredPercentage,_contents,_messageDate,_keyID);
+        for(uint256 i=0; i< voters.length; i++){
+            registerVoter(voters[i],_messageID);
+        }
+    }
+
+    function createProposal(bytes32 _messageID, uint256 expiry, uint256 requiredPercentage,bytes32 _contents,
+    string memory _messageDate, bytes32 _keyID) internal{
         // initialize proposal set by the original sender and counted votes to zero
         require(initiators[_messageID] == address(0),"Proposal already created!");
             voteCounts[_messageID] = 0;
@@ -40,11 +76,29 @@ contract BusinessConsensus{
             messageDates[_keyID] = _messageDate;
             numApprovals[_messageID] = 0;
             initiators[_messageID] = msg.sender;
+            emit ProposalCreated(_messageID,msg.sender,_keyID,expiryDates[_messageID],requiredPercentage,_contents,_messageDate);
 
     }
     function getIsCompiled(bytes32 _messageID) public view returns (bool){
         return isCompiled[_messageID];
     }
+    // Status of many proposals in one call, so dashboards don't need
+    // a call per field per proposal.
+    function getProposalStatuses(bytes32[] calldata _messageIDs) external view returns (ProposalStatus[] memory){
+        ProposalStatus[] memory statuses = new ProposalStatus[](_messageIDs.length);
+        for(uint256 i=0; i< _messageIDs.length; i++){
+            bytes32 id = _messageIDs[i];
+            statuses[i] = ProposalStatus({
+                expiryDate: expiryDates[id],
+                voteCount: voteCounts[id],
+                numApprovals: numApprovals[id],
+                numVoters: keys[id].length,
+                isCompiled: isCompiled[id],
+                finalVerdict: finalVerdicts[id]
+            });
+        }
+        return statuses;
+    }
     function checkConsistency(bytes32 _keyID, uint256 _businessRequirement, uint256 _expiryLength, bytes32 _contents) public view returns(bool, bool, bool){
         bool value1 = true;
         bool value2 = true;
@@ -72,6 +126,22 @@ contract BusinessConsensus{
             msg.sender == initiators[_messageID],
             "Only initiator can register a recipient."
         );
+        registerVoter(voter,_messageID);
+    }
+
+    // Give every address in `voters` the right to vote in this proposal
+    // in a single transaction. May only be called by `initiator`.
+    function RegisterVoters(address[] calldata voters,bytes32 _messageID) external {
+        require(
+            msg.sender == initiators[_messageID],
+            "Only initiator can register a recipient."
+        );
+        for(uint256 i=0; i< voters.length; i++){
+            registerVoter(voters[i],_messageID);
+        }
+    }
+
+    function registerVoter(address voter,bytes32 _messageID) internal {
         require(voter != initiators[_messageID], "Initiator can't vote!");
 
         require(voter_maps[_messageID][voter].recipient == address(0), "Recipient is already registered");
@@ -81,34 +151,37 @@ contract BusinessConsensus{
         Voter memory x = Voter({voted: false,recipient: voter, vote: false});
         voter_maps[_messageID][voter] = x;
         keys[_messageID].push(voter);
+        emit VoterRegistered(_messageID,voter);
     }
 
+    // Legacy string vote, kept for clients built against older deployments.
+    // Any response other than "i approve" is counted as a disapproval.
     function Vote(string memory response,bytes32 _messageID) external {
+        castVote(_messageID, keccak256(bytes(response)) == keccak256(bytes("i approve")));
+    }
+
+    // Vote with a one-byte choice instead of a string: cheaper calldata and no hashing.
+    // A choice outside the Choice enum reverts.
+    function VoteV2(bytes32 _messageID, Choice choice) external {
+        castVote(_messageID, choice == Choice.Approve);
+    }
+
+    function castVote(bytes32 _messageID, bool approval) internal {
 
         require(block.timestamp < expiryDates[_messageID], "Voting has expired");
-        require(voter_maps[_messageID][msg.sender].recipient != address(0x0), "You are not registered to vote");
-        require(!voter_maps[_messageID][msg.sender].voted, "You already sent a response.");
+        Voter storage ballot = voter_maps[_messageID][msg.sender];
+        require(ballot.recipient != address(0x0), "You are not registered to vote");
+        require(!ballot.voted, "You already sent a response.");
 
-        if(keccak256(bytes(response)) == keccak256(bytes("i approve"))){
-            voter_maps[_messageID][msg.sender].voted = true;
-            voter_maps[_messageID][msg.sender].vote = true;
+        ballot.voted = true;
+        if(approval){
+            ballot.vote = true;
             numApprovals[_messageID] += 1;
-            voteCounts[_messageID] += 1;
-            Voters[_messageID].push(voter_maps[_messageID][msg.sender]);
         }
+        voteCounts[_messageID] += 1;
+        Voters[_messageID].push(ballot);
+        emit VoteCast(_messageID,msg.sender,approval);
 
-        else if(keccak256(bytes(response)) == keccak256(bytes("i disapprove"))){
-            voter_maps[_messageID][msg.sender].voted = true;
-            voteCounts[_messageID] += 1;
-            Voters[_messageID].push(voter_maps[_messageID][msg.sender]);
-        }
-        //if given invalid response, it will be considered a disapproval
-        else{
-            voter_maps[_messageID][msg.sender].voted = true;
-            voteCounts[_messageID] += 1;
-            Voters[_messageID].push(voter_maps[_messageID][msg.sender]);
-        }
-        
     }
 
     /// compile all relevant information into a Bundle
@@ -117,16 +190,40 @@ contract BusinessConsensus{
         require(isCompiled[_messageID] == false, "Consensus has already been calculated");
         require(msg.sender == initiators[_messageID] || voter_maps[_messageID][msg.sender].recipient != address(0x0),
          "You aren't authorize to compile Bundle");
-        uint256 AccumulatedPercentage = (numApprovals[_messageID]/keys[_messageID].length)*100;
-        if(AccumulatedPercentage >= businessRequirements[_messageID]){
+        // Constant gas whatever the board size: the verdict comes from the running counters, compared
+        // as approvals/voters >= required/100 without dividing, so partial approval isn't rounded to 0%
+        uint256 numVoters = keys[_messageID].length;
+        if(numVoters > 0 && numApprovals[_messageID]*100 >= businessRequirements[_messageID]*numVoters){
             finalVerdicts[_messageID] = true;
         }
-        for(uint8 i=0; i< keys[_messageID].length; i++){
-            if(voter_maps[_messageID][keys[_messageID][i]].voted == false){
-                Voters[_messageID].push(voter_maps[_messageID][keys[_messageID][i]]);
+        isCompiled[_messageID] = true;
+        emit ConsensusReached(_messageID,finalVerdicts[_messageID],voteCounts[_messageID],numApprovals[_messageID]);
+    }
+
+    // Registered voters of this proposal who never voted, among keys[start:start+count],
+    // and the total number of registered voters so callers know how many pages to read.
+    // Consensus no longer copies them into Voters, so retrieve_bundle only lists those who voted.
+    function getAbsentVoters(bytes32 _messageID, uint256 start, uint256 count) external view returns (address[] memory, uint256){
+        address[] storage registered = keys[_messageID];
+        if(start >= registered.length){
+            return (new address[](0), registered.length);
+        }
+        // Clamped before adding, so count = type(uint256).max can mean "all" without overflowing
+        if(count > registered.length - start){
+            count = registered.length - start;
+        }
+        uint256 end = start + count;
+        address[] memory absent = new address[](count);
+        uint256 found = 0;
+        for(uint256 i=start; i< end; i++){
+            if(!voter_maps[_messageID][registered[i]].voted){
+                absent[found] = registered[i];
+                found++;
             }
         }
-        isCompiled[_messageID] = true;
+        // Trim the unused tail of the array in place
+        assembly { mstore(absent, found) }
+        return (absent, registered.length);
     }
 
     function retrieve_bundle(bytes32 _messageID) external view returns (bool, bytes32, uint256, Voter[] memory){
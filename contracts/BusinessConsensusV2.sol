@@ -0,0 +1,245 @@
+pragma solidity >=0.7.0 <0.9.0;
+// Version 2 of BusinessConsensus. It keeps the same external functions and
+// events, but each proposal's state lives in one packed Proposal struct (two
+// storage slots) instead of a dozen parallel mappings, so creating a proposal
+// writes far fewer cold slots and getProposal reads it back in one call.
+contract BusinessConsensusV2{
+    uint8 public constant VERSION = 2;
+
+    struct Voter {
+        bool voted;  // if true, that person already voted
+        bool vote;   //represents approval or disapproval
+        address recipient; // represents a stakeholder recipient
+    }
+
+    // A vote cast through VoteV2.
+    enum Choice { Disapprove, Approve }
+
+    // Everything about one proposal, packed into two slots:
+    // initiator, expiryDate and voteCount in the first, the rest in the second.
+    struct Proposal {
+        address initiator;
+        uint64 expiryDate;
+        uint32 voteCount;
+        uint32 numApprovals;
+        uint32 numVoters;
+        uint8 requiredPercentage;
+        bool isCompiled;
+        bool finalVerdict;
+    }
+
+    // What getIsCreated and checkConsistency look up by keyID.
+    struct Request {
+        bytes32 messageID;
+        bytes32 contents;
+        uint64 expiryLength;
+        uint8 requiredPercentage;
+        string messageDate;
+    }
+
+    // Summary of one proposal, as returned by getProposalStatuses.
+    struct ProposalStatus {
+        uint256 expiryDate;
+        uint256 voteCount;
+        uint256 numApprovals;
+        uint256 numVoters;
+        bool isCompiled;
+        bool finalVerdict;
+    }
+
+    // Emitted on every state change, so off-chain indexers can follow
+    // proposals with eth_getLogs.
+    event ProposalCreated(bytes32 indexed messageID, address indexed initiator, bytes32 indexed keyID,
+    uint256 expiryDate, uint256 requiredPercentage, bytes32 contents, string messageDate);
+    event VoterRegistered(bytes32 indexed messageID, address indexed voter);
+    event VoteCast(bytes32 indexed messageID, address indexed voter, bool approval);
+    event ConsensusReached(bytes32 indexed messageID, bool verdict, uint256 voteCount, uint256 numApprovals);
+
+    mapping(bytes32 => Proposal) public proposals;
+    mapping(bytes32 => Request) public requests;
+    mapping(bytes32=>mapping(address=>Voter)) public voter_maps;
+    mapping(bytes32=>Voter[]) public Voters;
+    mapping(bytes32=>address[]) public keys;
+
+    function createContract(bytes32 _messageID, uint256 expiry, uint256 requiredPercentage,bytes32 _contents,
+    string memory _messageDate, bytes32 _keyID) external{
+        createProposal(_messageID,expiry,requiredPercentage,_contents,_messageDate,_keyID);
+    }
+
+    // Create a proposal and register its initial recipients atomically,
+    // so a proposal never exists without its voters.
+    function createContractWithVoters(bytes32 _messageID, uint256 expiry, uint256 requiredPercentage,bytes32 _contents,
+    string memory _messageDate, bytes32 _keyID, address[] calldata voters) external{
+        createProposal(_messageID,expiry,requiredPercentage,_contents,_messageDate,_keyID);
+        for(uint256 i=0; i< voters.length; i++){
+            registerVoter(voters[i],_messageID);
+        }
+    }
+
+    function createProposal(bytes32 _messageID, uint256 expiry, uint256 requiredPercentage,bytes32 _contents,
+    string memory _messageDate, bytes32 _keyID) internal{
+        require(proposals[_messageID].initiator == address(0),"Proposal already created!");
+        require(requiredPercentage <= 100, "Business requirement is a percentage");
+        require(expiry <= type(uint64).max - block.timestamp, "Expiry is too far away");
+
+        uint64 expiryDate = uint64(block.timestamp + expiry);
+        proposals[_messageID] = Proposal({
+            initiator: msg.sender,
+            expiryDate: expiryDate,
+            voteCount: 0,
+            numApprovals: 0,
+            numVoters: 0,
+            requiredPercentage: uint8(requiredPercentage),
+            isCompiled: false,
+            finalVerdict: false
+        });
+        requests[_keyID] = Request({
+            messageID: _messageID,
+            contents: _contents,
+            expiryLength: uint64(expiry),
+            requiredPercentage: uint8(requiredPercentage),
+            messageDate: _messageDate
+        });
+        emit ProposalCreated(_messageID,msg.sender,_keyID,expiryDate,requiredPercentage,_contents,_messageDate);
+    }
+
+    // The whole state of one proposal in one call.
+    function getProposal(bytes32 _messageID) external view returns (Proposal memory){
+        return proposals[_messageID];
+    }
+
+    function getIsCompiled(bytes32 _messageID) public view returns (bool){
+        return proposals[_messageID].isCompiled;
+    }
+
+    // Status of many proposals in one call, so dashboards don't need
+    // a call per field per proposal.
+    function getProposalStatuses(bytes32[] calldata _messageIDs) external view returns (ProposalStatus[] memory){
+        ProposalStatus[] memory statuses = new ProposalStatus[](_messageIDs.length);
+        for(uint256 i=0; i< _messageIDs.length; i++){
+            Proposal storage proposal = proposals[_messageIDs[i]];
+            statuses[i] = ProposalStatus({
+                expiryDate: proposal.expiryDate,
+                voteCount: proposal.voteCount,
+                numApprovals: proposal.numApprovals,
+                numVoters: proposal.numVoters,
+                isCompiled: proposal.isCompiled,
+                finalVerdict: proposal.finalVerdict
+            });
+        }
+        return statuses;
+    }
+
+    function checkConsistency(bytes32 _keyID, uint256 _businessRequirement, uint256 _expiryLength, bytes32 _contents) public view returns(bool, bool, bool){
+        Request storage request = requests[_keyID];
+        return (_businessRequirement == request.requiredPercentage, _contents == request.contents, _expiryLength == request.expiryLength);
+    }
+
+    function getIsCreated(bytes32 _keyID) public view returns (bytes32,string memory){
+        return (requests[_keyID].messageID,requests[_keyID].messageDate);
+    }
+
+    // Give `voter` the right to vote in this proposal.
+    // May only be called by `initiator`.
+    function RegisterVoter(address voter,bytes32 _messageID) external {
+        require(msg.sender == proposals[_messageID].initiator, "Only initiator can register a recipient.");
+        registerVoter(voter,_messageID);
+    }
+
+    // Give every address in `voters` the right to vote in this proposal
+    // in a single transaction. May only be called by `initiator`.
+    function RegisterVoters(address[] calldata voters,bytes32 _messageID) external {
+        require(msg.sender == proposals[_messageID].initiator, "Only initiator can register a recipient.");
+        for(uint256 i=0; i< voters.length; i++){
+            registerVoter(voters[i],_messageID);
+        }
+    }
+
+    function registerVoter(address voter,bytes32 _messageID) internal {
+        Proposal storage proposal = proposals[_messageID];
+        require(voter != proposal.initiator, "Initiator can't vote!");
+        require(voter_maps[_messageID][voter].recipient == address(0), "Recipient is already registered");
+        require(block.timestamp < proposal.expiryDate, "Proposal has reached its expiry date");
+
+        voter_maps[_messageID][voter] = Voter({voted: false,recipient: voter, vote: false});
+        keys[_messageID].push(voter);
+        proposal.numVoters += 1;
+        emit VoterRegistered(_messageID,voter);
+    }
+
+    // Legacy string vote. Any response other than "i approve" is counted as a disapproval.
+    function Vote(string memory response,bytes32 _messageID) external {
+        castVote(_messageID, keccak256(bytes(response)) == keccak256(bytes("i approve")));
+    }
+
+    // Vote with a one-byte choice instead of a string. A choice outside the Choice enum reverts.
+    function VoteV2(bytes32 _messageID, Choice choice) external {
+        castVote(_messageID, choice == Choice.Approve);
+    }
+
+    function castVote(bytes32 _messageID, bool approval) internal {
+        Proposal storage proposal = proposals[_messageID];
+        require(block.timestamp < proposal.expiryDate, "Voting has expired");
+        Voter storage ballot = voter_maps[_messageID][msg.sender];
+        require(ballot.recipient != address(0x0), "You are not registered to vote");
+        require(!ballot.voted, "You already sent a response.");
+
+        ballot.voted = true;
+        if(approval){
+            ballot.vote = true;
+            proposal.numApprovals += 1;
+        }
+        proposal.voteCount += 1;
+        Voters[_messageID].push(ballot);
+        emit VoteCast(_messageID,msg.sender,approval);
+    }
+
+    /// compile all relevant information into a Bundle
+    function Consensus(bytes32 _messageID) external {
+        Proposal storage proposal = proposals[_messageID];
+        require(block.timestamp >= proposal.expiryDate, "Verdict has not been reached yet");
+        require(proposal.isCompiled == false, "Consensus has already been calculated");
+        require(msg.sender == proposal.initiator || voter_maps[_messageID][msg.sender].recipient != address(0x0),
+         "You aren't authorize to compile Bundle");
+        // Constant gas whatever the board size: the verdict comes from the running counters, compared
+        // as approvals/voters >= required/100 without dividing, so partial approval isn't rounded to 0%
+        if(proposal.numVoters > 0 && uint256(proposal.numApprovals)*100 >= uint256(proposal.requiredPercentage)*proposal.numVoters){
+            proposal.finalVerdict = true;
+        }
+        proposal.isCompiled = true;
+        emit ConsensusReached(_messageID,proposal.finalVerdict,proposal.voteCount,proposal.numApprovals);
+    }
+
+    // Registered voters of this proposal who never voted, among keys[start:start+count],
+    // and the total number of registered voters so callers know how many pages to read.
+    // Consensus no longer copies them into Voters, so retrieve_bundle only lists those who voted.
+    function getAbsentVoters(bytes32 _messageID, uint256 start, uint256 count) external view returns (address[] memory, uint256){
+        address[] storage registered = keys[_messageID];
+        if(start >= registered.length){
+            return (new address[](0), registered.length);
+        }
+        // Clamped before adding, so count = type(uint256).max can mean "all" without overflowing
+        if(count > registered.length - start){
+            count = registered.length - start;
+        }
+        uint256 end = start + count;
+        address[] memory absent = new address[](count);
+        uint256 found = 0;
+        for(uint256 i=start; i< end; i++){
+            if(!voter_maps[_messageID][registered[i]].voted){
+                absent[found] = registered[i];
+                found++;
+            }
+        }
+        // Trim the unused tail of the array in place
+        assembly { mstore(absent, found) }
+        return (absent, registered.length);
+    }
+
+    function retrieve_bundle(bytes32 _messageID) external view returns (bool, bytes32, uint256, Voter[] memory){
+        Proposal storage proposal = proposals[_messageID];
+        require(block.timestamp >= proposal.expiryDate, "Verdict has not been reached yet");
+        return (proposal.finalVerdict,_messageID,proposal.voteCount,Voters[_messageID]);
+    }
+
+}
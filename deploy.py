@@ -1,39 +1,271 @@
-import json
-from web3 import Web3
 import os
-import time
-from decimal import Decimal
+import unittest
 from dotenv import load_dotenv
+from web3 import Web3
+from eth_abi import decode_abi, encode_abi
 from hashlib import sha256
+from chain import ConsensusClient, RPCError, has_function, is_revert
+
+# Gas budget for each RegisterVoters transaction, kept well under a block's gas limit
+REGISTER_BATCH_GAS = 6000000
+# Upper bounds on what RegisterVoters spends per call and per registered voter
+REGISTER_BASE_GAS = 50000
+REGISTER_VOTER_GAS = 80000
+# getProposalStatuses pages: messageIDs per eth_call, and eth_calls per JSON-RPC batch
+PROPOSAL_PAGE_SIZE = 500
+PROPOSAL_PAGES_PER_BATCH = 10
+# Values of the contract's Choice enum, taken by VoteV2
+VOTE_DISAPPROVE = 0
+VOTE_APPROVE = 1
+# Registered voters checked per getAbsentVoters call
+ABSENT_VOTER_PAGE_SIZE = 1000
+# Views called with their own ABI, since the ABI in .env may be older than the deployed contract
+ABSENT_VOTERS_ABI = [{"type":"function","name":"getAbsentVoters","stateMutability":"view",
+    "inputs":[{"name":"_messageID","type":"bytes32"},{"name":"start","type":"uint256"},{"name":"count","type":"uint256"}],
+    "outputs":[{"name":"","type":"address[]"},{"name":"","type":"uint256"}]}]
+VERSION_ABI = [{"type":"function","name":"VERSION","stateMutability":"view","inputs":[],"outputs":[{"name":"","type":"uint8"}]}]
+# Field order of the contract's ProposalStatus struct
+PROPOSAL_STATUS_FIELDS = ["expiryDate","voteCount","numApprovals","numVoters","isCompiled","finalVerdict"]
+# Field order of BusinessConsensusV2's packed Proposal struct, as returned by getProposal
+PROPOSAL_FIELDS = ["initiator","expiryDate","voteCount","numApprovals","numVoters","requiredPercentage","isCompiled","finalVerdict"]
+
+# ---------- Unit tests ---------- #
+class TestRegisterVoters(unittest.TestCase):
+    URL = "http://register-voters.test"
+    ADDRESS = "0x" + "11"*20
+
+    class FakeClient:
+        # Records every transaction submitted instead of sending it
+        def __init__(self):
+            self.web3 = Web3()
+            self.submitted = []
+            self.gas = []
+
+        def contract(self,address,abi):
+            return self.web3.eth.contract(address=address,abi=abi)
+
+        def submit(self,function,account_address,private_key,gas=None):
+            self.submitted.append((function.fn_name,function.args))
+            self.gas.append(gas)
+            return len(self.submitted)
+
+    def abi(self,*names):
+        inputs = {
+            "RegisterVoter": [{"name": "voter","type": "address"},{"name": "_messageID","type": "bytes32"}],
+            "RegisterVoters": [{"name": "voters","type": "address[]"},{"name": "_messageID","type": "bytes32"}],
+            "createContract": [{"name": "_messageID","type": "bytes32"},{"name": "expiry","type": "uint256"},{"name": "requiredPercentage","type": "uint256"},
+                {"name": "_contents","type": "bytes32"},{"name": "_messageDate","type": "string"},{"name": "_keyID","type": "bytes32"}],
+        }
+        return [{"type": "function","name": name,"inputs": inputs[name],"outputs": [],"stateMutability": "nonpayable"} for name in names]
+
+    def voters(self,count):
+        return [Web3.toChecksumAddress("0x%040x" % (i + 1)) for i in range(count)]
+
+    def setUp(self):
+        self.client = self.FakeClient()
+        ConsensusClient._clients.put(self.URL,self.client)
+
+    def tearDown(self):
+        ConsensusClient._clients.pop(self.URL)
+
+    def test_voters_are_chunked_to_the_gas_limit(self):
+        # Arrange
+        voters = self.voters(8)
+        gasLimit = REGISTER_BASE_GAS + 3*REGISTER_VOTER_GAS
+
+        # Act
+        handles = register_voters(self.ADDRESS,self.abi("RegisterVoter","RegisterVoters"),self.URL,voters,self.ADDRESS,None,b"m"*32,wait=False,gasLimit=gasLimit)
+
+        # Assert
+        self.assertEqual(handles,[1,2,3])
+        self.assertEqual([name for name, _ in self.client.submitted],["RegisterVoters"]*3)
+        self.assertEqual([args[0] for _, args in self.client.submitted],[voters[0:3],voters[3:6],voters[6:8]])
+
+    def test_duplicate_voters_are_registered_once(self):
+        # Arrange
+        voters = self.voters(3)
+
+        # Act
+        register_voters(self.ADDRESS,self.abi("RegisterVoter","RegisterVoters"),self.URL,voters + voters[:2],self.ADDRESS,None,b"m"*32,wait=False)
+
+        # Assert
+        self.assertEqual(self.client.submitted,[("RegisterVoters",(voters,b"m"*32))])
+
+    def test_falls_back_to_one_transaction_per_voter(self):
+        # Arrange
+        voters = self.voters(3)
+
+        # Act
+        register_voters(self.ADDRESS,self.abi("RegisterVoter"),self.URL,voters + voters[:1],self.ADDRESS,None,b"m"*32,wait=False)
+
+        # Assert
+        self.assertEqual(self.client.submitted,[("RegisterVoter",(voter,b"m"*32)) for voter in voters])
+
+    def test_proposal_and_voters_are_sent_without_waiting(self):
+        # Arrange
+        voters = self.voters(2)
+
+        # Act
+        handles = create_contract_with_voters(self.abi("createContract","RegisterVoter"),self.URL,b"m"*32,60,50,self.ADDRESS,"subject","content","date","key",voters,wait=False)
+
+        # Assert
+        self.assertEqual(handles,[1,2,3])
+        self.assertEqual([name for name, _ in self.client.submitted],["createContract","RegisterVoter","RegisterVoter"])
+        self.assertEqual(self.client.gas,[None] + [REGISTER_BASE_GAS + REGISTER_VOTER_GAS]*2)
+
+class TestAbsentVoters(unittest.TestCase):
+    URL = "http://absent-voters.test"
+    ADDRESS = "0x" + "11"*20
+    MESSAGE_ID = b"m"*32
+    ABI = [{"type": "function","name": "getIsCompiled","stateMutability": "view","inputs": [{"name": "_messageID","type": "bytes32"}],
+            "outputs": [{"name": "","type": "bool"}]},
+           {"type": "function","name": "retrieve_bundle","stateMutability": "view","inputs": [{"name": "_messageID","type": "bytes32"}],
+            "outputs": [{"name": "","type": "bool"},{"name": "","type": "bytes32"},{"name": "","type": "uint256"},
+                        {"name": "","type": "tuple[]","components": [{"name": "voted","type": "bool"},{"name": "vote","type": "bool"},{"name": "recipient","type": "address"}]}]}]
+
+    class FakeResponse:
+        def __init__(self,body):
+            self.body = body
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return self.body
+
+    class FakeSession:
+        # Answers eth_call like a deployed, compiled proposal: voters[0] approved and the rest never voted.
+        # Without getAbsentVoters, calling it reverts as it would on an older deployment.
+        def __init__(self,voters,hasAbsentVoters=True):
+            self.voters = voters
+            self.hasAbsentVoters = hasAbsentVoters
+            self.batches = []
+
+        def post(self,url,json,timeout):
+            replies = []
+            starts = []
+            for call in json:
+                data = bytes.fromhex(call["params"][0]["data"][2:])
+                if data[:4] == Web3.keccak(text="getAbsentVoters(bytes32,uint256,uint256)")[:4]:
+                    if not self.hasAbsentVoters:
+                        replies.append({"id": call["id"],"error": {"code": -32000,"message": "execution reverted"}})
+                        continue
+                    _, start, count = decode_abi(["bytes32","uint256","uint256"],data[4:])
+                    starts.append(start)
+                    absent = self.voters[1:]
+                    result = encode_abi(["address[]","uint256"],[absent[start:start+count],len(absent)])
+                elif data[:4] == Web3.keccak(text="getIsCompiled(bytes32)")[:4]:
+                    result = encode_abi(["bool"],[True])
+                else:
+                    result = encode_abi(["bool","bytes32","uint256","(bool,bool,address)[]"],[True,TestAbsentVoters.MESSAGE_ID,1,[(True,True,self.voters[0])]])
+                replies.append({"id": call["id"],"result": "0x" + result.hex()})
+            self.batches.append(starts)
+            return TestAbsentVoters.FakeResponse(replies)
+
+    def voters(self,count):
+        return [Web3.toChecksumAddress("0x%040x" % (i + 1)) for i in range(count)]
+
+    def install(self,session):
+        client = ConsensusClient(self.URL)
+        client.session = session
+        ConsensusClient._clients.put(self.URL,client)
+
+    def tearDown(self):
+        ConsensusClient._clients.pop(self.URL)
+
+    def test_pages_after_the_first_are_read_in_one_batch(self):
+        # Arrange
+        voters = self.voters(6)
+        session = self.FakeSession(voters)
+        self.install(session)
+
+        # Act
+        absent = get_absent_voters(self.ADDRESS,self.URL,self.MESSAGE_ID,pageSize=2)
+
+        # Assert
+        self.assertEqual(absent,voters[1:])
+        self.assertEqual(session.batches,[[0],[2,4]])
+
+    def test_bundle_lists_absent_voters_only_if_the_contract_has_them(self):
+        # Arrange
+        voters = self.voters(3)
+
+        # Act
+        self.install(self.FakeSession(voters))
+        current = fetch_bundle(self.ABI,self.URL,self.ADDRESS,None,None,self.MESSAGE_ID)
+        self.install(self.FakeSession(voters,hasAbsentVoters=False))
+        older = fetch_bundle(self.ABI,self.URL,self.ADDRESS,None,None,self.MESSAGE_ID)
+
+        # Assert
+        self.assertEqual(current[3],[(True,True,voters[0]),(False,False,voters[1]),(False,False,voters[2])])
+        self.assertEqual(older[3],[(True,True,voters[0])])
+
+class TestLegacyProposalStatuses(unittest.TestCase):
+    URL = "http://legacy-statuses.test"
+    ADDRESS = "0x" + "11"*20
+    COMPILED = b"c"*32
+    OPEN = b"o"*32
+
+    def abi(self):
+        getters = [(name,"uint256") for name in ["expiryDates","voteCounts","numApprovals"]] + [(name,"bool") for name in ["isCompiled","finalVerdicts"]]
+        abi = [{"type": "function","name": name,"stateMutability": "view","inputs": [{"name": "","type": "bytes32"}],"outputs": [{"name": "","type": type}]}
+               for name, type in getters]
+        return abi + TestAbsentVoters.ABI[1:]
+
+    class FakeSession:
+        # A deployment from before getProposalStatuses: COMPILED has three voters in its bundle, OPEN hasn't expired
+        def __init__(self,voters):
+            self.voters = voters
+
+        def post(self,url,json,timeout):
+            replies = []
+            for call in json:
+                data = bytes.fromhex(call["params"][0]["data"][2:])
+                compiled = data[4:36] == TestLegacyProposalStatuses.COMPILED
+                if data[:4] == Web3.keccak(text="retrieve_bundle(bytes32)")[:4]:
+                    if not compiled:
+                        replies.append({"id": call["id"],"error": {"code": -32000,"message": "execution reverted: Verdict has not been reached yet"}})
+                        continue
+                    result = encode_abi(["bool","bytes32","uint256","(bool,bool,address)[]"],[True,data[4:36],1,[(True,True,self.voters[0])] + [(False,False,voter) for voter in self.voters[1:]]])
+                elif data[:4] in [Web3.keccak(text=name + "(bytes32)")[:4] for name in ["isCompiled","finalVerdicts"]]:
+                    result = encode_abi(["bool"],[compiled])
+                else:
+                    result = encode_abi(["uint256"],[1])
+                replies.append({"id": call["id"],"result": "0x" + result.hex()})
+            return TestAbsentVoters.FakeResponse(replies)
+
+    def setUp(self):
+        client = ConsensusClient(self.URL)
+        client.session = self.FakeSession([Web3.toChecksumAddress("0x%040x" % (i + 1)) for i in range(3)])
+        ConsensusClient._clients.put(self.URL,client)
+
+    def tearDown(self):
+        ConsensusClient._clients.pop(self.URL)
+
+    def test_num_voters_comes_from_the_compiled_bundle(self):
+        # Act
+        compiled, open = get_proposal_statuses(self.ADDRESS,self.abi(),self.URL,[self.COMPILED,self.OPEN])
+
+        # Assert
+        self.assertEqual(compiled,{"expiryDate": 1,"voteCount": 1,"numApprovals": 1,"numVoters": 3,"isCompiled": True,"finalVerdict": True})
+        self.assertEqual(open["numVoters"],None)
 
 def deploy_contract(abi,bytecode,url):
 
-    web3 = Web3(Web3.HTTPProvider(url))
+    client = ConsensusClient.for_url(url)
     
     load_dotenv()
     account_address = os.getenv("ACCOUNT_ADDRESS")
     private_key = os.getenv('PRIVATE_KEY')
 
-    contract = web3.eth.contract(abi=abi, bytecode=bytecode)
-
-    tx = contract.constructor().buildTransaction({'nonce': web3.eth.getTransactionCount(account_address), 'from': account_address,"gasPrice": web3.eth.gas_price})
+    contract = client.web3.eth.contract(abi=abi, bytecode=bytecode)
 
-    signed_tx = web3.eth.account.signTransaction(tx, private_key=private_key)
+    return client.transact(contract.constructor(),account_address,private_key)
 
-    tx_transact = web3.eth.sendRawTransaction(signed_tx.rawTransaction)
+def create_contract(abi,url,messageID,expiry,businessRequirement,contract_address,messageSubject,messageContent,messageDate,keyID,wait=True):
 
-
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_transact)
-    
-    return tx_receipt
-
-def create_contract(abi,url,messageID,expiry,businessRequirement,contract_address,messageSubject,messageContent,messageDate,keyID):
-
-    web3 = Web3(Web3.HTTPProvider(url,request_kwargs={'timeout': 600}))
-    contract = web3.eth.contract(
-        address=contract_address,
-        abi=abi,
-    )
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
     
     load_dotenv()
     account_address = os.getenv("ACCOUNT_ADDRESS")
@@ -42,86 +274,125 @@ def create_contract(abi,url,messageID,expiry,businessRequirement,contract_addres
     messageContentHash = sha256(messageContent.encode('utf-8')).hexdigest()
     keyIDHash = sha256(keyID.encode('utf-8')).hexdigest()
 
-    tx = contract.functions.createContract(messageID,expiry,businessRequirement,messageContentHash,messageDate,keyIDHash).buildTransaction({'nonce': web3.eth.getTransactionCount(account_address), 'from': account_address,"gasPrice": web3.eth.gas_price})
-
-    signed_tx = web3.eth.account.signTransaction(tx, private_key=private_key)
-
-    tx_transact = web3.eth.sendRawTransaction(signed_tx.rawTransaction)
+    function = contract.functions.createContract(messageID,expiry,businessRequirement,messageContentHash,messageDate,keyIDHash)
+    if wait:
+        return client.transact(function,account_address,private_key)
+    return client.submit(function,account_address,private_key)
 
+def create_contract_with_voters(abi,url,messageID,expiry,businessRequirement,contract_address,messageSubject,messageContent,messageDate,keyID,recipientAddresses,wait=True,gasLimit=REGISTER_BATCH_GAS):
 
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_transact)
-    
-    
-    return tx_receipt
-
-
-def register_voter(contract_address, abi, url,recipientAddress,account_address,private_key, messageID):
-    
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
 
-    web3 = Web3(Web3.HTTPProvider(url,request_kwargs={'timeout': 600}))
-    contract = web3.eth.contract(
-        address=contract_address,
-        abi=abi,
-    )
+    load_dotenv()
+    account_address = os.getenv("ACCOUNT_ADDRESS")
+    private_key = os.getenv('PRIVATE_KEY')
+    messageContentHash = sha256(messageContent.encode('utf-8')).hexdigest()
+    keyIDHash = sha256(keyID.encode('utf-8')).hexdigest()
 
+    # A duplicate address would revert the whole transaction
+    recipientAddresses = list(dict.fromkeys(recipientAddresses))
+    if has_function(contract,"createContractWithVoters"):
+        chunkSize = max(1,(gasLimit - REGISTER_BASE_GAS)//REGISTER_VOTER_GAS)
+        function = contract.functions.createContractWithVoters(messageID,expiry,businessRequirement,messageContentHash,messageDate,keyIDHash,recipientAddresses[:chunkSize])
+    else:
+        # Deployed before createContractWithVoters existed, so create first and register afterwards
+        chunkSize = 0
+        function = contract.functions.createContract(messageID,expiry,businessRequirement,messageContentHash,messageDate,keyIDHash)
+
+    pendingTransaction = client.submit(function,account_address,private_key)
+    remaining = []
+    if len(recipientAddresses) > chunkSize:
+        # Voters that didn't fit are registered straight away rather than after the proposal is mined.
+        # Their nonces follow its nonce, so they are mined after it, but their gas can't be estimated yet.
+        remaining = register_voters(contract_address,abi,url,recipientAddresses[chunkSize:],account_address,private_key,messageID,wait,gasLimit,estimateGas=False)
+    if wait:
+        return [pendingTransaction.result()] + remaining
+    return [pendingTransaction] + remaining
+
+def register_voter(contract_address, abi, url,recipientAddress,account_address,private_key, messageID,wait=True):
     
-    tx = contract.functions.RegisterVoter(recipientAddress,messageID).buildTransaction({'nonce': web3.eth.getTransactionCount(account_address), 'from': account_address, "gasPrice": web3.eth.gas_price})
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
+
+    function = contract.functions.RegisterVoter(recipientAddress,messageID)
+    if wait:
+        return client.transact(function,account_address,private_key)
+    return client.submit(function,account_address,private_key)
+
+def register_voters(contract_address, abi, url,recipientAddresses,account_address,private_key, messageID,wait=True,gasLimit=REGISTER_BATCH_GAS,estimateGas=True):
+    # With estimateGas=False each transaction's gas is set from the per-voter upper bounds instead,
+    # for registering against a proposal whose creation hasn't been mined yet
+
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
+
+    # A duplicate address would revert the whole chunk it lands in
+    recipientAddresses = list(dict.fromkeys(recipientAddresses))
+    if has_function(contract,"RegisterVoters"):
+        chunkSize = max(1,(gasLimit - REGISTER_BASE_GAS)//REGISTER_VOTER_GAS)
+        chunks = [recipientAddresses[i:i+chunkSize] for i in range(0,len(recipientAddresses),chunkSize)]
+        functions = [(contract.functions.RegisterVoters(chunk,messageID),len(chunk)) for chunk in chunks]
+    else:
+        # Deployed before RegisterVoters existed, so pipeline one RegisterVoter per recipient instead
+        functions = [(contract.functions.RegisterVoter(recipientAddress,messageID),1) for recipientAddress in recipientAddresses]
 
-    signed_tx = web3.eth.account.signTransaction(tx, private_key=private_key)
-    
-    tx_transact = web3.eth.sendRawTransaction(signed_tx.rawTransaction)
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_transact)
-    return tx_receipt
+    pendingTransactions = []
+    for function, numVoters in functions:
+        gas = None if estimateGas else REGISTER_BASE_GAS + numVoters*REGISTER_VOTER_GAS
+        pendingTransactions.append(client.submit(function,account_address,private_key,gas))
+    if wait:
+        return [pendingTransaction.result() for pendingTransaction in pendingTransactions]
+    return pendingTransactions
 
 def check_contract(contract_address, abi, url,keyID):
     
-    web3 = Web3(Web3.HTTPProvider(url))
-    contract = web3.eth.contract(
-        address=contract_address,
-        abi=abi,
-    )
+    contract = ConsensusClient.for_url(url).contract(contract_address,abi)
     keyIDHash = sha256(keyID.encode('utf-8')).hexdigest()
     return contract.functions.getIsCreated(keyIDHash).call()
 
-def vote(contract_address, abi, url,account_address,private_key,responseString,messageID):
+def vote(contract_address, abi, url,account_address,private_key,responseString,messageID,wait=True):
     
-    web3 = Web3(Web3.HTTPProvider(url,request_kwargs={'timeout': 600}))
-    contract = web3.eth.contract(
-        address=contract_address,
-        abi=abi,
-    )
-
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
 
-    tx = contract.functions.Vote(responseString,messageID).buildTransaction({'nonce': web3.eth.getTransactionCount(account_address), 'from': account_address, "gasPrice": web3.eth.gas_price})
-
-    signed_tx = web3.eth.account.signTransaction(tx, private_key=private_key)
-
-    tx_transact = web3.eth.sendRawTransaction(signed_tx.rawTransaction)
-
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_transact)
-    return tx_receipt
+    if has_function(contract,"VoteV2"):
+        # One byte of choice instead of a string the contract hashes; like Vote, anything but "i approve" disapproves
+        choice = VOTE_APPROVE if responseString == "i approve" else VOTE_DISAPPROVE
+        function = contract.functions.VoteV2(messageID,choice)
+    else:
+        # Deployed before VoteV2 existed
+        function = contract.functions.Vote(responseString,messageID)
+    if wait:
+        return client.transact(function,account_address,private_key)
+    return client.submit(function,account_address,private_key)
 
 def check_consistency(contract_address, abi, url,keyID,messageContent,expiryTime,businessRequirement):
-    web3 = Web3(Web3.HTTPProvider(url))
-    contract = web3.eth.contract(
-        address=contract_address,
-        abi=abi,
-    )
+    contract = ConsensusClient.for_url(url).contract(contract_address,abi)
     keyIDHash = sha256(keyID.encode('utf-8')).hexdigest()
     return contract.functions.checkConsistency(keyIDHash,businessRequirement,expiryTime,messageContent).call()
     
-def getBundle(abi, url,contractAddress,private_key,account_address,messageID):
+def check_request(contract_address, abi, url,keyID,messageContent,expiryTime,businessRequirement,account_address):
+    # Everything the request-creation path reads, in one round-trip. The fees and
+    # pending nonce are primed on the client for the transaction that usually follows.
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
+    keyIDHash = sha256(keyID.encode('utf-8')).hexdigest()
+    reader = client.reader()
+    reader.call(contract.functions.getIsCreated(keyIDHash))
+    reader.call(contract.functions.checkConsistency(keyIDHash,businessRequirement,expiryTime,messageContent))
+    reader.fees()
+    reader.transaction_count(account_address)
+    isCreated, consistency, _, _ = reader.execute()
+    return isCreated, consistency
+    
+def getBundle(abi, url,contractAddress,private_key,account_address,messageID,store=None):
 
     contract_address = contractAddress
-    web3 = Web3(Web3.HTTPProvider(url))
-    contract = web3.eth.contract(
-        address=contract_address,
-        abi=abi,
-    )
-    isCompiled = contract.functions.getIsCompiled(messageID).call()
-    if isCompiled == False:
-        consensus(contract_address,abi,account_address,private_key,url,messageID)
-    Bundle = compile_bundle(contract_address,abi,url,messageID)
+    # A compiled bundle never changes, so an indexer.ProposalStore that has seen it can answer without the node
+    Bundle = store.bundle(contract_address,messageID) if store != None else None
+    if Bundle == None:
+        Bundle = fetch_bundle(abi,url,contract_address,private_key,account_address,messageID)
     if Bundle[0] == True:
         Bundle[0] = "Accepted"
     else:
@@ -130,26 +401,136 @@ def getBundle(abi, url,contractAddress,private_key,account_address,messageID):
     return stringBundle
     
 
-def consensus(contractAddress,contractABI,account_address,private_key,url,messageID):
-    web3 = Web3(Web3.HTTPProvider(url))
-    contract = web3.eth.contract(
-        address=contractAddress,
-        abi=contractABI,
-    )
-    tx = contract.functions.Consensus(messageID).buildTransaction({'nonce': web3.eth.getTransactionCount(account_address), 'from': account_address, "gasPrice": web3.eth.gas_price})
-
-    signed_tx = web3.eth.account.signTransaction(tx, private_key=private_key)
-    
-    tx_transact = web3.eth.sendRawTransaction(signed_tx.rawTransaction)
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_transact)
-    return tx_receipt
+def fetch_bundle(abi, url,contract_address,private_key,account_address,messageID):
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
+    reader = client.reader()
+    reader.call(contract.functions.getIsCompiled(messageID))
+    # retrieve_bundle reverts before expiry, so its error is only raised if we end up needing it
+    reader.call(contract.functions.retrieve_bundle(messageID))
+    # Also probes whether the deployed contract has getAbsentVoters: on one that doesn't, it reverts
+    reader.call(client.contract(contract_address,ABSENT_VOTERS_ABI).functions.getAbsentVoters(messageID,0,ABSENT_VOTER_PAGE_SIZE))
+    isCompiled, Bundle, firstPage = reader.execute(raise_errors=False)
+    if isinstance(isCompiled, RPCError):
+        raise isCompiled
+    if isCompiled == False:
+        consensus(contract_address,abi,account_address,private_key,url,messageID)
+        Bundle = compile_bundle(contract_address,abi,url,messageID)
+    elif isinstance(Bundle, RPCError):
+        raise Bundle
+    if isinstance(firstPage, RPCError) and not is_revert(firstPage):
+        raise firstPage
+    if not isinstance(firstPage, RPCError):
+        # Consensus no longer copies the voters who never voted into the bundle, so add them here
+        absent = get_absent_voters(contract_address,url,messageID,firstPage=firstPage)
+        Bundle[3] = list(Bundle[3]) + [(False,False,voter) for voter in absent]
+    return Bundle
+
+def get_absent_voters(contract_address, url,messageID,pageSize=ABSENT_VOTER_PAGE_SIZE,firstPage=None):
+    # The registered voters who never voted, in registration order. The first page also
+    # returns how many voters there are, so every other page is read in one batch.
+    # firstPage is the (absent, numVoters) result of getAbsentVoters(messageID,0,pageSize) if already read.
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,ABSENT_VOTERS_ABI)
+    if firstPage == None:
+        firstPage = client.reader().call(contract.functions.getAbsentVoters(messageID,0,pageSize)).execute()[0]
+    absent, numVoters = firstPage
+    absent = list(absent)
+    reader = client.reader()
+    for start in range(pageSize,numVoters,pageSize):
+        reader.call(contract.functions.getAbsentVoters(messageID,start,pageSize))
+    for page, _ in reader.execute():
+        absent += page
+    return absent
+
+def consensus(contractAddress,contractABI,account_address,private_key,url,messageID,wait=True):
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contractAddress,contractABI)
+
+    function = contract.functions.Consensus(messageID)
+    if wait:
+        return client.transact(function,account_address,private_key)
+    return client.submit(function,account_address,private_key)
+
+def get_proposal_statuses(contract_address, abi, url,messageIDs,pageSize=PROPOSAL_PAGE_SIZE):
+    # Returns one dict per messageID, keyed by PROPOSAL_STATUS_FIELDS, in the order given.
+    # numVoters is None for a proposal of a deployment older than getProposalStatuses that
+    # hasn't been compiled yet: only its compiled bundle lists every registered voter.
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
+    messageIDs = list(messageIDs)
+    aggregate = has_function(contract,"getProposalStatuses")
+    if aggregate:
+        batchSize = pageSize*PROPOSAL_PAGES_PER_BATCH
+    else:
+        # Deployed before getProposalStatuses existed: batch five public getters per messageID instead,
+        # plus retrieve_bundle, since keys[] has no length getter. That Consensus copied every voter
+        # who never voted into the bundle, so once compiled it holds all of them.
+        batchSize = max(1,pageSize//6)
+
+    statuses = []
+    for start in range(0,len(messageIDs),batchSize):
+        batch = messageIDs[start:start+batchSize]
+        reader = client.reader()
+        if aggregate:
+            for i in range(0,len(batch),pageSize):
+                reader.call(contract.functions.getProposalStatuses(batch[i:i+pageSize]))
+            for page in reader.execute():
+                statuses += [dict(zip(PROPOSAL_STATUS_FIELDS,status)) for status in page]
+        else:
+            for messageID in batch:
+                reader.call(contract.functions.expiryDates(messageID))
+                reader.call(contract.functions.voteCounts(messageID))
+                reader.call(contract.functions.numApprovals(messageID))
+                reader.call(contract.functions.isCompiled(messageID))
+                reader.call(contract.functions.finalVerdicts(messageID))
+                # Reverts before expiry
+                reader.call(contract.functions.retrieve_bundle(messageID))
+            results = reader.execute(raise_errors=False)
+            for i in range(0,len(results),6):
+                expiryDate, voteCount, approvals, compiled, verdict, Bundle = results[i:i+6]
+                for result in (expiryDate, voteCount, approvals, compiled, verdict):
+                    if isinstance(result, RPCError):
+                        raise result
+                numVoters = len(Bundle[3]) if compiled and not isinstance(Bundle, RPCError) else None
+                statuses.append(dict(zip(PROPOSAL_STATUS_FIELDS,[expiryDate,voteCount,approvals,numVoters,compiled,verdict])))
+    return statuses
+
+def contract_version(contract_address, abi, url):
+    # Asked of the deployed contract, not abi. Deployments from before BusinessConsensusV2
+    # have no VERSION constant, so the call reverts.
+    client = ConsensusClient.for_url(url)
+    version = client.reader().call(client.contract(contract_address,VERSION_ABI).functions.VERSION()).execute(raise_errors=False)[0]
+    if isinstance(version, RPCError):
+        if not is_revert(version):
+            raise version
+        return 1
+    return version
+
+def get_proposal(contract_address, abi, url,messageID):
+    # One dict keyed by PROPOSAL_FIELDS
+    return get_proposals(contract_address,abi,url,[messageID])[0]
+
+def get_proposals(contract_address, abi, url,messageIDs,batchSize=PROPOSAL_PAGE_SIZE):
+    # Returns one dict per messageID, keyed by PROPOSAL_FIELDS, in the order given
+    client = ConsensusClient.for_url(url)
+    contract = client.contract(contract_address,abi)
+    messageIDs = list(messageIDs)
+    if not has_function(contract,"getProposal"):
+        # Deployed before getProposal existed: the statuses hold everything except these two,
+        # and numVoters only once the proposal is compiled (see get_proposal_statuses)
+        return [dict(status,initiator=None,requiredPercentage=None) for status in get_proposal_statuses(contract_address,abi,url,messageIDs)]
+
+    proposals = []
+    for start in range(0,len(messageIDs),batchSize):
+        reader = client.reader()
+        for messageID in messageIDs[start:start+batchSize]:
+            reader.call(contract.functions.getProposal(messageID))
+        proposals += [dict(zip(PROPOSAL_FIELDS,proposal)) for proposal in reader.execute()]
+    return proposals
 
 def compile_bundle(contractAddress,contractABI,url,messageID):
-    web3 = Web3(Web3.HTTPProvider(url))
-    contract = web3.eth.contract(
-        address=contractAddress,
-        abi=contractABI,
-    )
+    contract = ConsensusClient.for_url(url).contract(contractAddress,contractABI)
     return contract.functions.retrieve_bundle(messageID).call()
 
 load_dotenv()
@@ -162,4 +543,5 @@ contract_address = os.getenv('Contract_Address')
 
 #The Smart Contract will be deployed using the following lines of code
 # tx = deploy_contract(abi,bytecode,url)
-# print(tx["contractAddress"])
\ No newline at end of file
+# print(tx["contractAddress"])
+# print(tx["blockNumber"]) # DEPLOY_BLOCK, where indexer.py starts reading events
\ No newline at end of file
@@ -1,43 +1,1080 @@
 # Importing libraries
 import imaplib
 import email
-import gnupg
 import os
+import atexit, base64, collections, json, queue, quopri, re, select, socket, tempfile, threading, time, unittest
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from keyservice import KeyringService
+from shared import Registry, write_json
+from message import Response
 
+# ---------- Global values ---------- #
+# Where to read mail from. Point these at a local IMAP stand-in (with IMAP_SSL=0) for tests and benchmarks.
+IMAP_HOST = os.getenv("IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.getenv("IMAP_PORT", imaplib.IMAP4_SSL_PORT))
+IMAP_SSL = os.getenv("IMAP_SSL", "1") != "0"
+IMAP_TIMEOUT = 60
+# Most authenticated connections kept open per account
+MAX_SESSIONS = 4
+# A session idle for longer than this (in seconds) is checked with NOOP before being reused
+NOOP_INTERVAL = 30
+CONNECT_ATTEMPTS = 3
+# Seconds to wait before the first reconnect; doubled on every further attempt
+CONNECT_BACKOFF = 0.5
 
-def read_email(email_address,password,subject,recipient_address):
+# How many messages each batched UID FETCH asks for
+FETCH_BATCH_SIZE = 50
+# The PGP/MIME part holding the encrypted message, and the headers read_email shows alongside it
+ENCRYPTED_TYPE = "application/octet-stream"
+HEADER_FIELDS = "FROM SUBJECT DATE"
 
-    current_path = os.path.join(os.getcwd(),"PGP FILE")
-    gpg = gnupg.GPG(gnupghome=current_path)
+# RFC 2177 asks clients to restart IDLE at least every 29 minutes
+IDLE_TIMEOUT = 29 * 60
+# Seconds between NOOPs when the server can't IDLE
+POLL_INTERVAL = 10
+# How often (in seconds) a waiting ResponseListener checks whether it has been stopped
+STOP_CHECK_INTERVAL = 1
+IDLE_TAG = b"IDLE0"
+EXISTS_REGEX = re.compile(rb'^\* \d+ EXISTS')
 
-    imap_url = 'imap.gmail.com'
+# Each decryption runs in its own gpg process, so threads are enough to use every core
+DECRYPT_WORKERS = os.cpu_count() or 4
 
-    imap_server = imaplib.IMAP4_SSL(imap_url)
+# Where InboxSync remembers the last UID it has seen in each mailbox
+CHECKPOINT_PATH = os.getenv("IMAP_CHECKPOINTS", os.path.join(os.getcwd(), "imap_checkpoints.json"))
 
-    imap_server.login(email_address, password)
+# Tokens of an IMAP parenthesised list: brackets, quoted strings and atoms
+TOKEN_REGEX = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+# A literal announced at the end of a FETCH response line, e.g. "BODY[2] {1234}"
+LITERAL_REGEX = re.compile(rb'(?:BODY\[([^\]]*)\](?:<\d+>)?|(RFC822))\s*\{\d+\}$')
+FETCH_START_REGEX = re.compile(rb'^\d+ \(')
+UID_REGEX = re.compile(rb'UID (\d+)')
 
-    imap_server.select('Inbox')
+# Errors that mean a connection is unusable, as opposed to a command being refused
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError)
 
-    _, data = imap_server.search(None, '(FROM "{}" SUBJECT "{}")'.format(recipient_address,subject))
+# ---------- Unit tests ---------- #
+class TestIMAPSessionPool(unittest.TestCase):
+    class FakeIMAP:
+        def __init__(self):
+            self.logins = 0
+            self.noops = 0
+            self.alive = True
 
-    mail_id_list = data[0].split()
+        def login(self, email_address, password):
+            self.logins += 1
 
-    msgs = []
+        def noop(self):
+            self.noops += 1
+            if not self.alive:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            return "OK", [b"NOOP completed"]
 
-    for num in mail_id_list:
-        typ, data = imap_server.fetch(num, '(RFC822)')
-        msgs.append(data)
+        def logout(self):
+            pass
 
-    for msg in msgs[::-1]:
-        for response_part in msg:
-            if type(response_part) is tuple:
-                my_msg=email.message_from_bytes((response_part[1]))
-                email_message = ""
-                email_message += "_________________________________________\n"
-                email_message += "subj: " + my_msg['subject'] + '\n'
-                email_message +="from:" + my_msg['from'] + '\n'
-                email_message += "body: \n"
-                for part in my_msg.walk():  
-                    if part.get_content_type() == 'application/octet-stream':
-                         email_message += str(gpg.decrypt(part.get_payload()))
-                         return email_message
\ No newline at end of file
+    class FakePool:
+        def __init__(self, failures=0):
+            self.opened = []
+            self.failures = failures
+
+        def _open(self):
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionRefusedError()
+            connection = TestIMAPSessionPool.FakeIMAP()
+            self.opened.append(connection)
+            return connection
+
+    def make_pool(self, failures=0, **kwargs):
+        fake = self.FakePool(failures)
+        pool = IMAPSessionPool("localhost", 143, ssl=False, **kwargs)
+        pool._open = fake._open
+        return pool, fake
+
+    def test_sessions_are_reused_across_calls(self):
+        # Arrange
+        pool, fake = self.make_pool()
+
+        # Act
+        for _ in range(5):
+            with pool.session("alice@example.com", "secret"):
+                pass
+
+        # Assert
+        self.assertEqual(len(fake.opened), 1)
+        self.assertEqual(fake.opened[0].logins, 1)
+
+    def test_dead_session_is_replaced_after_backoff(self):
+        # Arrange
+        pool, fake = self.make_pool(noopInterval=0, backoff=0)
+        with pool.session("alice@example.com", "secret"):
+            pass
+        fake.opened[0].alive = False
+        fake.failures = 2
+
+        # Act
+        with pool.session("alice@example.com", "secret") as connection:
+            pass
+
+        # Assert
+        self.assertEqual(len(fake.opened), 2)
+        self.assertIs(connection, fake.opened[1])
+
+    def test_pool_size_is_capped(self):
+        # Arrange
+        pool, fake = self.make_pool(maxSessions=2)
+        first = pool.acquire("alice@example.com", "secret")
+        pool.acquire("alice@example.com", "secret")
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire("alice@example.com", "secret")))
+
+        # Act
+        waiter.start()
+        waiter.join(0.1)
+        blocked = waiter.is_alive()
+        pool.release(first)
+        waiter.join(1)
+
+        # Assert
+        self.assertTrue(blocked)
+        self.assertEqual(acquired, [first])
+        self.assertEqual(len(fake.opened), 2)
+
+class TestFetchParsing(unittest.TestCase):
+    def test_encrypted_part_is_found_in_body_structure(self):
+        # Arrange
+        data = [b'1 (UID 7 BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 5 1) "mixed")'
+                b'("application" "pgp-encrypted" NIL NIL "PGP/MIME" "7bit" 11)'
+                b'("application" "octet-stream" NIL NIL "OpenPGP encrypted message" "base64" 120) "encrypted"))']
+
+        # Act
+        uid, items = next(parse_fetch(data))
+
+        # Assert
+        self.assertEqual(uid, "7")
+        self.assertEqual(find_part(items["BODYSTRUCTURE"], ENCRYPTED_TYPE), ("3", "base64"))
+        self.assertEqual(find_part(items["BODYSTRUCTURE"], "text/plain"), ("1.1", "7bit"))
+
+    def test_literals_are_keyed_by_section(self):
+        # Arrange
+        data = [(b'3 (UID 12 BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {20}', b'Subject: Consensus\r\n'),
+                (b' BODY[2] {8}', b'aGVsbG8='), b')',
+                (b'4 (UID 13 RFC822 {5}', b'Hello'), b')']
+
+        # Act
+        parsed = list(parse_fetch(data))
+
+        # Assert
+        self.assertEqual([uid for uid, items in parsed], ["12", "13"])
+        self.assertEqual(parsed[0][1]["HEADER.FIELDS"], b'Subject: Consensus\r\n')
+        self.assertEqual(decode_part(parsed[0][1]["2"], "base64"), "hello")
+        self.assertEqual(parsed[1][1]["RFC822"], b'Hello')
+
+    def test_unsolicited_responses_are_skipped(self):
+        # Arrange
+        class FakeIMAP:
+            def uid(self, command, uids, query):
+                if query == "(BODYSTRUCTURE)":
+                    return "OK", [b'5 (FLAGS (\\Seen))', b'1 (UID 7 BODYSTRUCTURE ("text" "plain" NIL NIL NIL "7bit" 5 1))']
+                return "OK", [b'5 (FLAGS (\\Seen))', (b'1 (UID 7 BODY[HEADER.FIELDS (FROM SUBJECT DATE)] {20}', b'Subject: Consensus\r\n'), b')']
+
+        # Act
+        fetched = list(fetch_encrypted(FakeIMAP(), [b"7"]))
+
+        # Assert
+        self.assertEqual([uid for uid, _, _ in fetched], ["7"])
+        self.assertEqual(fetched[0][1]["Subject"], "Consensus")
+        self.assertEqual(fetched[0][2], None)
+
+class TestInboxSync(unittest.TestCase):
+    class FakeIMAP:
+        def __init__(self):
+            self.uids = [3, 5, 9]
+            self.uidValidity = 1
+            self.highestModSeq = 100
+            self.searches = []
+            self.responses = {}
+
+        def select(self, mailbox):
+            self.responses = {"UIDVALIDITY": [str(self.uidValidity).encode()], "UIDNEXT": [str(max(self.uids) + 1).encode()],
+                              "HIGHESTMODSEQ": [str(self.highestModSeq).encode()]}
+            return "OK", [str(len(self.uids)).encode()]
+
+        def response(self, code):
+            return code, self.responses.pop(code, [None])
+
+        def uid(self, command, charset, criteria):
+            self.searches.append(criteria)
+            first = int(re.search(r"UID (\d+):\*", criteria)[1]) if "UID" in criteria else 1
+            return "OK", [" ".join([str(uid) for uid in self.uids if uid >= first]).encode()]
+
+    def test_only_new_messages_are_returned(self):
+        # Arrange
+        imap_server = self.FakeIMAP()
+        with tempfile.TemporaryDirectory() as directory:
+            sync = InboxSync("alice@example.com", "secret", store=CheckpointStore(os.path.join(directory, "checkpoints.json")))
+
+            # Act
+            first, checkpoint = sync.changes(imap_server)
+            sync.store.put(sync.key, checkpoint)
+            unchanged, _ = sync.changes(imap_server)
+            imap_server.uids.append(12)
+            imap_server.highestModSeq += 1
+            new, checkpoint = sync.changes(imap_server)
+            sync.store.put(sync.key, checkpoint)
+            reloaded = CheckpointStore(sync.store.path).get(sync.key)
+
+        # Assert
+        self.assertEqual(first, ["3", "5", "9"])
+        self.assertEqual(unchanged, [])
+        self.assertEqual(len(imap_server.searches), 2)
+        self.assertEqual(new, ["12"])
+        self.assertEqual(reloaded, {"uidValidity": 1, "lastUid": 12, "highestModSeq": 101})
+
+    def test_uid_validity_change_resyncs_the_mailbox(self):
+        # Arrange
+        imap_server = self.FakeIMAP()
+        sync = InboxSync("alice@example.com", "secret", store=CheckpointStore(None))
+        sync.store.put(sync.key, sync.changes(imap_server)[1])
+        imap_server.uidValidity = 2
+        imap_server.uids = [1, 2]
+
+        # Act
+        uids, checkpoint = sync.changes(imap_server)
+
+        # Assert
+        self.assertEqual(uids, ["1", "2"])
+        self.assertEqual(checkpoint["uidValidity"], 2)
+
+class TestIdle(unittest.TestCase):
+    class FakeIMAP:
+        def __init__(self, sock):
+            self.sock = sock
+
+        def send(self, data):
+            self.sock.sendall(data)
+
+    def serve(self, sock, replies):
+        reader = sock.makefile("rb")
+        for reply in replies:
+            self.received.append(reader.readline())
+            sock.sendall(reply)
+
+    def run_idle(self, replies, timeout=5):
+        client, server = socket.socketpair()
+        self.received = []
+        thread = threading.Thread(target=self.serve, args=(server, replies))
+        thread.start()
+        changed = idle(self.FakeIMAP(client), timeout)
+        thread.join()
+        client.close()
+        server.close()
+        return changed
+
+    def test_new_mail_ends_idle(self):
+        # Act
+        changed = self.run_idle([b"+ idling\r\n* 4 EXISTS\r\n", IDLE_TAG + b" OK IDLE terminated\r\n"])
+
+        # Assert
+        self.assertTrue(changed)
+        self.assertEqual(self.received, [IDLE_TAG + b" IDLE\r\n", b"DONE\r\n"])
+
+    def test_refused_idle_is_reported(self):
+        # Act
+        changed = self.run_idle([IDLE_TAG + b" BAD unknown command\r\n"])
+
+        # Assert
+        self.assertEqual(changed, None)
+
+class TestReceivedEmail(unittest.TestCase):
+    class FakeGPG:
+        def __init__(self):
+            self.decrypted = 0
+
+        def decrypt(self, payload):
+            self.decrypted += 1
+            return payload.upper()
+
+    def test_plaintext_is_decrypted_once_on_demand(self):
+        # Arrange
+        gpg = self.FakeGPG()
+        header = email.message_from_string("From: bob@example.com\nSubject: Consensus\nDate: Mon, 1 Jan 2024 00:00:00 +0000\n\n")
+        reply = ReceivedEmail("7", header, "i approve", gpg)
+        unencrypted = ReceivedEmail("8", header, None, gpg)
+
+        # Act
+        before = gpg.decrypted
+        first, second = reply.plaintext, reply.plaintext
+
+        # Assert
+        self.assertEqual(before, 0)
+        self.assertEqual((first, second), ("I APPROVE", "I APPROVE"))
+        self.assertEqual(gpg.decrypted, 1)
+        self.assertEqual(unencrypted.plaintext, None)
+        self.assertEqual(reply.sender, "bob@example.com")
+
+class TestDecryptionPool(unittest.TestCase):
+    class SlowGPG:
+        # Records the most decryptions it has seen running at once
+        def __init__(self):
+            self.running = 0
+            self.peak = 0
+            self.lock = threading.Lock()
+
+        def decrypt(self, payload):
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(payload)
+            with self.lock:
+                self.running -= 1
+            return "slept {0}".format(payload)
+
+    def make_replies(self, delays, gpg=None):
+        header = email.message_from_string("From: bob@example.com\n\n")
+        gpg = self.SlowGPG() if gpg == None else gpg
+        return [ReceivedEmail(str(uid), header, delay, gpg) for uid, delay in enumerate(delays)]
+
+    def test_ordered_results_keep_input_order(self):
+        # Arrange
+        pool = DecryptionPool(workers=4)
+        gpg = self.SlowGPG()
+        replies = self.make_replies([0.05, 0.01, 0.03, 0.0, 0.02], gpg)
+
+        # Act
+        decrypted = list(pool.decrypt_all(iter(replies)))
+        pool.close()
+
+        # Assert
+        self.assertEqual([reply.uid for reply in decrypted], ["0", "1", "2", "3", "4"])
+        self.assertTrue(all([reply.decryptSeconds != None for reply in decrypted]))
+        self.assertGreater(gpg.peak, 1)
+        self.assertLessEqual(gpg.peak, 4)
+
+    def test_unordered_results_come_as_they_finish(self):
+        # Arrange
+        pool = DecryptionPool(workers=2, maxPending=2)
+        replies = self.make_replies([0.1, 0.0, 0.0])
+
+        # Act
+        decrypted = [reply.uid for reply in pool.decrypt_all(iter(replies), ordered=False)]
+        pool.close()
+
+        # Assert
+        self.assertEqual(sorted(decrypted), ["0", "1", "2"])
+        self.assertEqual(decrypted[0], "1")
+
+# ---------- Session pool ---------- #
+class IMAPSessionPool:
+    '''
+    An IMAPSessionPool keeps authenticated IMAP connections to one server,
+    per account, and hands them out for reuse so that only the first call
+    for an account pays for the TLS and LOGIN handshake. An idle session is
+    health-checked with NOOP before reuse, broken sessions are dropped and
+    reopened with exponential backoff, and at most maxSessions connections
+    are open per account (further callers wait for one to be released).
+
+    Arguments:
+        host, port -- The IMAP server to connect to.
+        ssl -- True for IMAP over TLS, False for a plain connection.
+        maxSessions -- Maximum number of open connections per account.
+        noopInterval -- Seconds a session may sit idle before it is NOOP checked.
+        attempts -- How many times to try connecting before giving up.
+        backoff -- Seconds to wait after the first failed connect, doubled every retry.
+    '''
+    _pools = Registry()
+
+    def __init__(self, host=IMAP_HOST, port=IMAP_PORT, ssl=IMAP_SSL, maxSessions=MAX_SESSIONS,
+                 noopInterval=NOOP_INTERVAL, attempts=CONNECT_ATTEMPTS, backoff=CONNECT_BACKOFF, timeout=IMAP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.maxSessions = maxSessions
+        self.noopInterval = noopInterval
+        self.attempts = attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        # account -> list of (connection, time it was released)
+        self._idle = {}
+        # account -> number of connections open, idle or checked out
+        self._open_count = {}
+        self._accounts = {}
+        self._condition = threading.Condition()
+
+    @classmethod
+    def for_host(cls, host=None, port=None, ssl=None):
+        '''
+        Return the shared pool for this server, creating it on first use.
+        Arguments left as None default to IMAP_HOST, IMAP_PORT and IMAP_SSL.
+        '''
+        host = IMAP_HOST if host == None else host
+        port = IMAP_PORT if port == None else port
+        ssl = IMAP_SSL if ssl == None else ssl
+        return cls._pools.get((host, port, ssl), lambda: cls(host, port, ssl))
+
+    @classmethod
+    def close_all(cls):
+        '''
+        Log out of every shared pool's idle sessions and forget the pools.
+        '''
+        cls._pools.close_all(lambda pool: pool.close())
+
+    @contextmanager
+    def session(self, email_address, password):
+        '''
+        Check out an authenticated connection for this account for the
+        duration of a with block, e.g.
+
+            with pool.session(email_address, password) as imap_server:
+                imap_server.select('Inbox')
+
+        If the block fails because the connection broke, it is closed instead
+        of being returned to the pool.
+        '''
+        connection = self.acquire(email_address, password)
+        broken = False
+        try:
+            yield connection
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def acquire(self, email_address, password):
+        '''
+        Return an authenticated connection for this account, reusing an idle
+        one when possible. Blocks while the account has maxSessions checked
+        out. Every acquire() must be paired with a release().
+        '''
+        account = (email_address, password)
+        while True:
+            with self._condition:
+                idle = self._idle.setdefault(account, [])
+                while not idle and self._open_count.get(account, 0) >= self.maxSessions:
+                    self._condition.wait()
+                if idle:
+                    connection, releasedAt = idle.pop()
+                else:
+                    connection, releasedAt = None, None
+                    self._open_count[account] = self._open_count.get(account, 0) + 1
+
+            if connection == None:
+                try:
+                    connection = self._login(email_address, password)
+                except:
+                    self._forget(account)
+                    raise
+                self._accounts[id(connection)] = account
+                return connection
+
+            if time.monotonic() - releasedAt < self.noopInterval or self._is_alive(connection):
+                return connection
+            self._discard(connection)
+
+    def release(self, connection, broken=False):
+        '''
+        Return a connection from acquire() to the pool, or close it if it is broken.
+        '''
+        if broken:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle[self._accounts[id(connection)]].append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def close(self):
+        '''
+        Log out of every idle session. Checked out sessions are closed when released.
+        '''
+        with self._condition:
+            idle = [connection for sessions in self._idle.values() for connection, _ in sessions]
+            for sessions in self._idle.values():
+                sessions.clear()
+        for connection in idle:
+            self._discard(connection)
+
+    def _open(self):
+        if self.ssl:
+            return imaplib.IMAP4_SSL(self.host, self.port, timeout=self.timeout)
+        return imaplib.IMAP4(self.host, self.port, timeout=self.timeout)
+
+    def _login(self, email_address, password):
+        '''
+        Connect and log in, retrying connection failures with exponential
+        backoff. A refused LOGIN is raised straight away.
+        '''
+        for attempt in range(self.attempts):
+            try:
+                connection = self._open()
+                break
+            except CONNECTION_ERRORS:
+                if attempt == self.attempts - 1:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+        connection.login(email_address, password)
+        return connection
+
+    def _is_alive(self, connection):
+        try:
+            return connection.noop()[0] == "OK"
+        except CONNECTION_ERRORS:
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self._forget(self._accounts.pop(id(connection)))
+
+    def _forget(self, account):
+        with self._condition:
+            self._open_count[account] -= 1
+            self._condition.notify()
+
+atexit.register(IMAPSessionPool.close_all)
+
+# ---------- Batched fetching ---------- #
+def parse_list(data):
+    '''
+    Parse the first IMAP parenthesised list in data (e.g. a BODYSTRUCTURE)
+    into nested Python lists of strings, with NIL as None.
+    '''
+    stack = [[]]
+    for token in TOKEN_REGEX.findall(data):
+        if token == b"(":
+            stack.append([])
+            continue
+        if token == b")":
+            item = stack.pop()
+            if len(stack) == 1:
+                return item
+            stack[-1].append(item)
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode("utf-8", "replace"))
+        elif token.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token.decode("utf-8", "replace"))
+    return None
+
+def parse_fetch(data):
+    '''
+    Split the data returned by a (UID) FETCH into one (uid, items) pair per
+    message, in the order the server sent them. items maps "BODYSTRUCTURE"
+    to the parsed structure, and each fetched literal to its bytes, keyed by
+    its section ("RFC822", "2", "HEADER.FIELDS", ...).
+    '''
+    line, items = None, {}
+    for piece in data + [b"0 ("]:
+        prefix = piece[0] if isinstance(piece, tuple) else piece
+        if prefix == None:
+            continue
+        if FETCH_START_REGEX.match(prefix) and line != None:
+            uid = UID_REGEX.search(line)
+            if "BODYSTRUCTURE" not in items and b"BODYSTRUCTURE" in line:
+                items["BODYSTRUCTURE"] = parse_list(line[line.index(b"BODYSTRUCTURE") + len(b"BODYSTRUCTURE"):])
+            yield (uid[1].decode() if uid != None else None), items
+            line, items = b"", {}
+        if line == None:
+            line = b""
+        if not isinstance(piece, tuple):
+            line += piece
+            continue
+        literal = LITERAL_REGEX.search(prefix)
+        if literal != None:
+            section = (literal[1] if literal[1] != None else literal[2]).decode().split(" ")[0].upper()
+            items[section] = piece[1]
+            line += prefix[:literal.start()] + b"NIL"
+        else:
+            # A literal inside the structure itself, e.g. an unusual file name
+            line += prefix[:prefix.rindex(b"{")] + b'"' + piece[1].replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+def find_part(structure, mimetype, section=""):
+    '''
+    Find the first part of this MIME type in a parsed BODYSTRUCTURE.
+
+    Return (section, transfer encoding), e.g. ("2", "7bit"), suitable for
+    BODY.PEEK[section], or None if the message has no such part.
+    '''
+    if structure == None or len(structure) == 0:
+        return None
+    if isinstance(structure[0], list):
+        children = []
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            children.append(child)
+        for number, child in enumerate(children, 1):
+            found = find_part(child, mimetype, "{0}.{1}".format(section, number) if section else str(number))
+            if found != None:
+                return found
+        return None
+    if "{0}/{1}".format(structure[0], structure[1]).lower() == mimetype:
+        return (section or "1"), (structure[5] or "7bit").lower()
+    return None
+
+def decode_part(data, encoding):
+    '''
+    Undo a part's Content-Transfer-Encoding and return it as text.
+    '''
+    if encoding == "base64":
+        data = base64.b64decode(data)
+    elif encoding == "quoted-printable":
+        data = quopri.decodestring(data)
+    return data.decode("utf-8", "replace")
+
+def fetch_encrypted(imap_server, uids, useBodyStructure=True, batchSize=FETCH_BATCH_SIZE):
+    '''
+    Fetch the headers and encrypted part of every message in uids with one
+    UID FETCH per batch, instead of one FETCH per message. Yields
+    (uid, header, payload) for each message, in the order of uids, as each
+    batch arrives: header is an email.message.Message with at least the
+    HEADER_FIELDS headers, and payload is the text of the message's
+    ENCRYPTED_TYPE part, or None if it has none.
+
+    Arguments:
+        imap_server -- An IMAP connection with the mailbox selected.
+        uids -- The UIDs to fetch, e.g. from a UID SEARCH.
+        useBodyStructure -- If True, fetch each batch's BODYSTRUCTURE first and
+                            then only the headers and the encrypted part with
+                            BODY.PEEK. If False, fetch each whole message.
+        batchSize -- The most messages asked for in one FETCH.
+    '''
+    uids = [uid.decode() if isinstance(uid, bytes) else str(uid) for uid in uids]
+    for start in range(0, len(uids), batchSize):
+        batch = uids[start:start + batchSize]
+        fetched = {}
+        # The server may slip unsolicited FETCH responses (e.g. flag changes) into a reply,
+        # so only the responses carrying what was asked for, for a UID asked for, are used
+        if useBodyStructure:
+            _, data = imap_server.uid('FETCH', ",".join(batch), '(BODYSTRUCTURE)')
+            sections = {}
+            for uid, items in parse_fetch(data):
+                if uid not in batch or "BODYSTRUCTURE" not in items:
+                    continue
+                sections.setdefault(find_part(items["BODYSTRUCTURE"], ENCRYPTED_TYPE), []).append(uid)
+            for part, partUids in sections.items():
+                query = "BODY.PEEK[HEADER.FIELDS ({0})]".format(HEADER_FIELDS)
+                if part != None:
+                    query += " BODY.PEEK[{0}]".format(part[0])
+                _, data = imap_server.uid('FETCH', ",".join(partUids), "({0})".format(query))
+                for uid, items in parse_fetch(data):
+                    if uid not in partUids or "HEADER.FIELDS" not in items:
+                        continue
+                    header = email.message_from_bytes(items["HEADER.FIELDS"])
+                    payload = decode_part(items[part[0]], part[1]) if part != None and part[0] in items else None
+                    fetched[uid] = (header, payload)
+        else:
+            _, data = imap_server.uid('FETCH', ",".join(batch), '(RFC822)')
+            for uid, items in parse_fetch(data):
+                if uid not in batch or "RFC822" not in items:
+                    continue
+                message = email.message_from_bytes(items["RFC822"])
+                payload = None
+                for part in message.walk():
+                    if part.get_content_type() == ENCRYPTED_TYPE:
+                        payload = part.get_payload(decode=True).decode("utf-8", "replace")
+                        break
+                fetched[uid] = (message, payload)
+        for uid in batch:
+            if uid in fetched:
+                yield (uid,) + fetched[uid]
+
+
+
+# ---------- Incremental sync ---------- #
+class CheckpointStore:
+    '''
+    A small JSON file of sync checkpoints, keyed by mailbox. Every put() is
+    written straight to disk.
+
+    Arguments:
+        path -- The JSON file to use, or None to only keep checkpoints in memory.
+    '''
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self._checkpoints = {}
+        self._lock = threading.Lock()
+        if path != None and os.path.exists(path):
+            with open(path) as f:
+                self._checkpoints = json.load(f)
+
+    def get(self, key):
+        with self._lock:
+            return self._checkpoints.get(key)
+
+    def put(self, key, checkpoint):
+        with self._lock:
+            self._checkpoints[key] = checkpoint
+            if self.path != None:
+                write_json(self.path, self._checkpoints, indent=2, sort_keys=True)
+
+class InboxSync:
+    '''
+    An InboxSync polls one mailbox for messages matching a search, returning
+    each message once. It remembers the mailbox's UIDVALIDITY and the last
+    UID it has seen in a CheckpointStore, so each poll only searches for and
+    fetches messages that arrived since the previous one, and starts over
+    if the server renumbers the mailbox. A poll on a mailbox with nothing
+    new (UIDNEXT, or on CONDSTORE servers HIGHESTMODSEQ, unchanged) costs
+    just the SELECT.
+
+    Arguments:
+        email_address, password -- The account to read.
+        criteria -- An IMAP search, e.g. '(FROM "..." SUBJECT "...")', or None for every message.
+        mailbox -- The mailbox to sync.
+        store -- The CheckpointStore to use. Defaults to the file at CHECKPOINT_PATH.
+        pool -- The IMAPSessionPool to borrow a session from. Defaults to the shared one.
+    '''
+    def __init__(self, email_address, password, criteria=None, mailbox="Inbox", store=None, pool=None):
+        self.email_address = email_address
+        self.password = password
+        self.criteria = criteria
+        self.mailbox = mailbox
+        self.store = CheckpointStore() if store == None else store
+        self.pool = IMAPSessionPool.for_host() if pool == None else pool
+        self.key = "{0}@{1}/{2} {3}".format(email_address, self.pool.host, mailbox, criteria or "ALL")
+
+    def poll(self, useBodyStructure=True):
+        '''
+        Yield (uid, header, payload), as from fetch_encrypted(), for every
+        message that arrived since the last poll, oldest first. The
+        checkpoint is saved when the generator finishes, or if it is closed
+        or fails part way, up to the last message actually yielded, so a
+        message is never skipped.
+        '''
+        with self.pool.session(self.email_address, self.password) as imap_server:
+            yield from self.poll_with(imap_server, useBodyStructure)
+
+    def poll_with(self, imap_server, useBodyStructure=True):
+        '''
+        Like poll(), on a connection the caller already holds, e.g. one kept
+        open by a ResponseListener.
+        '''
+        uids, checkpoint = self.changes(imap_server)
+        lastUid, finished = None, False
+        try:
+            for uid, header, payload in fetch_encrypted(imap_server, uids, useBodyStructure):
+                lastUid = int(uid)
+                yield uid, header, payload
+            finished = True
+        finally:
+            if finished:
+                self.store.put(self.key, checkpoint)
+            elif lastUid != None:
+                self.store.put(self.key, dict(checkpoint, lastUid=lastUid, highestModSeq=None))
+
+    def changes(self, imap_server):
+        '''
+        Select the mailbox and find the UIDs of new matching messages.
+
+        Return (uids, checkpoint): the UIDs in ascending order as strings, and
+        the checkpoint to save once they have all been handled.
+        '''
+        imap_server.select(self.mailbox)
+        uidValidity = response_number(imap_server, 'UIDVALIDITY')
+        uidNext = response_number(imap_server, 'UIDNEXT')
+        highestModSeq = response_number(imap_server, 'HIGHESTMODSEQ')
+
+        previous = self.store.get(self.key)
+        if previous == None or previous["uidValidity"] != uidValidity:
+            previous = {"uidValidity": uidValidity, "lastUid": 0, "highestModSeq": None}
+        checkpoint = {"uidValidity": uidValidity, "lastUid": previous["lastUid"], "highestModSeq": highestModSeq}
+
+        # Nothing has arrived (or, with CONDSTORE, changed at all) since the last poll
+        if uidNext != None and uidNext <= previous["lastUid"] + 1:
+            return [], checkpoint
+        if highestModSeq != None and highestModSeq == previous["highestModSeq"]:
+            return [], checkpoint
+
+        criteria = "UID {0}:*".format(previous["lastUid"] + 1)
+        if self.criteria != None:
+            criteria = "({0} {1})".format(criteria, self.criteria)
+        _, data = imap_server.uid('SEARCH', None, criteria)
+        # "n:*" always matches the newest message, even if its UID is below n
+        uids = sorted([int(uid) for uid in data[0].split() if int(uid) > previous["lastUid"]])
+        if uids:
+            checkpoint["lastUid"] = uids[-1]
+        if uidNext != None:
+            checkpoint["lastUid"] = max(checkpoint["lastUid"], uidNext - 1)
+        return [str(uid) for uid in uids], checkpoint
+
+def response_number(imap_server, code):
+    '''
+    Return the number in a response code from the last command, e.g. the
+    [UIDVALIDITY 123] sent with SELECT, or None if the server didn't send it.
+    '''
+    _, data = imap_server.response(code)
+    if not data or data[-1] == None:
+        return None
+    return int(data[-1])
+
+# ---------- Push listener ---------- #
+class ResponseListener:
+    '''
+    A ResponseListener watches a mailbox from a background thread and puts
+    every valid Response that arrives onto .queue, as (sender, Response).
+    It holds one session open and waits for new mail with IMAP IDLE, or
+    with a NOOP every pollInterval seconds if the server can't IDLE, then
+    picks up just the new messages with an InboxSync, decrypting them with
+    a DecryptionPool. Dropped connections are reopened with the pool's backoff.
+
+    Arguments:
+        email_address, password -- The account to watch.
+        criteria -- An IMAP search for the replies to watch for, or None for every message.
+        mailbox -- The mailbox to watch.
+        store -- The CheckpointStore to use. Defaults to the file at CHECKPOINT_PATH.
+        pool -- The IMAPSessionPool to take a session from. Defaults to the shared one.
+        gpg -- What to decrypt replies with. Defaults to the shared KeyringService.
+        idleTimeout -- Seconds to stay in one IDLE before restarting it.
+        pollInterval -- Seconds between NOOPs when IDLE isn't available.
+    '''
+    def __init__(self, email_address, password, criteria=None, mailbox="Inbox", store=None, pool=None, gpg=None,
+                 idleTimeout=IDLE_TIMEOUT, pollInterval=POLL_INTERVAL):
+        self.email_address = email_address
+        self.password = password
+        self.pool = IMAPSessionPool.for_host() if pool == None else pool
+        self.sync = InboxSync(email_address, password, criteria, mailbox, store, self.pool)
+        self.gpg = KeyringService.for_home() if gpg == None else gpg
+        self.idleTimeout = idleTimeout
+        self.pollInterval = pollInterval
+        self.useIdle = True
+        self.decryptor = DecryptionPool()
+        self.queue = queue.Queue()
+        # The exception that stopped the listener, e.g. a refused LOGIN
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if wait and self._thread.is_alive():
+            self._thread.join()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def run(self):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                with self.pool.session(self.email_address, self.password) as imap_server:
+                    while not self._stop.is_set():
+                        replies = (ReceivedEmail(uid, header, payload, self.gpg) for uid, header, payload in self.sync.poll_with(imap_server))
+                        for reply in self.decryptor.decrypt_all(replies):
+                            self.handle(reply)
+                        failures = 0
+                        self.wait(imap_server)
+            except CONNECTION_ERRORS:
+                self._stop.wait(self.pool.backoff * 2 ** min(failures, 6))
+                failures += 1
+            except Exception as e:
+                self.error = e
+                break
+        self.decryptor.close()
+
+    def handle(self, reply):
+        '''
+        Queue a new, decrypted message if it holds a valid Response.
+        '''
+        if reply.payload == None:
+            return
+        response = Response(reply.plaintext)
+        if response.isValid:
+            self.queue.put((reply.sender, response))
+
+    def wait(self, imap_server):
+        '''
+        Block until the mailbox may have new mail, or the listener is stopped.
+        '''
+        if self.useIdle and 'IDLE' in imap_server.capabilities:
+            if idle(imap_server, self.idleTimeout, self._stop) != None:
+                return
+            self.useIdle = False
+        # Forget the count SELECT reported, so only a change seen by NOOP wakes us
+        imap_server.response('EXISTS')
+        while not self._stop.wait(self.pollInterval):
+            imap_server.noop()
+            if response_number(imap_server, 'EXISTS') != None:
+                return
+
+def idle(imap_server, timeout, stopEvent=None):
+    '''
+    Wait in IDLE for up to timeout seconds, or until stopEvent is set, for
+    the server to report new mail. The mailbox must already be selected.
+
+    Return True if new mail arrived, False if not, or None if the server
+    refused to IDLE.
+    '''
+    sock, buffer = imap_server.sock, b""
+    imap_server.send(IDLE_TAG + b" IDLE\r\n")
+    changed = False
+    while True:
+        line, buffer = read_socket_line(sock, buffer, imap_server.sock.gettimeout())
+        if line == None or line.startswith(IDLE_TAG + b" "):
+            return None
+        if line.startswith(b"+"):
+            break
+        changed = changed or EXISTS_REGEX.match(line) != None
+
+    deadline = time.monotonic() + timeout
+    while not changed and time.monotonic() < deadline and not (stopEvent != None and stopEvent.is_set()):
+        line, buffer = read_socket_line(sock, buffer, min(STOP_CHECK_INTERVAL, max(deadline - time.monotonic(), 0)))
+        changed = line != None and EXISTS_REGEX.match(line) != None
+
+    imap_server.send(b"DONE\r\n")
+    while True:
+        line, buffer = read_socket_line(sock, buffer, imap_server.sock.gettimeout())
+        if line == None:
+            raise imaplib.IMAP4.abort("no reply to DONE")
+        if line.startswith(IDLE_TAG + b" "):
+            return changed
+        changed = changed or EXISTS_REGEX.match(line) != None
+
+def read_socket_line(sock, buffer, timeout):
+    '''
+    Read one line straight from the socket, so that waiting for it can time
+    out without upsetting imaplib's own buffered reader. Return (line, the
+    rest of the buffer), with line None if nothing arrived within timeout.
+    '''
+    while b"\n" not in buffer:
+        pending = sock.pending() if hasattr(sock, "pending") else 0
+        if pending == 0 and not select.select([sock], [], [], timeout)[0]:
+            return None, buffer
+        data = sock.recv(4096)
+        if not data:
+            raise imaplib.IMAP4.abort("connection closed")
+        buffer += data
+    line, buffer = buffer.split(b"\n", 1)
+    return line + b"\n", buffer
+
+# ---------- Reading ---------- #
+class ReceivedEmail:
+    '''
+    One message read from the mailbox. The encrypted part is only decrypted
+    the first time .plaintext is read.
+
+    Attributes:
+        uid -- The message's IMAP UID, as a string.
+        sender, subject, date -- The message's From, Subject and Date headers.
+        payload -- The armored encrypted part, or None if the message has none.
+        decryptSeconds -- How long decryption took, or None until it's done.
+    '''
+    def __init__(self, uid, header, payload, gpg):
+        self.uid = uid
+        self.sender = header['from']
+        self.subject = header['subject']
+        self.date = header['date']
+        self.payload = payload
+        # How long decryption took, in seconds, once it has been done
+        self.decryptSeconds = None
+        self._gpg = gpg
+        self._plaintext = None
+
+    @property
+    def plaintext(self):
+        '''
+        The decrypted message, or None if the message has no encrypted part.
+        '''
+        return self.decrypt()._plaintext
+
+    def decrypt(self):
+        '''
+        Decrypt the message now, unless that's already been done, and return
+        this ReceivedEmail. Used by DecryptionPool's worker threads.
+        '''
+        if self._plaintext == None and self.payload != None:
+            start = time.perf_counter()
+            self._plaintext = str(self._gpg.decrypt(self.payload))
+            self.decryptSeconds = time.perf_counter() - start
+        return self
+
+    def format(self):
+        '''
+        Generate the text shown for this message in the app's message box.
+        '''
+        email_message = ""
+        email_message += "_________________________________________\n"
+        email_message += "subj: " + str(self.subject) + '\n'
+        email_message +="from:" + str(self.sender) + '\n'
+        email_message += "body: \n"
+        email_message += self.plaintext or ""
+        return email_message
+
+class DecryptionPool:
+    '''
+    A DecryptionPool decrypts a stream of ReceivedEmails on a bounded set
+    of worker threads. Each gpg.decrypt() runs in its own gpg process, so
+    many replies are decrypted at once instead of one spawn after another.
+    At most maxPending messages are read ahead of the caller, so memory
+    stays bounded however long the stream is.
+
+    Arguments:
+        workers -- How many decryptions may run at once.
+        maxPending -- How many messages may be queued or in progress. Defaults to twice workers.
+    '''
+    def __init__(self, workers=DECRYPT_WORKERS, maxPending=None):
+        self.workers = workers
+        self.maxPending = 2 * workers if maxPending == None else maxPending
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def decrypt_all(self, replies, ordered=True):
+        '''
+        Yield every ReceivedEmail in replies once it has been decrypted, with
+        its decryptSeconds set. If ordered, they come out in the order they
+        went in; otherwise each is yielded as soon as it is ready.
+        '''
+        pending = collections.deque() if ordered else set()
+        for reply in replies:
+            if ordered:
+                pending.append(self._executor.submit(reply.decrypt))
+            else:
+                pending.add(self._executor.submit(reply.decrypt))
+            if len(pending) >= self.maxPending:
+                yield from self._drain(pending, ordered, self.maxPending - 1)
+        yield from self._drain(pending, ordered, 0)
+
+    def _drain(self, pending, ordered, keep):
+        while len(pending) > keep:
+            if ordered:
+                yield pending.popleft().result()
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                yield future.result()
+
+    def close(self):
+        self._executor.shutdown()
+
+def read_email(email_address,password,subject,recipient_address,pool=None,gpg=None):
+    '''
+    Yield a ReceivedEmail for every message from recipient_address with this
+    subject, newest first. Messages are fetched a batch at a time as the
+    caller iterates, and each is only decrypted if its .plaintext is read,
+    so stopping early skips the rest of the downloads and decryptions.
+    '''
+    if gpg == None:
+        gpg = KeyringService.for_home()
+
+    if pool == None:
+        pool = IMAPSessionPool.for_host()
+
+    with pool.session(email_address, password) as imap_server:
+
+        imap_server.select('Inbox')
+
+        _, data = imap_server.uid('SEARCH', None, '(FROM "{}" SUBJECT "{}")'.format(recipient_address,subject))
+
+        mail_id_list = data[0].split()
+
+        for uid, header, payload in fetch_encrypted(imap_server, mail_id_list[::-1]):
+            yield ReceivedEmail(uid, header, payload, gpg)
@@ -0,0 +1,681 @@
+#! python3
+# indexer.py
+# Follows the BusinessConsensus events with eth_getLogs into a local SQLite projection.
+
+import json, os, sqlite3, threading, unittest
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_abi import decode_abi, encode_abi
+from eth_utils import keccak, to_checksum_address
+
+from chain import ConsensusClient, RPCError
+
+# ---------- Global values ---------- #
+INDEX_PATH = os.getenv("INDEX_PATH", os.path.join(os.getcwd(), "consensus_index.sqlite3"))
+# Blocks per eth_getLogs request. Halved whenever the node says a range has too many
+# results, and doubled back (up to LOG_BATCH_SIZE) after GROW_AFTER successful requests.
+LOG_BATCH_SIZE = 2000
+GROW_AFTER = 10
+# eth_getLogs requests in flight at once
+BACKFILL_WORKERS = 4
+# Blocks near the head whose hashes are kept to detect reorgs; also how far back
+# to roll back when none of the kept blocks are still on the chain
+REORG_DEPTH = 64
+# Substrings of node errors meaning an eth_getLogs range must be made smaller
+TOO_MANY_RESULTS_ERRORS = ["more than", "too many", "size exceeded", "limit exceeded", "range is too large", "block range", "-32005"]
+# Times a range is read before giving up, when the node keeps failing it or its last block keeps
+# changing; FETCH_BACKOFF seconds pass before the first retry, doubled on every further one
+FETCH_ATTEMPTS = 4
+FETCH_BACKOFF = 0.5
+# Seconds between syncs when following the chain in the background
+SYNC_INTERVAL = 5
+
+# name -> (indexed [(field, type)], data [(field, type)]), as declared in contracts/BusinessConsensus.sol
+EVENTS = {
+    "ProposalCreated": ([("messageID", "bytes32"), ("initiator", "address"), ("keyID", "bytes32")],
+                        [("expiryDate", "uint256"), ("requiredPercentage", "uint256"), ("contents", "bytes32"), ("messageDate", "string")]),
+    "VoterRegistered": ([("messageID", "bytes32"), ("voter", "address")], []),
+    "VoteCast": ([("messageID", "bytes32"), ("voter", "address")], [("approval", "bool")]),
+    "ConsensusReached": ([("messageID", "bytes32")], [("verdict", "bool"), ("voteCount", "uint256"), ("numApprovals", "uint256")]),
+}
+
+def event_signature(name):
+    indexed, data = EVENTS[name]
+    return "{0}({1})".format(name, ",".join([type for _, type in indexed + data]))
+
+# topic0 (the keccak of the event signature, as "0x..." hex) -> event name
+EVENT_TOPICS = {"0x" + keccak(text=event_signature(name)).hex(): name for name in EVENTS}
+
+# Bumped whenever SCHEMA changes; a store built with another version is dropped and re-indexed
+SCHEMA_VERSION = 2
+TABLES = ["proposals", "voters", "checkpoints", "events", "blocks"]
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS proposals (
+    contract TEXT NOT NULL,
+    messageID TEXT NOT NULL,
+    initiator TEXT,
+    keyID TEXT,
+    expiryDate INTEGER,
+    requiredPercentage INTEGER,
+    contents TEXT,
+    messageDate TEXT,
+    numVoters INTEGER NOT NULL DEFAULT 0,
+    voteCount INTEGER NOT NULL DEFAULT 0,
+    numApprovals INTEGER NOT NULL DEFAULT 0,
+    isCompiled INTEGER NOT NULL DEFAULT 0,
+    finalVerdict INTEGER NOT NULL DEFAULT 0,
+    createdBlock INTEGER,
+    PRIMARY KEY (contract, messageID)
+);
+CREATE TABLE IF NOT EXISTS voters (
+    contract TEXT NOT NULL,
+    messageID TEXT NOT NULL,
+    voter TEXT NOT NULL,
+    registeredAt INTEGER NOT NULL,
+    voted INTEGER NOT NULL DEFAULT 0,
+    approval INTEGER NOT NULL DEFAULT 0,
+    votedAt INTEGER,
+    PRIMARY KEY (contract, messageID, voter)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    contract TEXT PRIMARY KEY,
+    block INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    contract TEXT NOT NULL,
+    blockNumber INTEGER NOT NULL,
+    logIndex INTEGER NOT NULL,
+    messageID TEXT NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (contract, blockNumber, logIndex)
+);
+CREATE INDEX IF NOT EXISTS eventsByProposal ON events (contract, messageID, blockNumber, logIndex);
+CREATE TABLE IF NOT EXISTS blocks (
+    contract TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (contract, number)
+);
+'''
+
+# ---------- Unit tests ---------- #
+class TestEventIndexer(unittest.TestCase):
+    MESSAGE_ID = "0x" + "ab" * 32
+    CONTRACT = "0x" + "42" * 20
+    INITIATOR = "0x" + "11" * 20
+    VOTERS = ["0x" + "22" * 20, "0x" + "33" * 20, "0x" + "44" * 20]
+
+    class FakeEth:
+        def __init__(self, logs, head, limit=None):
+            self.logs = logs
+            self.blockNumber = head
+            self.limit = limit
+            # Block hashes that differ from block_hash(), i.e. blocks on a new fork
+            self.forked = {}
+            self.requests = []
+            self.lock = threading.Lock()
+
+        def block_hash(self, number):
+            return self.forked.get(number, "0x" + number.to_bytes(32, "big").hex())
+
+        def getLogs(self, filter):
+            with self.lock:
+                self.requests.append((filter["fromBlock"], filter["toBlock"]))
+            logs = [dict(log, blockHash=self.block_hash(log["blockNumber"])) for log in self.logs if filter["fromBlock"] <= log["blockNumber"] <= filter["toBlock"]]
+            if self.limit != None and len(logs) > self.limit:
+                raise ValueError({"code": -32005, "message": "query returned more than {0} results".format(self.limit)})
+            return logs
+
+    class FakeClient:
+        def __init__(self, eth):
+            self.web3 = type("FakeWeb3", (), {"eth": eth})()
+
+        def batch(self, calls):
+            replies = []
+            for method, params in calls:
+                if method == "eth_getLogs":
+                    try:
+                        replies.append(self.web3.eth.getLogs({**params[0], "fromBlock": int(params[0]["fromBlock"], 16), "toBlock": int(params[0]["toBlock"], 16)}))
+                    except ValueError as e:
+                        replies.append(RPCError(e.args[0]))
+                else:
+                    replies.append({"hash": self.web3.eth.block_hash(int(params[0], 16))})
+            return replies
+
+    def make_log(self, name, blockNumber, logIndex, *values):
+        indexed, data = EVENTS[name]
+        topics = [bytes.fromhex(topic[2:]) for topic, event in EVENT_TOPICS.items() if event == name]
+        topics += [encode_abi([type], [value]) for (_, type), value in zip(indexed, values)]
+        return {"address": self.CONTRACT, "topics": topics, "blockNumber": blockNumber, "logIndex": logIndex,
+                "data": "0x" + encode_abi([type for _, type in data], list(values[len(indexed):])).hex()}
+
+    def make_indexer(self, eth, batchSize=4):
+        return EventIndexer(self.FakeClient(eth), self.CONTRACT, ProposalStore(":memory:"), startBlock=2, batchSize=batchSize, backoff=0)
+
+    def proposal_logs(self):
+        messageID = bytes.fromhex(self.MESSAGE_ID[2:])
+        return [
+            self.make_log("ProposalCreated", 3, 0, messageID, self.INITIATOR, b"\x01" * 32, 1000, 50, b"\x02" * 32, "Mon, 01 Jan"),
+            self.make_log("VoterRegistered", 3, 1, messageID, self.VOTERS[0]),
+            self.make_log("VoterRegistered", 3, 2, messageID, self.VOTERS[1]),
+            self.make_log("VoterRegistered", 3, 3, messageID, self.VOTERS[2]),
+            self.make_log("VoteCast", 7, 0, messageID, self.VOTERS[1], True),
+            self.make_log("VoteCast", 9, 4, messageID, self.VOTERS[0], False),
+            self.make_log("ConsensusReached", 12, 0, messageID, False, 2, 1),
+        ]
+
+    def test_events_build_the_proposal_and_its_bundle(self):
+        # Arrange
+        store = ProposalStore(":memory:")
+
+        # Act
+        store.apply(self.CONTRACT, [decode_log(log) for log in self.proposal_logs()], 12)
+        status = store.statuses(self.CONTRACT, [self.MESSAGE_ID])[0]
+        verdict, messageID, count, voters = store.bundle(self.CONTRACT, self.MESSAGE_ID)
+
+        # Assert
+        self.assertEqual(status, {"expiryDate": 1000, "voteCount": 2, "numApprovals": 1, "numVoters": 3, "isCompiled": True, "finalVerdict": False})
+        self.assertEqual((verdict, messageID.hex(), count), (False, "ab" * 32, 2))
+        # Voters in the order they voted, then those that never did, as retrieve_bundle returns them
+        self.assertEqual(voters, [(True, True, to_checksum_address(self.VOTERS[1])), (True, False, to_checksum_address(self.VOTERS[0])),
+                                  (False, False, to_checksum_address(self.VOTERS[2]))])
+        self.assertEqual(store.checkpoint(self.CONTRACT), 12)
+
+    def test_rollback_only_touches_its_contract(self):
+        # Arrange
+        store = ProposalStore(":memory:")
+        other = "0x" + "43" * 20
+        events = [decode_log(log) for log in self.proposal_logs()[:6]]
+        store.apply(self.CONTRACT, events, 10)
+        store.apply(other, events, 10)
+
+        # Act
+        store.rollback(self.CONTRACT, 6)
+
+        # Assert
+        self.assertEqual(store.statuses(self.CONTRACT, [self.MESSAGE_ID])[0]["voteCount"], 0)
+        self.assertEqual(store.statuses(other, [self.MESSAGE_ID])[0]["voteCount"], 2)
+        self.assertEqual((store.checkpoint(self.CONTRACT), store.checkpoint(other)), (6, 10))
+
+    def test_sync_resumes_from_the_checkpoint(self):
+        # Arrange
+        eth = self.FakeEth(self.proposal_logs(), 8)
+        indexer = self.make_indexer(eth)
+
+        # Act
+        firstCount = indexer.sync()
+        eth.blockNumber = 20
+        secondCount = indexer.sync()
+
+        # Assert
+        self.assertEqual((firstCount, secondCount), (5, 2))
+        # Ranges are fetched concurrently, so they may be requested in any order
+        self.assertEqual(sorted(eth.requests), [(2, 5), (6, 8), (9, 12), (13, 16), (17, 20)])
+        self.assertEqual(indexer.store.statuses(self.CONTRACT, [self.MESSAGE_ID])[0]["voteCount"], 2)
+        self.assertEqual(indexer.store.checkpoint(self.CONTRACT), 20)
+
+    def test_ranges_with_too_many_results_are_halved(self):
+        # Arrange
+        eth = self.FakeEth(self.proposal_logs(), 12, limit=4)
+        indexer = self.make_indexer(eth, batchSize=16)
+
+        # Act
+        count = indexer.sync()
+
+        # Assert
+        self.assertEqual(count, 7)
+        self.assertLess(indexer.batchSize, 16)
+        self.assertTrue(indexer.store.statuses(self.CONTRACT, [self.MESSAGE_ID])[0]["isCompiled"])
+
+    def test_block_the_node_keeps_refusing_fails_the_sync(self):
+        # Arrange
+        # Block 3 alone has more logs than the node will return
+        eth = self.FakeEth(self.proposal_logs(), 12, limit=1)
+        indexer = self.make_indexer(eth, batchSize=16)
+
+        # Act
+        with self.assertRaises(RPCError):
+            indexer.sync()
+
+        # Assert
+        self.assertEqual(eth.requests.count((3, 3)), FETCH_ATTEMPTS)
+        self.assertEqual(indexer.store.checkpoint(self.CONTRACT), None)
+
+    def test_reorg_rolls_back_orphaned_blocks(self):
+        # Arrange
+        messageID = bytes.fromhex(self.MESSAGE_ID[2:])
+        logs = self.proposal_logs()[:6]
+        eth = self.FakeEth(logs, 10)
+        indexer = self.make_indexer(eth)
+        indexer.sync()
+
+        # Act
+        # Blocks 9 and 10 are replaced: the vote in block 9 is gone, and another voter approves in block 10
+        eth.forked = {9: "0x" + "99" * 32, 10: "0x" + "aa" * 32}
+        eth.logs = logs[:5] + [self.make_log("VoteCast", 10, 0, messageID, self.VOTERS[2], True)]
+        eth.blockNumber = 11
+        indexer.sync()
+        status = indexer.store.statuses(self.CONTRACT, [self.MESSAGE_ID])[0]
+
+        # Assert
+        self.assertEqual(indexer.rollbacks, [7])
+        self.assertEqual((status["voteCount"], status["numApprovals"]), (2, 2))
+        self.assertEqual(indexer.store.checkpoint(self.CONTRACT), 11)
+
+# ---------- Log decoding ---------- #
+def to_hex(value):
+    '''
+    Return bytes or a hex string as lower case "0x..." hex.
+    '''
+    if isinstance(value, str):
+        return "0x" + value[2:].lower() if value.startswith("0x") else "0x" + value.lower()
+    return "0x" + bytes(value).hex()
+
+def to_int(value):
+    '''
+    Return an integer given as an int or, as in raw JSON-RPC results, as "0x..." hex.
+    '''
+    return int(value, 16) if isinstance(value, str) else value
+
+def decode_log(log):
+    '''
+    Decode one eth_getLogs entry of a BusinessConsensus event.
+
+    Return a dict of the event's fields, plus "event", "blockNumber",
+    "logIndex" and "blockHash", with bytes32 values as "0x..." hex and
+    addresses checksummed.
+    Return None for a log that isn't one of EVENTS.
+    '''
+    topics = [to_hex(topic) for topic in log["topics"]]
+    name = EVENT_TOPICS.get(topics[0]) if topics else None
+    if name == None:
+        return None
+    indexed, data = EVENTS[name]
+    event = {"event": name, "blockNumber": to_int(log["blockNumber"]), "logIndex": to_int(log["logIndex"])}
+    if log.get("blockHash") != None:
+        event["blockHash"] = to_hex(log["blockHash"])
+    # Indexed bytes32 and address values are their topic as is, so skip the ABI decoder for them
+    for (field, type), topic in zip(indexed, topics[1:]):
+        event[field] = topic if type == "bytes32" else to_checksum_address("0x" + topic[-40:])
+    if data:
+        payload = log["data"]
+        payload = bytes.fromhex(payload[2:]) if isinstance(payload, str) else bytes(payload)
+        event.update(zip([field for field, _ in data], decode_abi([type for _, type in data], payload)))
+        for field, type in data:
+            if type == "bytes32":
+                event[field] = to_hex(event[field])
+    return event
+
+# ---------- Object class definition ---------- #
+class ProposalStore:
+    '''
+    A SQLite projection of every proposal on one or more BusinessConsensus
+    contracts, built from their events, and the last block indexed for each
+    contract. Reads are answered locally, without an RPC round-trip. A store
+    written by an older SCHEMA_VERSION is emptied and indexed again.
+
+    The events themselves are kept too, with the hashes of recent blocks, so
+    that rollback() can undo blocks dropped by a reorg by rebuilding the
+    proposals they touched.
+
+    Arguments:
+        path -- The database file, or ":memory:" for a throwaway store.
+    '''
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                for table in TABLES:
+                    self.connection.execute("DROP TABLE IF EXISTS {0}".format(table))
+                self.connection.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def checkpoint(self, contract_address):
+        '''
+        Return the last block indexed for this contract, or None.
+        '''
+        with self._lock:
+            row = self.connection.execute("SELECT block FROM checkpoints WHERE contract = ?", (contract_address.lower(),)).fetchone()
+        return None if row == None else row[0]
+
+    def apply(self, contract_address, events, toBlock, hashes=None, keepFrom=0):
+        '''
+        Apply decoded events, in chain order, and move the contract's
+        checkpoint to toBlock, all in one database transaction.
+
+        Arguments:
+            hashes -- {block number: hash} of blocks to remember for reorg detection.
+            keepFrom -- Forget remembered hashes of blocks before this one.
+        '''
+        contract = contract_address.lower()
+        with self._lock, self.connection:
+            for event in events:
+                APPLIERS[event["event"]](self.connection, contract, event)
+            self.connection.executemany("INSERT OR REPLACE INTO events (contract, blockNumber, logIndex, messageID, event) VALUES (?, ?, ?, ?, ?)",
+                                        [(contract, event["blockNumber"], event["logIndex"], event["messageID"], json.dumps(event)) for event in events])
+            self.connection.executemany("INSERT OR REPLACE INTO blocks (contract, number, hash) VALUES (?, ?, ?)",
+                                        [(contract, number, hash) for number, hash in (hashes or {}).items()])
+            self.connection.execute("DELETE FROM blocks WHERE contract = ? AND number < ?", (contract, keepFrom))
+            self.connection.execute("INSERT OR REPLACE INTO checkpoints (contract, block) VALUES (?, ?)", (contract, toBlock))
+
+    def block_hashes(self, contract_address):
+        '''
+        Return the remembered {block number: hash} of this contract's recent blocks.
+        '''
+        with self._lock:
+            return dict(self.connection.execute("SELECT number, hash FROM blocks WHERE contract = ?", (contract_address.lower(),)).fetchall())
+
+    def rollback(self, contract_address, toBlock):
+        '''
+        Forget every event of this contract after block toBlock, rebuild the
+        proposals they touched from the events that remain, and move the
+        checkpoint back to toBlock, all in one database transaction.
+        '''
+        contract = contract_address.lower()
+        with self._lock, self.connection:
+            affected = [row[0] for row in self.connection.execute("SELECT DISTINCT messageID FROM events WHERE contract = ? AND blockNumber > ?", (contract, toBlock))]
+            self.connection.execute("DELETE FROM events WHERE contract = ? AND blockNumber > ?", (contract, toBlock))
+            self.connection.execute("DELETE FROM blocks WHERE contract = ? AND number > ?", (contract, toBlock))
+            for messageID in affected:
+                self.connection.execute("DELETE FROM proposals WHERE contract = ? AND messageID = ?", (contract, messageID))
+                self.connection.execute("DELETE FROM voters WHERE contract = ? AND messageID = ?", (contract, messageID))
+                for (event,) in self.connection.execute("SELECT event FROM events WHERE contract = ? AND messageID = ? ORDER BY blockNumber, logIndex",
+                                                        (contract, messageID)).fetchall():
+                    event = json.loads(event)
+                    APPLIERS[event["event"]](self.connection, contract, event)
+            self.connection.execute("INSERT OR REPLACE INTO checkpoints (contract, block) VALUES (?, ?)", (contract, toBlock))
+
+    def proposal(self, contract_address, messageID):
+        '''
+        Return every indexed field of one of this contract's proposals as a
+        dict, or None if it hasn't been indexed.
+        '''
+        with self._lock:
+            cursor = self.connection.execute("SELECT * FROM proposals WHERE contract = ? AND messageID = ?", (contract_address.lower(), to_hex(messageID)))
+            row = cursor.fetchone()
+            if row == None:
+                return None
+            proposal = dict(zip([column[0] for column in cursor.description], row))
+        proposal["isCompiled"] = bool(proposal["isCompiled"])
+        proposal["finalVerdict"] = bool(proposal["finalVerdict"])
+        return proposal
+
+    def statuses(self, contract_address, messageIDs):
+        '''
+        Return one dict per messageID of this contract, in the order given,
+        with the fields of deploy.get_proposal_statuses(), or None for a
+        proposal not indexed.
+        '''
+        statuses = []
+        for messageID in messageIDs:
+            proposal = self.proposal(contract_address, messageID)
+            if proposal == None:
+                statuses.append(None)
+                continue
+            statuses.append({field: proposal[field] for field in ["expiryDate", "voteCount", "numApprovals", "numVoters", "isCompiled", "finalVerdict"]})
+        return statuses
+
+    def bundle(self, contract_address, messageID):
+        '''
+        Return the bundle of one of this contract's compiled proposals in the
+        form the contract's retrieve_bundle returns it, [verdict, messageID,
+        voteCount, voters], with voters as (voted, vote, address) in the order
+        they voted and then those that never did. Return None if the proposal
+        isn't compiled yet.
+        '''
+        proposal = self.proposal(contract_address, messageID)
+        if proposal == None or not proposal["isCompiled"]:
+            return None
+        with self._lock:
+            voters = self.connection.execute('''SELECT voted, approval, voter FROM voters WHERE contract = ? AND messageID = ?
+                                                ORDER BY voted DESC, CASE WHEN voted THEN votedAt ELSE registeredAt END''',
+                                             (proposal["contract"], proposal["messageID"])).fetchall()
+        return [proposal["finalVerdict"], bytes.fromhex(proposal["messageID"][2:]), proposal["voteCount"],
+                [(bool(voted), bool(approval), voter) for voted, approval, voter in voters]]
+
+    def close(self):
+        self.connection.close()
+
+def position(event):
+    '''
+    A number that orders events the way the chain does.
+    '''
+    return event["blockNumber"] * 1000000 + event["logIndex"]
+
+def apply_proposal_created(connection, contract, event):
+    connection.execute('''INSERT OR IGNORE INTO proposals (contract, messageID, initiator, keyID, expiryDate, requiredPercentage, contents, messageDate, createdBlock)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (contract, event["messageID"], event["initiator"], event["keyID"], event["expiryDate"], event["requiredPercentage"],
+                        event["contents"], event["messageDate"], event["blockNumber"]))
+
+def apply_voter_registered(connection, contract, event):
+    inserted = connection.execute("INSERT OR IGNORE INTO voters (contract, messageID, voter, registeredAt) VALUES (?, ?, ?, ?)",
+                                  (contract, event["messageID"], event["voter"], position(event))).rowcount
+    connection.execute("UPDATE proposals SET numVoters = numVoters + ? WHERE contract = ? AND messageID = ?", (inserted, contract, event["messageID"]))
+
+def apply_vote_cast(connection, contract, event):
+    updated = connection.execute("UPDATE voters SET voted = 1, approval = ?, votedAt = ? WHERE contract = ? AND messageID = ? AND voter = ? AND voted = 0",
+                                 (int(event["approval"]), position(event), contract, event["messageID"], event["voter"])).rowcount
+    connection.execute("UPDATE proposals SET voteCount = voteCount + ?, numApprovals = numApprovals + ? WHERE contract = ? AND messageID = ?",
+                       (updated, updated if event["approval"] else 0, contract, event["messageID"]))
+
+def apply_consensus_reached(connection, contract, event):
+    connection.execute("UPDATE proposals SET isCompiled = 1, finalVerdict = ?, voteCount = ?, numApprovals = ? WHERE contract = ? AND messageID = ?",
+                       (int(event["verdict"]), event["voteCount"], event["numApprovals"], contract, event["messageID"]))
+
+def too_many_results(error):
+    '''
+    Whether a failed eth_getLogs means its block range must be made smaller.
+    '''
+    message = str(getattr(error, "error", error)).lower()
+    return any([pattern in message for pattern in TOO_MANY_RESULTS_ERRORS])
+
+APPLIERS = {
+    "ProposalCreated": apply_proposal_created,
+    "VoterRegistered": apply_voter_registered,
+    "VoteCast": apply_vote_cast,
+    "ConsensusReached": apply_consensus_reached,
+}
+
+class EventIndexer:
+    '''
+    An EventIndexer keeps a ProposalStore up to date with one contract. Each
+    sync() asks the node for the contract's events with eth_getLogs, in
+    ranges of blocks from the block after the stored checkpoint up to the
+    chain head, and applies every range with its checkpoint in one database
+    transaction, so an interrupted sync resumes where it stopped.
+
+    Up to workers ranges are fetched at once but applied in chain order. A
+    range the node refuses for having too many results is split in half until
+    it is accepted, and later ranges start at the smaller size. A single
+    block still refused, or any other node error, is retried with backoff up
+    to FETCH_ATTEMPTS times before the sync fails. The hashes of
+    blocks within reorgDepth of the head are remembered, and each sync first
+    checks them against the node: if the chain has reorganised, the store is
+    rolled back to the newest remembered block still on it (recorded in
+    .rollbacks) and the orphaned blocks are indexed again.
+
+    Arguments:
+        client -- The ConsensusClient of the node to read logs from.
+        contract_address -- The BusinessConsensus contract to follow.
+        store -- The ProposalStore to write to.
+        startBlock -- Where to start if the store has no checkpoint, e.g. the
+                      contract's deployment block.
+        batchSize -- The largest number of blocks per eth_getLogs request.
+        workers -- How many eth_getLogs requests may be in flight at once.
+        reorgDepth -- How many blocks behind the head a reorg is looked for.
+        backoff -- Seconds before a failed range is read again, doubled on every further attempt.
+    '''
+    def __init__(self, client, contract_address, store, startBlock=0, batchSize=LOG_BATCH_SIZE, workers=BACKFILL_WORKERS, reorgDepth=REORG_DEPTH,
+                 backoff=FETCH_BACKOFF):
+        self.client = client
+        self.contract_address = contract_address
+        self.store = store
+        self.startBlock = startBlock
+        self.maxBatchSize = batchSize
+        self.batchSize = batchSize
+        self.workers = workers
+        self.reorgDepth = reorgDepth
+        self.backoff = backoff
+        self.rollbacks = []
+        self.error = None
+        self._successes = 0
+        self._sizeLock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def for_contract(cls, url, contract_address, path=INDEX_PATH, startBlock=0):
+        '''
+        Return an indexer for this contract over the shared client for url.
+        '''
+        return cls(ConsensusClient.for_url(url), contract_address, ProposalStore(path), startBlock)
+
+    def sync(self):
+        '''
+        Index every block up to the current head. Return the number of events applied.
+        '''
+        self.check_reorg()
+        checkpoint = self.store.checkpoint(self.contract_address)
+        fromBlock = self.startBlock if checkpoint == None else checkpoint + 1
+        head = self.client.web3.eth.blockNumber
+        count = 0
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="EventIndexer") as executor:
+            pending = deque()
+            while fromBlock <= head or pending:
+                while fromBlock <= head and len(pending) < self.workers:
+                    toBlock = min(fromBlock + self.batchSize - 1, head)
+                    pending.append((toBlock, executor.submit(self.fetch_range, fromBlock, toBlock, head)))
+                    fromBlock = toBlock + 1
+                toBlock, future = pending.popleft()
+                events, hashes = future.result()
+                self.store.apply(self.contract_address, events, toBlock, hashes, head - self.reorgDepth)
+                count += len(events)
+        return count
+
+    def fetch_range(self, fromBlock, toBlock, head):
+        '''
+        Return the decoded events of these blocks in chain order, and the
+        hashes to remember of those within reorgDepth of head.
+        '''
+        keepFrom = head - self.reorgDepth
+        for attempt in range(FETCH_ATTEMPTS):
+            if attempt > 0:
+                self.wait_before_retry(attempt)
+            events = self.fetch_events(fromBlock, toBlock)
+            if toBlock < keepFrom:
+                return events, {}
+            hashes = {event["blockNumber"]: event["blockHash"] for event in events if event["blockNumber"] >= keepFrom and "blockHash" in event}
+            endHash = self.block_hashes([toBlock])[toBlock]
+            # Otherwise the last block was replaced while we were reading it, so read the range again
+            if hashes.get(toBlock, endHash) == endHash:
+                hashes[toBlock] = endHash
+                return events, hashes
+        raise RuntimeError("Block {0} changed every time blocks {1}-{0} were read".format(toBlock, fromBlock))
+
+    def fetch_events(self, fromBlock, toBlock):
+        '''
+        Return the decoded events of these blocks in chain order, halving any
+        range the node says has too many results, down to single blocks.
+        '''
+        events = []
+        # (fromBlock, toBlock, failed attempts) still to read, the earliest last
+        ranges = [(fromBlock, toBlock, 0)]
+        while ranges:
+            start, end, failures = ranges.pop()
+            logs = self.get_logs(start, end)
+            if not isinstance(logs, RPCError):
+                self.grow()
+                events += [event for event in map(decode_log, [log for log in logs if not log.get("removed")]) if event != None]
+            elif start < end and too_many_results(logs):
+                self.shrink(end - start + 1)
+                middle = (start + end) // 2
+                ranges += [(middle + 1, end, 0), (start, middle, 0)]
+            elif failures + 1 >= FETCH_ATTEMPTS:
+                raise logs
+            else:
+                self.wait_before_retry(failures + 1)
+                ranges.append((start, end, failures + 1))
+        events.sort(key=position)
+        return events
+
+    def get_logs(self, fromBlock, toBlock):
+        '''
+        Return this contract's logs in these blocks, or the RPCError the node answered with.
+        '''
+        # Sent raw rather than through web3.eth.getLogs, whose result formatting costs more than decoding the logs
+        return self.client.batch([("eth_getLogs", [{"address": self.contract_address, "fromBlock": hex(fromBlock), "toBlock": hex(toBlock),
+                                                    "topics": [list(EVENT_TOPICS)]}])])[0]
+
+    def wait_before_retry(self, attempt):
+        # Returns early if the indexer is stopped
+        self._stopEvent.wait(self.backoff * 2 ** (attempt - 1))
+
+    def shrink(self, rangeSize):
+        with self._sizeLock:
+            self.batchSize = max(1, min(self.batchSize, rangeSize // 2))
+            self._successes = 0
+
+    def grow(self):
+        with self._sizeLock:
+            self._successes += 1
+            if self._successes >= GROW_AFTER and self.batchSize < self.maxBatchSize:
+                self.batchSize = min(self.maxBatchSize, self.batchSize * 2)
+                self._successes = 0
+
+    def block_hashes(self, numbers):
+        '''
+        Return {number: hash} of these blocks as the node now has them, in
+        one JSON-RPC batch, with None for a block it doesn't have.
+        '''
+        replies = self.client.batch([("eth_getBlockByNumber", [hex(number), False]) for number in numbers])
+        for reply in replies:
+            if isinstance(reply, RPCError):
+                raise reply
+        return {number: None if reply == None else to_hex(reply["hash"]) for number, reply in zip(numbers, replies)}
+
+    def check_reorg(self):
+        '''
+        Roll the store back if any remembered block has left the chain. Return
+        the block rolled back to, or None if there was no reorg.
+        '''
+        checkpoint = self.store.checkpoint(self.contract_address)
+        remembered = self.store.block_hashes(self.contract_address)
+        if checkpoint == None or checkpoint not in remembered:
+            return None
+        # The common case: the checkpoint is still on the chain, so everything below it is too
+        if self.block_hashes([checkpoint])[checkpoint] == remembered[checkpoint]:
+            return None
+        numbers = sorted([number for number in remembered if number < checkpoint], reverse=True)
+        current = self.block_hashes(numbers)
+        ancestors = [number for number in numbers if current[number] == remembered[number]]
+        ancestor = ancestors[0] if ancestors else max(checkpoint - self.reorgDepth, self.startBlock - 1)
+        self.store.rollback(self.contract_address, ancestor)
+        self.rollbacks.append(ancestor)
+        return ancestor
+
+    def start(self, interval=SYNC_INTERVAL):
+        '''
+        Keep syncing from a background thread every interval seconds. A
+        failed sync is kept in .error and retried on the next interval.
+        '''
+        self._thread = threading.Thread(target=self.run, args=(interval,), name="EventIndexer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stopEvent.set()
+        if wait and self._thread != None:
+            self._thread.join()
+
+    def run(self, interval):
+        while not self._stopEvent.is_set():
+            try:
+                self.sync()
+                self.error = None
+            except Exception as e:
+                self.error = e
+            self._stopEvent.wait(interval)
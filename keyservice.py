@@ -0,0 +1,204 @@
+#! python3
+# keyservice.py
+# Provides one long-lived GnuPG context per keyring, shared by smtp.py and imap.py.
+
+import os, tempfile, threading, time, unittest
+from email.utils import parseaddr
+
+import gnupg
+
+from shared import Registry
+
+# ---------- Global values ---------- #
+# Files whose change means keys have been added, removed or re-trusted
+KEYRING_FILES = ["pubring.kbx", "pubring.gpg", "secring.gpg", "trustdb.gpg", "private-keys-v1.d"]
+# Key validities (gpg --with-colons field 2) of keys that can't be encrypted to: expired, revoked, disabled, invalid
+UNUSABLE_VALIDITIES = ["e", "r", "d", "i"]
+
+# ---------- Unit tests ---------- #
+class TestKeyringService(unittest.TestCase):
+    class FakeGPG:
+        def __init__(self, keys=None):
+            self.exports = 0
+            self.listings = 0
+            self.keys = [{"fingerprint": "ABCD" * 10, "uids": ["Alice <alice@example.com>"], "trust": "u", "expires": "", "cap": "scESC"}] if keys == None else keys
+
+        def export_keys(self, keyids):
+            self.exports += 1
+            return "-----BEGIN PGP PUBLIC KEY BLOCK----- {0}".format(keyids)
+
+        def list_keys(self, secret=False, keys=None):
+            # Like gpg, matches any uid containing the address, ignoring case
+            self.listings += 1
+            return [key for key in self.keys if any([keys[0].lower() in uid.lower() for uid in key["uids"]])]
+
+    def test_exports_and_lookups_are_memoized(self):
+        # Arrange
+        gpg = self.FakeGPG()
+        with tempfile.TemporaryDirectory() as directory:
+            keyring = KeyringService(directory, gpg)
+
+            # Act
+            exported = [keyring.export_key("alice@example.com") for _ in range(50)]
+            found = [keyring.recipient_key("alice@example.com") for _ in range(50)]
+            missing = [keyring.recipient_key("bob@example.com") for _ in range(50)]
+
+        # Assert
+        self.assertEqual(len(set(exported)), 1)
+        self.assertEqual(gpg.exports, 1)
+        self.assertEqual(set(found), {"ABCD" * 10})
+        self.assertEqual(set(missing), {None})
+        self.assertEqual(gpg.listings, 2)
+
+    def test_cache_is_dropped_when_the_keyring_changes(self):
+        # Arrange
+        gpg = self.FakeGPG()
+        with tempfile.TemporaryDirectory() as directory:
+            keyring = KeyringService(directory, gpg)
+            keyring.export_key("alice@example.com")
+
+            # Act
+            with open(os.path.join(directory, "pubring.kbx"), "wb") as f:
+                f.write(b"new key")
+            keyring.export_key("alice@example.com")
+            keyring.export_key("alice@example.com")
+
+        # Assert
+        self.assertEqual(gpg.exports, 2)
+
+    def test_only_a_usable_key_for_the_exact_address_is_pinned(self):
+        # Arrange
+        def key(fingerprint, uid, trust="f", expires="", cap="scESC"):
+            return {"fingerprint": fingerprint * 10, "uids": [uid], "trust": trust, "expires": expires, "cap": cap}
+        gpg = self.FakeGPG([key("AAAA", "Jim <jimbob@example.com>"), key("BBBB", "Bob <bob@example.com>", trust="r"),
+                            key("CCCC", "Bob <bob@example.com>", expires="1000"), key("DDDD", "Bob <bob@example.com>", cap="scSCD"),
+                            key("EEEE", "Bob <BOB@example.com>")])
+        with tempfile.TemporaryDirectory() as directory:
+            keyring = KeyringService(directory, gpg)
+
+            # Act
+            found = keyring.recipient_key("bob@example.com")
+            gpg.keys = gpg.keys[:4]
+            missing = KeyringService(directory, gpg).recipient_key("bob@example.com")
+
+        # Assert
+        self.assertEqual(found, "EEEE" * 10)
+        self.assertEqual(missing, None)
+
+# ---------- Object class definition ---------- #
+class KeyringService:
+    '''
+    A KeyringService owns one gnupg.GPG for a keyring directory and caches
+    what it reads from it: exported public keys, and the fingerprint each
+    recipient address resolves to. Creating a GPG and every export or key
+    listing spawns a gpg process, so sending to many recipients now spawns
+    one per address at most, instead of several per message. The caches are
+    dropped whenever the keyring files change on disk, e.g. after a key is
+    imported or trusted.
+
+    Arguments:
+        gnupghome -- The GnuPG home directory holding the keyring.
+        gpg -- The gnupg.GPG to use. Defaults to a new one for gnupghome.
+    '''
+    _services = Registry()
+
+    def __init__(self, gnupghome, gpg=None):
+        self.gnupghome = gnupghome
+        self.gpg = gnupg.GPG(gnupghome=gnupghome) if gpg == None else gpg
+        self._exported = {}
+        self._fingerprints = {}
+        self._signature = self.keyring_signature()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_home(cls, gnupghome=None):
+        '''
+        Return the shared service for this keyring, creating it on first use.
+        Defaults to the app's keyring, "PGP FILE" in the working directory.
+        '''
+        if gnupghome == None:
+            gnupghome = os.path.join(os.getcwd(), "PGP FILE")
+        return cls._services.get(gnupghome, lambda: cls(gnupghome))
+
+    def keyring_signature(self):
+        '''
+        Return the modification time and size of each keyring file, to tell
+        when the keyring has changed.
+        '''
+        signature = []
+        for name in KEYRING_FILES:
+            try:
+                stat = os.stat(os.path.join(self.gnupghome, name))
+            except OSError:
+                continue
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def refresh(self):
+        '''
+        Drop the caches if the keyring has changed since they were filled.
+        '''
+        signature = self.keyring_signature()
+        with self._lock:
+            if signature != self._signature:
+                self._exported.clear()
+                self._fingerprints.clear()
+                self._signature = signature
+
+    def export_key(self, email_address):
+        '''
+        Return the armored public key for this address, as gpg.export_keys() would.
+        '''
+        self.refresh()
+        with self._lock:
+            if email_address in self._exported:
+                return self._exported[email_address]
+        exported = self.gpg.export_keys(email_address)
+        with self._lock:
+            self._exported[email_address] = exported
+        return exported
+
+    def recipient_key(self, email_address):
+        '''
+        Return the fingerprint of the first usable public key with a uid for
+        exactly this address, or None if there is none, in which case callers
+        pass the address itself and let gpg choose.
+        '''
+        self.refresh()
+        with self._lock:
+            if email_address in self._fingerprints:
+                return self._fingerprints[email_address]
+        # gpg matches addresses as substrings, so "bob@" also lists "jimbob@"'s keys
+        keys = [key for key in self.gpg.list_keys(keys=[email_address]) if is_usable_key(key, email_address)]
+        fingerprint = keys[0]["fingerprint"] if keys else None
+        with self._lock:
+            self._fingerprints[email_address] = fingerprint
+        return fingerprint
+
+    def encrypt(self, data, recipients, **kwargs):
+        '''
+        gpg.encrypt(), with each recipient address resolved to its key's
+        fingerprint once and then looked up from the cache.
+        '''
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        return self.gpg.encrypt(data, [self.recipient_key(address) or address for address in recipients], **kwargs)
+
+    def decrypt(self, message, **kwargs):
+        return self.gpg.decrypt(message, **kwargs)
+
+def is_usable_key(key, email_address):
+    '''
+    Return True if this key, as listed by gpg.list_keys(), has a uid for
+    exactly this address and can be encrypted to: it isn't expired, revoked,
+    disabled or invalid, and has an encryption-capable (sub)key.
+    '''
+    addresses = [parseaddr(uid)[1].lower() for uid in key.get("uids", [])]
+    if email_address.lower() not in addresses:
+        return False
+    if key.get("trust") in UNUSABLE_VALIDITIES:
+        return False
+    if key.get("expires") and int(key["expires"]) <= time.time():
+        return False
+    capabilities = key.get("cap")
+    return capabilities == None or ("E" in capabilities and "D" not in capabilities)
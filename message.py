@@ -5,6 +5,7 @@
 import time, datetime
 import re, json, unittest
 from hashlib import sha256
+from blockparser import find_block, scan_blocks, parse_request_block, parse_response_block, parse_bundle_block
 
 # ---------- Global values ---------- #
 BYZANTINE_RATIO = 0.8
@@ -111,6 +112,67 @@ class TestBundle(unittest.TestCase):
         # Assert
         self.assertTrue(bundle.verdict)
 
+class TestParsing(unittest.TestCase):
+    def test_request_survives_line_wrapping(self):
+        # Arrange
+        req = Request()
+        req.create_new("Please approve the new budget for next quarter", "approval")
+        email_string = "Hi all,\n\n" + req.format_request_as_string().replace("the new budget", "the\nnew  budget") + "\nThanks\n"
+
+        # Act
+        parsed = Request()
+        isValid = parsed.parse_from_email(email_string)
+
+        # Assert
+        self.assertTrue(isValid)
+        self.assertEqual(parsed.id, req.id)
+        self.assertEqual(parsed.message, req.message)
+        self.assertEqual(parsed.action, "approval")
+
+    def test_response_is_parsed_from_reply(self):
+        # Arrange
+        req = Request()
+        req.create_new("Test", "approval")
+        email_string = "Sounds good to me.\n\n" + responseFormat.format(req.id, "approve", "disapprove").replace(" OR I disapprove", "")
+
+        # Act
+        res = Response(email_string)
+
+        # Assert
+        self.assertEqual(res.isValid, (True, "I approve", req.id))
+
+    def test_unterminated_block_is_rejected(self):
+        # Arrange
+        email_string = "# ---------- START BLOCKCHAIN RESPONSE ---------- #\n# MESSAGE ID: " + "a" * 64 + "\n"
+
+        # Act
+        res = Response(email_string)
+
+        # Assert
+        self.assertFalse(res.isValid)
+
+    def test_scan_finds_every_block_in_a_thread(self):
+        # Arrange
+        req = Request()
+        req.create_new("Test", "approval")
+        first = responseFormat.format(req.id, "approve", "disapprove").replace(" OR I disapprove", "")
+        second = responseFormat.format(req.id, "approve", "disapprove").replace("I approve OR ", "")
+        quote = lambda text, depth: "".join(["> " * depth + line + "\n" for line in text.split("\n")])
+        email_string = "Agreed.\n\n" + first + "\nOn Monday Bob wrote:\n" + quote(second, 1) + quote(req.format_request_as_string(), 2)
+
+        # Act
+        scanned = list(scan_email(email_string))
+
+        # Assert
+        self.assertEqual([block.kind for block, message in scanned], ["RESPONSE", "RESPONSE", "REQUEST", "RESPONSE"])
+        self.assertEqual([block.quoteDepth for block, message in scanned], [0, 1, 2, 2])
+        self.assertEqual(scanned[0][1].responseContents, "I approve")
+        self.assertEqual(scanned[1][1].responseContents, "I disapprove")
+        self.assertEqual(scanned[2][1].id, req.id)
+        for block, message in scanned:
+            self.assertTrue(email_string[block.start:block.end].startswith("# ---------- START BLOCKCHAIN " + block.kind))
+        self.assertEqual([block.start for block in scan_blocks(email_string.encode())], [block.start for block, message in scanned])
+
 # ---------- Object class definition ---------- #
 class Bundle:
     '''
@@ -172,45 +234,16 @@ class Bundle:
         email_string = email_string.replace("\r", "")
         
         # Pull out the block of text corresponding to our bundle
-        "We're being VERY careful here because emails can have newlines ANYWHERE and it's ANNOYING"
-        bundleRegex = re.compile(
-            r"#.+?-{10}.+?START.+?BLOCKCHAIN.+?BUNDLE.+?-{10}.+?#\n(.+?)\n#..?-{10}.+?END.+?BLOCKCHAIN.+?BUNDLE.+?-{10}.+?#\n"
-        , re.DOTALL)
-        bundleBlock = bundleRegex.search(email_string)
+        bundleBlock = find_block(email_string, "BUNDLE")
         if bundleBlock == None:
             return False
-        else:
-            bundleBlock = bundleBlock[1]
         
         # Parse the block to find our bundle contents
-        parseRegex = re.compile(
-            r"^#.+?REQUEST.+?ID:.+?(.+?)\n#.+?REQUEST.+?CONTENTS:.+?(.+?)\n#.+?ACTION.+?REQUESTED:.+?(.+?)\n#.+?RECIPIENTS:.+?(.+?)\n#.+?RESPONSES:.+?(.+?)\n.+?VERDICT:.+?(.+?)$"
-        , re.DOTALL)
-        parse = parseRegex.search(bundleBlock)
+        parse = parse_bundle_block(bundleBlock)
         if parse == None:
             return False
 
-        id, message, action, recipients, responses, verdict = parse[1], parse[2], parse[3], parse[4], parse[5], parse[6]
-        
-        # Remove newlines where needed
-        while "\n" in id or "  " in id:
-            id = id.replace("\n", " ")
-            id = id.replace("  ", " ")
-        while "\n" in message or "  " in message:
-            message = message.replace("\n", " ")
-            message = message.replace("  ", " ")
-        while "\n" in action or "  " in action:
-            action = action.replace("\n", " ")
-            action = action.replace("  ", " ")
-        while "\n" in recipients or "  " in recipients:
-            recipients = recipients.replace("\n", " ")
-            recipients = recipients.replace("  ", " ")
-        while "\n" in responses or "  " in responses:
-            responses = responses.replace("\n", " ")
-            responses = responses.replace("  ", " ")
-        while "\n" in verdict or "  " in verdict:
-            verdict = verdict.replace("\n", " ")
-            verdict = verdict.replace("  ", " ")
+        id, message, action, recipients, responses, verdict = parse["id"], parse["message"], parse["action"], parse["recipients"], parse["responses"], parse["verdict"]
         
         # Retrieve the logged RequestBlock from the blockchain
         requestBlock = localBlockchainObj.find_block_by_hash(id)
@@ -442,45 +475,26 @@ class Request:
         email_string = email_string.replace("\r", "")
 
         # Pull out the block of text corresponding to our request
-        "We're being VERY careful here because emails can have newlines ANYWHERE and it's ANNOYING"
-        requestRegex = re.compile(
-            r"#.+?-{10}.+?START.+?BLOCKCHAIN.+?REQUEST.+?-{10}.+?#\n(.+?)\n#..?-{10}.+?END.+?BLOCKCHAIN.+?REQUEST.+?-{10}.+?#\n"
-        , re.DOTALL)
-        requestBlock = requestRegex.search(email_string)
+        requestBlock = find_block(email_string, "REQUEST")
         if requestBlock == None:
             return False
-        else:
-            requestBlock = requestBlock[1]
         
+        return self.parse_from_block(requestBlock)
+    
+    def parse_from_block(self, requestBlock):
+        '''
+        Like parse_from_email(), but for the body of a REQUEST block that has
+        already been found, e.g. by scan_email().
+        
+        Arguments:
+            requestBlock -- The text between the block's START and END lines.
+        '''
         # Parse the block to find our message contents
-        parseRegex = re.compile(
-            r"^#.+?MESSAGE.DATE:.+?(.+?)\n#.+?EXPIRY.+?DATE:.+?(.+?)\n#.+?MESSAGE.+?ID:.+?(.+?)\n#.+?MESSAGE.+?CONTENTS:.+?(.+?)\n#.+?ACTION.+?REQUESTED:.+?\n#.+?Edit.+?the.+?MESSAGE.+?RESPONSE.+?field.+?to.+?say.+?\"(I.+?[A-Za-z]+?)\".+?if.+?YES,.+?or.+?\"(I.+?[A-Za-z]+?)\".+?if.+?NO"
-        , re.DOTALL)
-        parse = parseRegex.search(requestBlock)
+        parse = parse_request_block(requestBlock)
         if parse == None:
             return False
 
-        date, expiry, id, message, expectedYes, expectedNo = parse[1], parse[2], parse[3], parse[4], parse[5].lower(), parse[6].lower() # Make case insensitive
-        
-        # Remove newlines where needed
-        while "\n" in date or "  " in date:
-            date = date.replace("\n", " ")
-            date = date.replace("  ", " ")
-        while "\n" in expiry or "  " in expiry:
-            date = date.replace("\n", " ")
-            date = date.replace("  ", " ")
-        while "\n" in id or "  " in id:
-            id = id.replace("\n", " ")
-            id = id.replace("  ", " ")
-        while "\n" in message or "  " in message:
-            message = message.replace("\n", " ")
-            message = message.replace("  ", " ")
-        while "\n" in expectedYes or "  " in expectedYes:
-            expectedYes = expectedYes.replace("\n", " ")
-            expectedYes = expectedYes.replace("  ", " ")
-        while "\n" in expectedNo or "  " in expectedNo:
-            expectedNo = expectedNo.replace("\n", " ")
-            expectedNo = expectedNo.replace("  ", " ")
+        date, expiry, id, message, expectedYes, expectedNo = parse["date"], parse["expiry"], parse["id"], parse["message"], parse["expectedYes"], parse["expectedNo"]
         
         # Validate the hash
         _id = self.get_message_hash(message, date)
@@ -598,21 +612,29 @@ class Response:
         this object remains in its previous state and the function returns False.
         '''
         
-        # Pull out the block of text corresponding to our request
-        responseRegex = re.compile(r"#.+?-{10}.+?START.+?BLOCKCHAIN.+?RESPONSE.+?-{10}.+?#\n# MESSAGE ID:.+?\w{64}\n#.+?MESSAGE.+?RESPONSE:.+?I.+?[A-Za-z]+?\n#.+?-{10}.+?END.+?BLOCKCHAIN RESPONSE.+?-{10}.+?#", re.DOTALL)
-        responseBlock = responseRegex.search(self.email_string)
+        # Pull out the block of text corresponding to our response
+        responseBlock = find_block(self.email_string, "RESPONSE")
         if responseBlock == None:
             return False
         
+        return self.parse_from_block(responseBlock)
+    
+    def parse_from_block(self, responseBlock):
+        '''
+        Like parse_from_email(), but for the body of a RESPONSE block that has
+        already been found, e.g. by scan_email().
+        
+        Arguments:
+            responseBlock -- The text between the block's START and END lines.
+        '''
         # Parse the block to find our message contents
-        parseRegex = re.compile(r"#.+?MESSAGE.+?ID:.+?(\w{64})\s{0,10}?\n#.+?MESSAGE.+?RESPONSE:.+?(I.+?[A-Za-z]+).+?\s{0,10}", re.DOTALL)
-        parse = parseRegex.search(responseBlock[0])
+        parse = parse_response_block(responseBlock)
         if parse == None:
             return False
         
         # Store values as object attributes
-        self.requestID = parse[1]
-        self.responseContents = parse[2]
+        self.requestID = parse["id"]
+        self.responseContents = parse["response"]
         
         return (True,self.responseContents,self.requestID)
     
@@ -626,3 +648,29 @@ class Response:
             "responseContents": self.responseContents
         }
         return json.dumps(responseJSON)
+
+# ---------- Scanning ---------- #
+def scan_email(email_string):
+    '''
+    Walk an email once and yield (block, message) for every blockchain block
+    in it, quoted replies included, in the order the blocks end. block is the
+    blockparser.Block, with its kind and offsets in the email. message is a
+    Request or Response parsed from it, or None if it's malformed. BUNDLE
+    blocks always give None, since they can only be checked against a local
+    blockchain (see Bundle.parse_from_email()).
+    
+    Arguments:
+        email_string -- The contents of an email, as text or as raw bytes.
+    '''
+    for block in scan_blocks(email_string):
+        message = None
+        if block.kind == "REQUEST":
+            request = Request()
+            if request.parse_from_block(block.body):
+                message = request
+        elif block.kind == "RESPONSE":
+            response = Response("")
+            response.isValid = response.parse_from_block(block.body)
+            if response.isValid:
+                message = response
+        yield block, message
@@ -0,0 +1,436 @@
+#! python3
+# outbox.py
+# Provides a durable, background outbound mail queue for the P.O.C application.
+
+import heapq, json, os, queue, smtplib, tempfile, threading, time, unittest, uuid
+
+from shared import Registry, write_json
+from smtp import SMTPSender
+
+# ---------- Global values ---------- #
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", os.path.join(os.getcwd(), "outbox"))
+OUTBOX_WORKERS = 4
+# A message still failing after this many attempts is moved to the dead-letter store
+MAX_ATTEMPTS = 8
+# Seconds before the first retry of a temporary (4xx) failure; doubled on every further attempt
+RETRY_BACKOFF = 30
+MAX_RETRY_DELAY = 60 * 60
+# (messages per second, burst) allowed per SMTP host, to stay under providers' throttling
+PROVIDER_RATES = {"smtp.gmail.com": (1.0, 10)}
+DEFAULT_PROVIDER_RATE = (5.0, 20)
+
+# ---------- Unit tests ---------- #
+class TestOutbox(unittest.TestCase):
+    class FakeSender:
+        def __init__(self, replies):
+            self.host = "localhost"
+            self.replies = replies
+            self.sent = []
+
+        def send(self, recipients, subject, email_content, broadcast=False):
+            reply = self.replies.pop(0) if self.replies else {}
+            if isinstance(reply, Exception):
+                raise reply
+            self.sent.append(list(recipients))
+            return reply
+
+    class FakeTransaction:
+        def __init__(self, error=None):
+            self.hash = b"\xab" * 32
+            self.account_address = "0x" + "cd" * 20
+            self.error = error
+
+        def exception(self):
+            return self.error
+
+        def add_done_callback(self, callback):
+            callback(self)
+
+    class FakeSMTP:
+        def __init__(self, replies):
+            self.replies = replies
+            self.sent = []
+
+        def ehlo(self):
+            pass
+
+        def login(self, email_address, password):
+            pass
+
+        def sendmail(self, from_addr, to_addrs, msg):
+            reply = self.replies.pop(0) if self.replies else None
+            if reply != None:
+                raise reply
+            self.sent.append(to_addrs)
+            return {}
+
+    def make_outbox(self, directory, replies, sender=None):
+        sender = self.FakeSender(replies) if sender == None else sender
+        outbox = Outbox(directory, workers=1, senderFactory=lambda email_address, password: sender, backoff=0.01, rates={})
+        return outbox, sender
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_temporary_failures_are_retried(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Arrange
+            # Bob's message goes out, then the server closes the session before Carol's, twice
+            connection = self.FakeSMTP([None, smtplib.SMTPResponseException(421, b"Try again later"),
+                                        smtplib.SMTPResponseException(421, b"Try again later"),
+                                        smtplib.SMTPRecipientsRefused({"carol@example.com": (450, b"Mailbox busy")})])
+            sender = SMTPSender("alice@example.com", "secret", "localhost", 25, starttls=False)
+            sender._open = lambda: connection
+            sender.build = lambda recipient_email, subject, email_content: "To: " + recipient_email
+            outbox, _ = self.make_outbox(directory, [], sender)
+            outbox.register_account("alice@example.com", "secret")
+            outbox.start()
+
+            # Act
+            outbox.enqueue("alice@example.com", ["bob@example.com", "carol@example.com"], "Consensus", "Hello")
+            self.wait_for(lambda: outbox.delivered == 1)
+            outbox.stop()
+
+            # Assert
+            self.assertEqual(connection.sent, ["bob@example.com", "carol@example.com"])
+            self.assertEqual(outbox.spool.load(), [])
+
+    def test_mail_waits_for_its_transaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Arrange
+            outbox, sender = self.make_outbox(directory, [])
+            outbox.register_account("alice@example.com", "secret")
+            outbox.start()
+
+            # Act
+            outbox.enqueue("alice@example.com", ["bob@example.com"], "Vote", "I approve", after=self.FakeTransaction(ValueError("reverted")))
+            job, error = outbox.deadLetters.get(timeout=5)
+            outbox.stop()
+
+            # Assert
+            self.assertEqual(sender.sent, [])
+            self.assertIn("reverted", error)
+            self.assertEqual(len(outbox.spool.load(Spool.DEAD)), 1)
+
+    def test_spooled_mail_survives_a_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Arrange
+            outbox, _ = self.make_outbox(directory, [])
+            outbox.enqueue("alice@example.com", ["bob@example.com"], "Consensus", "Hello")
+
+            # Act
+            restarted, sender = self.make_outbox(directory, [])
+            restarted.start()
+            restarted.register_account("alice@example.com", "secret")
+            self.wait_for(lambda: restarted.delivered == 1)
+            restarted.stop()
+
+            # Assert
+            self.assertEqual(sender.sent, [["bob@example.com"]])
+
+# ---------- Object class definition ---------- #
+def transaction_hash(hash):
+    '''
+    Return a transaction hash as a "0x..." string, as it is kept in the spool.
+    '''
+    return hash if isinstance(hash, str) else "0x" + bytes(hash).hex()
+
+class Spool:
+    '''
+    The on-disk copy of the outbox: one JSON file per message, under a
+    "pending" directory until it is delivered and under "dead" if it can't
+    be.
+
+    Arguments:
+        path -- The directory to keep the spool in.
+    '''
+    PENDING = "pending"
+    DEAD = "dead"
+
+    def __init__(self, path):
+        self.path = path
+        for state in (self.PENDING, self.DEAD):
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def save(self, job, state=PENDING):
+        write_json(os.path.join(self.path, state, job["id"] + ".json"), job)
+
+    def remove(self, job, state=PENDING):
+        try:
+            os.remove(os.path.join(self.path, state, job["id"] + ".json"))
+        except FileNotFoundError:
+            pass
+
+    def bury(self, job):
+        '''
+        Move a job to the dead-letter store.
+        '''
+        self.save(job, self.DEAD)
+        self.remove(job)
+
+    def load(self, state=PENDING):
+        jobs = []
+        directory = os.path.join(self.path, state)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".json"):
+                with open(os.path.join(directory, name)) as f:
+                    jobs.append(json.load(f))
+        return jobs
+
+class RateLimiter:
+    '''
+    A token bucket: take() blocks until sending one more message keeps the
+    rate under rate messages per second, allowing bursts of up to burst.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class Outbox:
+    '''
+    An Outbox delivers email from background worker threads so sending
+    never blocks the interface, and keeps every message in a Spool until
+    it is delivered so none are lost if the app crashes or is closed.
+
+    A message may wait for a blockchain transaction: it is only sent once
+    that transaction is confirmed, and goes to the dead-letter store if the
+    transaction fails. Temporary SMTP failures (4xx replies, dropped
+    connections) are retried with exponential backoff, to only the
+    recipients that weren't sent to, so nobody gets a message twice.
+    Permanent ones (5xx) and messages still failing after MAX_ATTEMPTS go
+    to the dead-letter store and are reported on .deadLetters as (job,
+    error). Each SMTP host is rate limited separately.
+
+    Passwords are never written to the spool. Messages for an account wait
+    until register_account() has been called for it in this session.
+
+    Arguments:
+        path -- The spool directory.
+        workers -- How many messages may be being sent at once.
+        senderFactory -- Called as senderFactory(email_address, password) to
+                         get the SMTPSender for an account.
+        backoff -- Seconds before the first retry, doubled on every further one.
+        rates -- {SMTP host: (messages per second, burst)}.
+    '''
+    _shared = Registry()
+
+    def __init__(self, path=OUTBOX_PATH, workers=OUTBOX_WORKERS, senderFactory=None, backoff=RETRY_BACKOFF, rates=None):
+        self.spool = Spool(path)
+        self.workers = workers
+        self.senderFactory = SMTPSender.for_account if senderFactory == None else senderFactory
+        self.backoff = backoff
+        self.rates = PROVIDER_RATES if rates == None else rates
+        self.deadLetters = queue.Queue()
+        self.delivered = 0
+        self._passwords = {}
+        # Heap of (time to send at, sequence number, job) for jobs ready to go
+        self._ready = []
+        self._sequence = 0
+        # email_address -> jobs waiting for register_account()
+        self._parked = {}
+        self._limiters = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        for job in self.spool.load():
+            self._resume(job)
+
+    @classmethod
+    def shared(cls):
+        '''
+        Return the app's outbox, creating and starting it on first use.
+        '''
+        return cls._shared.get(None, lambda: cls().start())
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, name="Outbox-{0}".format(n), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, wait=True):
+        '''
+        Stop the workers once they finish the message they are sending. With
+        wait=False this doesn't wait for them; a message still being sent
+        when the app exits stays spooled and is sent on the next start.
+        '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def register_account(self, email_address, password):
+        '''
+        Let the workers send the messages queued for this account.
+        '''
+        with self._condition:
+            self._passwords[email_address] = password
+            for job in self._parked.pop(email_address, []):
+                self._push(job)
+            self._condition.notify_all()
+
+    def enqueue(self, email_address, recipients, subject, email_content, broadcast=False, after=None, url=None):
+        '''
+        Spool a message for delivery and return its job ID.
+
+        Arguments:
+            email_address -- The account to send from.
+            recipients -- The addresses to send to.
+            subject, email_content -- The message, as for SMTPSender.send().
+            broadcast -- Send one message encrypted to every recipient (see SMTPSender.send()).
+            after -- A chain.PendingTransaction that must be confirmed before the message is sent.
+            url -- The RPC URL of after's node, so it can be tracked again after a restart.
+        '''
+        job = {
+            "id": uuid.uuid4().hex,
+            "email_address": email_address,
+            "recipients": list(recipients),
+            "subject": subject,
+            "content": email_content,
+            "broadcast": broadcast,
+            "attempts": 0,
+            "sendAt": 0,
+            "transactionHash": transaction_hash(after.hash) if after != None else None,
+            "account_address": after.account_address if after != None else None,
+            "url": url,
+            "confirmed": after == None,
+            "lastError": None,
+        }
+        self.spool.save(job)
+        if after == None:
+            self._schedule(job)
+        else:
+            after.add_done_callback(lambda pendingTransaction: self._confirmed(job, pendingTransaction))
+        return job["id"]
+
+    def _resume(self, job):
+        '''
+        Pick a spooled job back up after a restart.
+        '''
+        if job["confirmed"]:
+            self._schedule(job)
+            return
+        if job["url"] == None:
+            self._bury(job, "Unknown whether transaction {0} was confirmed".format(job["transactionHash"]))
+            return
+        from chain import ConsensusClient
+        pendingTransaction = ConsensusClient.for_url(job["url"]).tracker.track(job["transactionHash"], job["account_address"])
+        pendingTransaction.add_done_callback(lambda pendingTransaction: self._confirmed(job, pendingTransaction))
+
+    def _confirmed(self, job, pendingTransaction):
+        error = pendingTransaction.exception()
+        if error != None:
+            self._bury(job, "Transaction {0} failed: {1}".format(job["transactionHash"], error))
+            return
+        job["confirmed"] = True
+        self.spool.save(job)
+        self._schedule(job)
+
+    def _schedule(self, job):
+        with self._condition:
+            if job["email_address"] in self._passwords:
+                self._push(job)
+            else:
+                self._parked.setdefault(job["email_address"], []).append(job)
+            self._condition.notify()
+
+    def _push(self, job):
+        self._sequence += 1
+        heapq.heappush(self._ready, (job["sendAt"], self._sequence, job))
+
+    def _next_job(self):
+        with self._condition:
+            while not self._stopping:
+                if self._ready:
+                    wait = self._ready[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self._ready)[2]
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job == None:
+                return
+            self._deliver(job)
+
+    def _limiter(self, host):
+        with self._condition:
+            limiter = self._limiters.get(host)
+            if limiter == None:
+                limiter = RateLimiter(*self.rates.get(host, DEFAULT_PROVIDER_RATE))
+                self._limiters[host] = limiter
+            return limiter
+
+    def _deliver(self, job):
+        try:
+            sender = self.senderFactory(job["email_address"], self._passwords[job["email_address"]])
+            if self.rates:
+                self._limiter(sender.host).take()
+            refused = sender.send(job["recipients"], job["subject"], job["content"], job["broadcast"])
+        except smtplib.SMTPResponseException as e:
+            if 400 <= e.smtp_code < 500:
+                self._retry(job, "{0} {1}".format(e.smtp_code, e.smtp_error))
+            else:
+                self._bury(job, "{0} {1}".format(e.smtp_code, e.smtp_error))
+            return
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            self._retry(job, str(e))
+            return
+        except Exception as e:
+            self._bury(job, str(e))
+            return
+
+        temporary = [recipient for recipient, (code, _) in refused.items() if 400 <= code < 500]
+        permanent = [recipient for recipient in refused if recipient not in temporary]
+        if permanent:
+            self._bury(dict(job, id=uuid.uuid4().hex, recipients=permanent), "Refused: " + str({recipient: refused[recipient] for recipient in permanent}), False)
+        if temporary:
+            job["recipients"] = temporary
+            self._retry(job, "Refused: " + str({recipient: refused[recipient] for recipient in temporary}))
+            return
+        self.spool.remove(job)
+        with self._condition:
+            self.delivered += 1
+
+    def _retry(self, job, error):
+        job["attempts"] += 1
+        job["lastError"] = error
+        if job["attempts"] >= MAX_ATTEMPTS:
+            self._bury(job, error)
+            return
+        job["sendAt"] = time.time() + min(self.backoff * 2 ** (job["attempts"] - 1), MAX_RETRY_DELAY)
+        self.spool.save(job)
+        self._schedule(job)
+
+    def _bury(self, job, error, spooled=True):
+        job["lastError"] = error
+        if spooled:
+            self.spool.bury(job)
+        else:
+            self.spool.save(job, Spool.DEAD)
+        self.deadLetters.put((job, error))
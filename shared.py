@@ -0,0 +1,113 @@
+#! python3
+# shared.py
+# Provides the building blocks the app's long-lived services have in common.
+
+import json, os, tempfile, threading, unittest
+
+# ---------- Unit tests ---------- #
+class TestRegistry(unittest.TestCase):
+    def test_one_instance_per_key(self):
+        # Arrange
+        registry = Registry()
+        created = []
+
+        def create():
+            created.append(object())
+            return created[-1]
+
+        # Act
+        threads = [threading.Thread(target=registry.get, args=("key", create)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        shared = registry.get("key", create)
+        other = registry.get("other", create)
+
+        # Assert
+        self.assertEqual(len(created), 2)
+        self.assertIs(shared, created[0])
+        self.assertIs(other, created[1])
+
+    def test_close_all_forgets_every_instance(self):
+        # Arrange
+        registry = Registry()
+        registry.get("a", lambda: "first")
+        registry.get("b", lambda: "second")
+        closed = []
+
+        # Act
+        registry.close_all(closed.append)
+
+        # Assert
+        self.assertEqual(sorted(closed), ["first", "second"])
+        self.assertEqual(registry.get("a", lambda: "new"), "new")
+
+class TestWriteJson(unittest.TestCase):
+    def test_file_is_replaced_whole(self):
+        # Arrange
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "state.json")
+            write_json(path, {"version": 1})
+
+            # Act
+            write_json(path, {"version": 2})
+            with open(path) as f:
+                written = json.load(f)
+            leftovers = os.listdir(directory)
+
+        # Assert
+        self.assertEqual(written, {"version": 2})
+        self.assertEqual(leftovers, ["state.json"])
+
+# ---------- Object class definition ---------- #
+class Registry:
+    '''
+    A thread-safe map from a key to the one shared instance for it, created on
+    first use. Classes whose instances hold on to something costly (HTTP
+    sessions, IMAP and SMTP connections, gpg processes) keep one and hand out
+    instances through a classmethod such as ConsensusClient.for_url(), rather
+    than having each caller construct its own.
+    '''
+    def __init__(self):
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        '''
+        Return the instance for key, calling create() to make it the first time.
+        '''
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance == None:
+                instance = create()
+                self._instances[key] = instance
+            return instance
+
+    def put(self, key, instance):
+        with self._lock:
+            self._instances[key] = instance
+
+    def pop(self, key):
+        with self._lock:
+            return self._instances.pop(key, None)
+
+    def close_all(self, close):
+        '''
+        Call close(instance) on every instance and forget them all.
+        '''
+        with self._lock:
+            for instance in self._instances.values():
+                close(instance)
+            self._instances.clear()
+
+def write_json(path, data, **kwargs):
+    '''
+    Write data to path as JSON via a temporary file in the same directory, so
+    a crash mid-write can't leave the file half written. Extra keyword
+    arguments are passed to json.dump(). The temporary file ends in ".tmp".
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(f.name, path)
@@ -1,27 +1,306 @@
 import smtplib
 from email import encoders
-import gnupg
 import os
+from keyservice import KeyringService
+from shared import Registry
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.message import Message
 from email.mime.multipart import MIMEMultipart
+import threading, unittest
 
+# ---------- Global values ---------- #
+# Where to send mail through. Point these at a local SMTP stand-in (with SMTP_STARTTLS=0) for tests and benchmarks.
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
+SMTP_TIMEOUT = 60
+# Most recipients put on one broadcast message; Gmail refuses more than 100
+MAX_RECIPIENTS_PER_MESSAGE = 100
+
+# ---------- Unit tests ---------- #
+class TestSMTPSender(unittest.TestCase):
+    class FakeSMTP:
+        def __init__(self, server):
+            self.server = server
+            self.closed = False
+
+        def ehlo(self):
+            pass
+
+        def login(self, email_address, password):
+            self.server.logins += 1
+
+        def sendmail(self, from_addr, to_addrs, msg):
+            if self.closed:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            reply = self.server.replies.pop(0) if self.server.replies else None
+            if reply != None:
+                raise reply
+            self.server.sent.append(to_addrs)
+            return {}
+
+        def quit(self):
+            pass
+
+    class FakeServer:
+        def __init__(self):
+            self.logins = 0
+            self.sent = []
+            self.connections = []
+            # Errors for the next sendmail() calls to raise, in order; None sends normally
+            self.replies = []
+
+        def connect(self):
+            connection = TestSMTPSender.FakeSMTP(self)
+            self.connections.append(connection)
+            return connection
+
+    def make_sender(self):
+        server = self.FakeServer()
+        sender = SMTPSender("alice@example.com", "secret", "localhost", 25, starttls=False)
+        sender._open = server.connect
+        sender.build = lambda recipient_email, subject, email_content: "To: " + recipient_email
+        return sender, server
+
+    def test_one_session_is_used_for_every_recipient(self):
+        # Arrange
+        sender, server = self.make_sender()
+
+        # Act
+        sender.send(["bob@example.com", "carol@example.com"], "Consensus", "Hello")
+        sender.send(["dave@example.com"], "Consensus", "Hello")
+
+        # Assert
+        self.assertEqual(server.logins, 1)
+        self.assertEqual(server.sent, ["bob@example.com", "carol@example.com", "dave@example.com"])
+
+    def test_broadcast_sends_one_message_per_batch(self):
+        # Arrange
+        sender, server = self.make_sender()
+        built = []
+        sender.build = lambda recipient_email, subject, email_content: built.append(recipient_email)
+        voters = ["voter{0}@example.com".format(n) for n in range(MAX_RECIPIENTS_PER_MESSAGE + 1)]
+
+        # Act
+        sender.send(voters, "Consensus", "Hello", broadcast=True)
+
+        # Assert
+        self.assertEqual(built, [voters[:-1], voters[-1:]])
+        self.assertEqual(server.sent, [voters[:-1], voters[-1:]])
+
+    def test_dropped_session_is_reopened(self):
+        # Arrange
+        sender, server = self.make_sender()
+        sender.send(["bob@example.com"], "Consensus", "Hello")
+        server.connections[0].closed = True
+
+        # Act
+        refused = sender.send(["carol@example.com"], "Consensus", "Hello")
+
+        # Assert
+        self.assertEqual(refused, {})
+        self.assertEqual(server.logins, 2)
+        self.assertEqual(server.sent, ["bob@example.com", "carol@example.com"])
+
+    def test_session_closed_with_421_is_reopened(self):
+        # Arrange
+        sender, server = self.make_sender()
+        sender.send(["bob@example.com"], "Consensus", "Hello")
+        server.replies = [smtplib.SMTPResponseException(421, b"Idle timeout, closing connection")]
+
+        # Act
+        refused = sender.send(["carol@example.com"], "Consensus", "Hello")
+
+        # Assert
+        self.assertEqual(refused, {})
+        self.assertEqual(len(server.connections), 2)
+        self.assertEqual(server.sent, ["bob@example.com", "carol@example.com"])
+
+    def test_failed_session_reports_only_unsent_recipients(self):
+        # Arrange
+        sender, server = self.make_sender()
+        server.replies = [smtplib.SMTPDataError(554, b"Message rejected"), None,
+                          smtplib.SMTPServerDisconnected("Connection unexpectedly closed"),
+                          smtplib.SMTPServerDisconnected("Connection unexpectedly closed")]
+
+        # Act
+        refused = sender.send(["bob@example.com", "carol@example.com", "dave@example.com", "erin@example.com"], "Consensus", "Hello")
+
+        # Assert
+        self.assertEqual(refused, {"bob@example.com": (554, b"Message rejected"),
+                                   "dave@example.com": (421, b"Connection unexpectedly closed"),
+                                   "erin@example.com": (421, b"Connection unexpectedly closed")})
+        self.assertEqual(server.sent, ["carol@example.com"])
+        self.assertEqual(sender.server, None)
+
+# ---------- Object class definition ---------- #
+class SMTPSender:
+    '''
+    An SMTPSender keeps one authenticated SMTP session open for an account
+    and sends every message through it, so only the first send pays for
+    the connect, STARTTLS and LOGIN handshake. If the server has dropped
+    or closed (421) the session, it is reopened and the message sent again.
+
+    Arguments:
+        email_address, password -- The account to send from.
+        host, port -- The SMTP server to send through.
+        starttls -- Whether to upgrade the connection with STARTTLS.
+        keyring -- The KeyringService to sign and encrypt with. Defaults to the shared one.
+    '''
+    _senders = Registry()
+
+    def __init__(self, email_address, password, host=SMTP_HOST, port=SMTP_PORT, starttls=SMTP_STARTTLS, timeout=SMTP_TIMEOUT, keyring=None):
+        self.email_address = email_address
+        self.password = password
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.timeout = timeout
+        self.keyring = keyring
+        self.server = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_account(cls, email_address, password):
+        '''
+        Return the shared sender for this account on SMTP_HOST, creating it on first use.
+        '''
+        return cls._senders.get((email_address, password, SMTP_HOST, SMTP_PORT), lambda: cls(email_address, password))
+
+    @classmethod
+    def close_all(cls):
+        cls._senders.close_all(lambda sender: sender.close())
+
+    def connect(self):
+        '''
+        Open and log in the session now, unless it already is, so that bad
+        credentials are reported before anything is sent.
+        '''
+        with self._lock:
+            self._connect()
+
+    def send(self, recipients, subject, email_content, broadcast=False):
+        '''
+        Sign, encrypt and send email_content to every recipient over this
+        account's session.
+
+        By default each recipient gets their own message, encrypted to their
+        key alone, so no recipient can see who else was asked. With
+        broadcast=True the content is signed and encrypted once to every
+        recipient's key (up to MAX_RECIPIENTS_PER_MESSAGE per message) and
+        that one message goes to all of them, which is far cheaper for a
+        large proposal but shows each recipient the others' addresses and
+        key IDs.
+
+        Return a dict of the recipients that weren't sent to, as
+        {address: (SMTP code, error)} like smtplib.SMTP.sendmail() does; it
+        is empty if every message was sent. A message the server refuses
+        doesn't stop the others. If the session itself fails partway
+        through, every recipient not yet sent to is in the dict under that
+        error (421 if the connection was lost), so a caller retrying them
+        won't send twice to those already sent to.
+        '''
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if broadcast:
+            recipients = [recipients[start:start + MAX_RECIPIENTS_PER_MESSAGE] for start in range(0, len(recipients), MAX_RECIPIENTS_PER_MESSAGE)]
+        refused = {}
+        with self._lock:
+            for index, recipient_email in enumerate(recipients):
+                message = self.build(recipient_email, subject, email_content)
+                try:
+                    refused.update(self._sendmail(recipient_email, message))
+                except smtplib.SMTPRecipientsRefused as e:
+                    refused.update(e.recipients)
+                except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    # Only this message was refused; the session can still be used
+                    refused.update(dict.fromkeys(addresses(recipient_email), (e.smtp_code, e.smtp_error)))
+                except (smtplib.SMTPException, OSError) as e:
+                    if isinstance(e, smtplib.SMTPResponseException):
+                        reply = (e.smtp_code, e.smtp_error)
+                    else:
+                        reply = (421, str(e).encode())
+                    self.server = None
+                    for unsent in recipients[index:]:
+                        refused.update(dict.fromkeys(addresses(unsent), reply))
+                    break
+        return refused
+
+    def build(self, recipient_email, subject, email_content):
+        return build_email(self.email_address, recipient_email, subject, email_content, self.keyring)
+
+    def close(self):
+        with self._lock:
+            if self.server != None:
+                try:
+                    self.server.quit()
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self.server = None
+
+    def _sendmail(self, recipient_email, message):
+        self._connect()
+        try:
+            return self.server.sendmail(self.email_address, recipient_email, message)
+        except smtplib.SMTPServerDisconnected:
+            pass
+        except smtplib.SMTPResponseException as e:
+            # 421 means the server is closing the session, e.g. after an idle timeout
+            if e.smtp_code != 421:
+                raise
+        self.server = None
+        self._connect()
+        return self.server.sendmail(self.email_address, recipient_email, message)
+
+    def _open(self):
+        return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    def _connect(self):
+        if self.server != None:
+            return
+        server = self._open()
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+        server.login(self.email_address, self.password)
+        self.server = server
+
+
+
+def addresses(recipient_email):
+    '''
+    Return the addresses a message built for recipient_email goes to: one
+    address, or a list of them for a broadcast.
+    '''
+    return [recipient_email] if isinstance(recipient_email, str) else recipient_email
 
 def log_in(email_address,password):
-    server = smtplib.SMTP("smtp.gmail.com",587)
+    server = smtplib.SMTP(SMTP_HOST,SMTP_PORT)
 
     server.ehlo()
-    server.starttls()
+    if SMTP_STARTTLS:
+        server.starttls()
 
     server.login(email_address, password)
     return server
 
-def send_email(email_address,server,recipient_email,subject,email_content):
+def send_email(email_address,server,recipient_email,subject,email_content,keyring=None):
+
+    server.sendmail(email_address, recipient_email, build_email(email_address,recipient_email,subject,email_content,keyring))
 
-    current_path = os.path.join(os.getcwd(),"PGP FILE")
-    gpg = gnupg.GPG(gnupghome=current_path)
-    Public_Key = gpg.export_keys(email_address)
+def build_email(email_address,recipient_email,subject,email_content,keyring=None):
+    '''
+    Build the signed, PGP/MIME encrypted email. recipient_email may be one
+    address, or a list of them to make a single message readable by all.
+    '''
+    if keyring == None:
+        keyring = KeyringService.for_home()
+    Public_Key = keyring.export_key(email_address)
+    if not isinstance(recipient_email, str):
+        recipients, recipient_email = list(recipient_email), ", ".join(recipient_email)
+    else:
+        recipients = [recipient_email]
 
     message = Message()
     message.add_header(_name="Content-Type", _value="multipart/mixed", protected_headers="v1")
@@ -54,9 +333,9 @@ def send_email(email_address,server,recipient_email,subject,email_content):
     encrypted_message2.add_header(_name="Content-Type", _value="application/octet-stream")
     encrypted_message2.add_header(_name="Content-Description", _value="OpenPGP encrypted message")
     encrypted_message2.add_header(_name="Content-Disposition", _value="inline")
-    encrypted_message2.set_payload(str(gpg.encrypt(message.as_string(), recipient_email,sign=Public_Key)))
+    encrypted_message2.set_payload(str(keyring.encrypt(message.as_string(), recipients,sign=Public_Key)))
 
     encrypted_message.attach(encrypted_message1)
     encrypted_message.attach(encrypted_message2)
 
-    server.sendmail(email_address, recipient_email, encrypted_message.as_string())
+    return encrypted_message.as_string()